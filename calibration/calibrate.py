@@ -1,56 +1,106 @@
+import os
 import sys
 import time
 import numpy as np
 import matplotlib.pyplot as plt
-from scipy.optimize import curve_fit, leastsq
 from socketIO_client import SocketIO, BaseNamespace
-from scipy.linalg import lstsq
-import scipy, scipy.optimize
 import asyncio
-from threading import Thread
+from threading import Thread, Lock
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait
+import multiprocessing
 import json
 import optparse
-from mpl_toolkits.mplot3d import Axes3D
-from matplotlib import cm
-from matplotlib.ticker import LinearLocator, FormatStrFormatter
+from mpl_toolkits.mplot3d import Axes3D # registers the '3d' projection (needed before matplotlib 3.2)
+import fitting
+from fitting import sigmoid
 
 VALID_FIT_TYPES = ['sigmoid', 'linear', 'constant', '3d']
 
-data_received = False
-calibration = None
-input_data = None
-dpu_evolver_ns = None
-
 class EvolverNamespace(BaseNamespace):
+    client = None
+
     def on_connect(self, *args):
-        global connected
         print("Connected to eVOLVER as client")
-        connected = True
 
     def on_disconnect(self, *args):
-        global connected
         print("Disconected from eVOLVER as client")
-        connected = False
 
     def on_reconnect(self, *args):
-        global connected, stop_waiting
         print("Reconnected to eVOLVER as client")
-        connected = True
-        stop_waiting = True
 
     def on_calibration(self, data):
-        global data_received, calibration, input_data
-        calibration = data
-        data_received = True
+        if self.client is not None:
+            self.client.resolve('calibration', data)
 
     def on_calibrationnames(self, data):
-        global data_received
-        for calibration_name in data:
-            print(calibration_name)
-        data_received = True
+        if self.client is not None:
+            self.client.resolve('calibrationnames', data)
 
-def sigmoid(x, a, b, c, d):
-    return a + (b - a)/(1 + (10**((c-x)*d)))
+class CalibrationClient:
+    """
+        asyncio client for the eVOLVER calibration API. Socket events are
+        handled on a background thread and resolve futures on the event loop,
+        so requests can be awaited, several at once, over one connection.
+    """
+    def __init__(self, evolver_ip, evolver_port = 8081, timeout = 60):
+        self.evolver_ip = evolver_ip
+        self.evolver_port = evolver_port
+        self.timeout = timeout
+        self.loop = None
+        self.socketIO = None
+        self.namespace = None
+        self._pending = {'calibration': [], 'calibrationnames': []}
+        self._lock = Lock()
+
+    async def connect(self):
+        self.loop = asyncio.get_running_loop()
+        print("Waiting for evolver connection...")
+        # SocketIO connects in its constructor, so keep it off the event loop
+        self.socketIO = await self.loop.run_in_executor(None, SocketIO, self.evolver_ip, self.evolver_port)
+        self.namespace = self.socketIO.define(EvolverNamespace, '/dpu-evolver')
+        self.namespace.client = self
+        listener = Thread(target = self.socketIO.wait, name = 'evolver-socket')
+        listener.daemon = True
+        listener.start()
+
+    def resolve(self, event, data):
+        """Called from the socket thread: completes the oldest matching request."""
+        with self._lock:
+            pending = self._pending[event]
+            if not pending:
+                return
+            match = 0
+            if event == 'calibration' and isinstance(data, dict):
+                names = [name for name, future in pending]
+                if data.get('name') in names:
+                    match = names.index(data.get('name'))
+            name, future = pending.pop(match)
+        self.loop.call_soon_threadsafe(lambda: future.done() or future.set_result(data))
+
+    async def _request(self, event, name, message, payload):
+        future = self.loop.create_future()
+        with self._lock:
+            self._pending[event].append((name, future))
+        self.namespace.emit(message, payload, namespace = '/dpu-evolver')
+        try:
+            return await asyncio.wait_for(future, self.timeout)
+        finally:
+            with self._lock:
+                if (name, future) in self._pending[event]:
+                    self._pending[event].remove((name, future))
+
+    async def get_calibration(self, name):
+        return await self._request('calibration', name, 'getcalibration', {'name': name})
+
+    async def get_calibration_names(self):
+        return await self._request('calibrationnames', None, 'getcalibrationnames', [])
+
+    def set_fit(self, name, fit):
+        self.namespace.emit('setfitcalibration', {'name': name, 'fit': fit}, namespace = '/dpu-evolver')
+
+    def disconnect(self):
+        if self.socketIO is not None:
+            self.socketIO.disconnect()
 
 def linear(x, a, b):
     return np.array(x)*a + b
@@ -60,8 +110,7 @@ def three_dim(data, c0, c1, c2, c3, c4, c5):
     y = data[1]
     return c0 + c1*x + c2*y + c3*x**2 + c4*x*y + c5*y**2
 
-def sigmoid_fit(calibration, fit_name, params, graph = True):
-    coefficients = []
+def sigmoid_fit(calibration, fit_name, params, graph = True, budget = 10, workers = None, report = None, cache = None):
 
     # For single param calibrations, just take the first value from the returned dictionary
     calibration_data = list(process_vial_data(calibration, param = params[0]).values())[0]
@@ -69,16 +118,32 @@ def sigmoid_fit(calibration, fit_name, params, graph = True):
     standard_deviations = calibration_data["standard_deviations"]
     measured_data = calibration_data["measured_data"]
 
-    for i in range(16):
-        paramsig, paramlin = curve_fit(sigmoid, measured_data[i], medians[i], p0 = [62721, 62721, 0, -1], maxfev=1000000000)
-        coefficients.append(np.array(paramsig).tolist())
+    # Vials are fitted in parallel, starting from the active fit when there is one
+    warm_start = fitting.active_coefficients(calibration, 'sigmoid', params)
+    def fit_vials(vials):
+        vial_warm_start = None if warm_start is None else [warm_start[v] if v < len(warm_start) else [np.nan] * 4 for v in vials]
+        return fitting.per_vial(fitting.fit_sigmoid(measured_data[vials], medians[vials], vial_warm_start, budget, workers), vials)
+    # Only vials whose points changed since a cached fit are refitted
+    fit = fitting.fit_with_cache(cache, 'sigmoid', params, [measured_data, medians], fit_vials)
+    coefficients = [vial['coefficients'] for vial in fit]
+    for i, vial in enumerate(fit):
+        if vial['status'] != 'ok':
+            print('Vial {0}: sigmoid fit {1} ({2})'.format(i, vial['status'], vial['message']))
+            # Keep the vial usable with its current fit if there is one
+            if warm_start is not None and i < len(warm_start):
+                print('Vial {0}: keeping the coefficients of the active fit'.format(i))
+                coefficients[i] = warm_start[i]
+            else:
+                coefficients[i] = [np.nan] * 4
     print(coefficients)
+    if report is not None:
+        report.update({name: [vial[name] for vial in fit] for name in ('status', 'message', 'rmse')})
 
     if graph:
-        graph_2d_data(sigmoid, measured_data, medians, standard_deviations, coefficients, fit_name, 'sigmoid', 0, max([max(sublist) for sublist in measured_data]), 500)
+        draw(graph, fit_name, graph_2d_data, sigmoid, measured_data, medians, standard_deviations, coefficients, fit_name, 'sigmoid', 0, np.nanmax(measured_data), 500)
     return create_fit(coefficients, fit_name, "sigmoid", time.time(), params)
 
-def linear_fit(calibration, fit_name, params, graph = True):
+def linear_fit(calibration, fit_name, params, graph = True, report = None, cache = None):
     coefficients = []
 
     # For single param calibrations, just take the first value from the returned dictionary
@@ -87,28 +152,29 @@ def linear_fit(calibration, fit_name, params, graph = True):
     standard_deviations = calibration_data["standard_deviations"]
     measured_data = calibration_data["measured_data"]
 
-    for i in range(16):
-        paramlin, cov = curve_fit(linear, medians[i], measured_data[i])
-        coefficients.append(paramlin.tolist())
+    # Linear in its coefficients: one batched least squares solve for all vials
+    fit = fitting.fit_with_cache(cache, 'linear', params, [medians, measured_data],
+                                 lambda vials: fitting.per_vial(fitting.fit_linear(medians[vials], measured_data[vials]), vials))
+    fit = {name: np.array([vial[name] for vial in fit]) for name in ('coefficients', 'rmse', 'r_squared', 'points')}
+    coefficients = fit['coefficients'].tolist()
 
     print(coefficients)
+    fitting.report(fit)
+    if report is not None:
+        report.update(rmse = fit['rmse'].tolist(), r_squared = fit['r_squared'].tolist(), points = fit['points'].tolist())
     if graph:
-        graph_2d_data(linear, medians, measured_data, standard_deviations, coefficients, fit_name, 'linear', 500, 3000, 50)
+        draw(graph, fit_name, graph_2d_data, linear, medians, measured_data, standard_deviations, coefficients, fit_name, 'linear', 500, 3000, 50)
 
     return create_fit(coefficients, fit_name, "linear", time.time(), params)
 
 def constant_fit(calibration, fit_name, params):
     calibration_data = list(process_vial_data(calibration, param = params[0]).values())[0]
     measured_data = calibration_data["measured_data"]
-    coefficients = []
-    for i in range(len(measured_data)):
-        coefficients.append(calibration_data['medians'][i][0]/measured_data[i])
+    coefficients = (calibration_data['medians'][:, 0] / measured_data).tolist()
     print(coefficients)
     return create_fit(coefficients, fit_name, "constant", time.time(), params)
 
-def three_dimension_fit(calibration, fit_name, params, graph = True):
-    initial_parameters = [1.0, 1.0, 1.0, 1.0, 1.0, 1.0]
-    coefficients = []
+def three_dimension_fit(calibration, fit_name, params, graph = True, report = None, cache = None):
     datas = []
     calibration_data = process_vial_data(calibration)
 
@@ -119,35 +185,42 @@ def three_dimension_fit(calibration, fit_name, params, graph = True):
             y_datas = param_data['medians']
         z_datas = param_data['measured_data']
 
-    for i in range(16):
-        x_data = np.array(x_datas[i])
-        y_data = np.array(y_datas[i])
-        z_data = np.array(z_datas[i])
-
-        data = [x_data, y_data, z_data]
-
-        fitted_parameters, pcov = scipy.optimize.curve_fit(three_dim, [x_data, y_data], z_data, p0 = initial_parameters)
-
-        modelPredictions = three_dim(data, *fitted_parameters)
-        absError = modelPredictions - z_data
-        SE = np.square(absError) # squared errors
-        MSE = np.mean(SE) # mean squared errors
-        RMSE = np.sqrt(MSE) # Root Mean Squared Error, RMSE
-        Rsquared = 1.0 - (np.var(absError) / np.var(z_data))
-        print('Vial ' + str(i))
-        print('RMSE:', RMSE)
-        print('R-squared:', Rsquared)
-        print('fitted prameters', fitted_parameters)
+    # three_dim is linear in its coefficients: one batched least squares solve for all vials
+    z_datas = np.broadcast_to(z_datas, x_datas.shape)
+    fit = fitting.fit_with_cache(cache, '3d', params, [x_datas, y_datas, z_datas],
+                                 lambda vials: fitting.per_vial(fitting.fit_three_dim(x_datas[vials], y_datas[vials], z_datas[vials]), vials))
+    fit = {name: np.array([vial[name] for vial in fit]) for name in ('coefficients', 'rmse', 'r_squared', 'points')}
+    coefficients = fit['coefficients'].tolist()
+    fitting.report(fit)
+    if report is not None:
+        report.update(rmse = fit['rmse'].tolist(), r_squared = fit['r_squared'].tolist(), points = fit['points'].tolist())
 
-        coefficients.append(fitted_parameters.tolist())
-        datas.append(data)
+    for i in range(len(coefficients)):
+        print('Vial {0} fitted parameters: {1}'.format(i, coefficients[i]))
+        datas.append([x_datas[i], y_datas[i], z_datas[i]])
 
     if graph:
-        graph_3d_data(three_dim, datas, coefficients, fit_name)
+        draw(graph, fit_name, graph_3d_data, three_dim, datas, coefficients, fit_name)
 
     return create_fit(coefficients, fit_name, '3d', time.time(), params)
 
-def graph_2d_data(func, measured_data, medians, standard_deviations, coefficients, fit_name, fit_type, space_min, space_max, space_step):
+def draw(graph, fit_name, plot, *args):
+    """
+        graph is True to show the plot, or a PlotRenderer to render it to a file.
+    """
+    if callable(graph):
+        graph(fit_name, plot.__name__, *args)
+    else:
+        plot(*args)
+
+def show_or_save(fig, output):
+    if output is None:
+        plt.show()
+    else:
+        fig.savefig(output, dpi = 100)
+        plt.close(fig)
+
+def graph_2d_data(func, measured_data, medians, standard_deviations, coefficients, fit_name, fit_type, space_min, space_max, space_step, output = None):
     linear_space = np.linspace(space_min, space_max, space_step)
     fig, ax = plt.subplots(4, 4)
     fig.suptitle("Fit Name: " + fit_name)
@@ -158,17 +231,17 @@ def graph_2d_data(func, measured_data, medians, standard_deviations, coefficient
         ax[i // 4, (i % 4)].set_title('Vial: ' + str(i))
         ax[i // 4, (i % 4)].ticklabel_format(style='sci', axis='y', scilimits=(0,0))
     plt.subplots_adjust(hspace = 0.6)
-    plt.show()
+    show_or_save(fig, output)
 
-def graph_3d_data(func, datas, coefficients, fit_name):
+def graph_3d_data(func, datas, coefficients, fit_name, output = None):
     fig = plt.figure()
     fig.suptitle("Fit Name: " + fit_name)
     for i, data in enumerate(datas):
         x_data = data[0]
         y_data = data[1]
         z_data = data[2]
-        x_space = np.linspace(min(x_data), max(x_data), 20)
-        y_space= np.linspace(min(y_data), max(y_data), 20)
+        x_space = np.linspace(np.nanmin(x_data), np.nanmax(x_data), 20)
+        y_space= np.linspace(np.nanmin(y_data), np.nanmax(y_data), 20)
         X, Y = np.meshgrid(x_space, y_space)
         Z = func(np.array([X, Y]), *coefficients[i])
 
@@ -182,19 +255,53 @@ def graph_3d_data(func, datas, coefficients, fit_name):
         ax.set_ylabel('OD135') # Y axis data label
         ax.set_zlabel('OD Measured') # Z axis data label
 
-    plt.show()
+    show_or_save(fig, output)
+
+def render_graph(plot_name, output, *args):
+    # Runs in the renderer process, without a display
+    plt.switch_backend('Agg')
+    globals()[plot_name](*args, output = output)
+    return output
+
+class PlotRenderer:
+    """
+        Renders the diagnostic figures of fits to PNG files with the Agg
+        backend, in a separate process so fitting carries on meanwhile.
+    """
+    def __init__(self, output_dir):
+        self.output_dir = output_dir
+        self.pool = ProcessPoolExecutor(max_workers = 1, mp_context = multiprocessing.get_context('spawn'))
+        self.futures = {}
+
+    def __call__(self, fit_name, plot_name, *args):
+        output = os.path.join(self.output_dir, '{0}.png'.format(fit_name))
+        self.futures[fit_name] = self.pool.submit(render_graph, plot_name, output, *args)
+
+    def close(self):
+        """Waits for all figures; returns {fit name: file or error message}."""
+        wait(list(self.futures.values()))
+        self.pool.shutdown()
+        plots = {}
+        for fit_name, future in self.futures.items():
+            try:
+                plots[fit_name] = future.result()
+            except Exception as e:
+                plots[fit_name] = 'error: {0}'.format(e)
+        return plots
 
 def process_vial_data(calibration, param = None):
     """
         Data is structed as a list of lists. Each element in the outer list is a vial.
         That element is also a list, one for each point to be fit. The list contains 1 or more points.
-        This function takes the median of those points and calculates the standard deviation, returning
-        a similar structure.
+        This function takes the median of those points and calculates the standard deviation.
 
         [vial0, vial1, vial2, ... ]
         vial = [point0, point1, point2, ...]
         point = [replicate0, replicate1, replicate2, ...]
 
+        All raw sets are converted once into a NaN-padded (params, vials, points, replicates)
+        array (see fitting.raw_array), so medians and standard deviations are (vials, points)
+        arrays and measured data a (vials, ...) array, as the fitting backends expect.
     """
     raw_sets = calibration.get("raw", None)
     if raw_sets is None:
@@ -209,33 +316,164 @@ def process_vial_data(calibration, param = None):
             vial_datas.append(raw_set["vialData"])
             names.append(raw_set.get("param"))
 
-    for i, vial_data in enumerate(vial_datas):
-        medians = []
-        standard_deviations = []
-        for vial in vial_data:
-            point_medians = []
-            point_standard_deviations = []
-            for point in vial:
-                point_medians.append(np.median(point))
-                point_standard_deviations.append(np.std(point))
-            medians.append(point_medians)
-            standard_deviations.append(point_standard_deviations)
-        calibration_data[names[i]] = {"medians": medians, "standard_deviations": standard_deviations, "measured_data": calibration["measuredData"]}
+    medians, standard_deviations = fitting.replicate_stats(fitting.raw_array(vial_datas))
+    measured_data = fitting.as_array(calibration["measuredData"])
+    for i, name in enumerate(names):
+        calibration_data[name] = {"medians": medians[i], "standard_deviations": standard_deviations[i], "measured_data": measured_data}
 
     return calibration_data
 
+def load_calibration_file(path):
+    """
+        Reads a calibration saved as JSON. Older exports such as 2dcalibrationdata.json
+        (vialData keyed by param, one inputData list of standards) are converted to the
+        format served by the eVOLVER. In those the standards were rotated through the
+        vials, so vial v measured standard (j - v - 1) % 16 at point j.
+    """
+    with open(path) as f:
+        calibration = json.load(f)
+    if 'raw' not in calibration and 'vialData' in calibration:
+        vial_count = max(len(vial_data) for vial_data in calibration['vialData'].values())
+        standards = calibration['inputData']
+        calibration = {
+            'name': calibration.get('filename', os.path.basename(path)),
+            'raw': [{'param': param, 'vialData': vial_data} for param, vial_data in calibration['vialData'].items()],
+            'measuredData': [np.roll(standards, vial + 1).tolist() for vial in range(vial_count)],
+        }
+    return calibration
+
 def create_fit(coefficients, fit_name, fit_type, time_fit, params):
     return {"name": fit_name, "coefficients": coefficients, "type": fit_type, "timeFit": time_fit, "active": False, "params": params}
 
-def start_background_loop(loop):
-    asyncio.set_event_loop(loop)
-    loop.run_forever()
+def fit_calibration(calibration, fit_type, fit_name, params, graph = True, budget = 10, workers = None, report = None, cache = None):
+    if fit_type == "sigmoid":
+        return sigmoid_fit(calibration, fit_name, params, graph = graph, budget = budget, workers = workers, report = report, cache = cache)
+    elif fit_type == "linear":
+        return linear_fit(calibration, fit_name, params, graph = graph, report = report, cache = cache)
+    elif fit_type == "constant":
+        return constant_fit(calibration, fit_name, params)
+    elif fit_type == "3d":
+        return three_dimension_fit(calibration, fit_name, params, graph = graph, report = report, cache = cache)
+
+def write_report(path, jobs, fits, reports, plots):
+    """Machine-readable summary of every fit: the fit itself, per-vial quality and plot file."""
+    entries = []
+    for job, fit, report in zip(jobs, fits, reports):
+        entries.append({'calibration': job['name'], 'file': job.get('file'), 'fit': fit,
+                        'vials': report, 'plot': plots.get(job['fit_name'])})
+    with open(path, 'w') as f:
+        json.dump(json_safe(entries), f, indent = 2)
+    print('Wrote fit report to {0}'.format(path))
+
+def json_safe(value):
+    # NaN and numpy values are not valid JSON
+    if isinstance(value, dict):
+        return {key: json_safe(v) for key, v in value.items()}
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return [json_safe(v) for v in value]
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and not np.isfinite(value):
+        return None
+    return value
+
+def load_jobs(options, parser):
+    """
+        Calibrations to fit: the one given with -n or -i and -t/-f/-p, or the list
+        in a --batch JSON file, e.g.
+        [{"name": "od135-cal", "fit_type": "sigmoid", "fit_name": "od135-fit", "params": "od_135"}, ...]
+        Jobs with a "file" instead of (or as well as) a "name" are read from that
+        calibration file and fitted offline.
+    """
+    if options.batch:
+        with open(options.batch) as f:
+            jobs = json.load(f)
+    elif options.calname or options.input:
+        jobs = [{'name': options.calname, 'file': options.input, 'fit_type': options.fittype, 'fit_name': options.fitname, 'params': options.params}]
+    else:
+        return []
+
+    for job in jobs:
+        if job.get('fit_name') is None:
+            print("Please input a name for the fit!")
+            parser.print_help()
+            sys.exit(2)
+        if job.get('fit_type') not in VALID_FIT_TYPES:
+            print("Invalid fit type!")
+            parser.print_help()
+            sys.exit(2)
+        if not job.get('params'):
+            print("Must provide at least 1 parameter!")
+            parser.print_help()
+            sys.exit(2)
+        if isinstance(job['params'], str):
+            job['params'] = job['params'].strip().split(',')
+        if job.get('file') and not job.get('name'):
+            job['name'] = os.path.splitext(os.path.basename(job['file']))[0]
+    return jobs
+
+async def main(options, parser):
+    jobs = load_jobs(options, parser)
+    online = options.getnames or any(not job.get('file') for job in jobs)
+    if online and not options.ipaddress:
+        print('Please specify ip address')
+        parser.print_help()
+        sys.exit(2)
+
+    client = None
+    if online:
+        client = CalibrationClient('http://' + options.ipaddress, 8081)
+        await client.connect()
+
+    if options.getnames:
+        print("Getting calibration names...")
+        for calibration_name in await client.get_calibration_names():
+            print(calibration_name)
 
-def run(evolver_ip, evolver_port):
-    global dpu_evolver_ns
-    socketIO = SocketIO(evolver_ip, evolver_port)
-    dpu_evolver_ns = socketIO.define(EvolverNamespace, '/dpu-evolver')
-    socketIO.wait()
+    if jobs:
+        # Fetch every calibration at once over the same connection, or read it from its file
+        async def get(job):
+            if job.get('file'):
+                return load_calibration_file(job['file'])
+            return await client.get_calibration(job['name'])
+        calibrations = await asyncio.gather(*[get(job) for job in jobs])
+
+        # Offline fits and --output-dir render figures to files in the background,
+        # otherwise graphs need the main thread, so only fits without graphs run in parallel
+        renderer = None
+        if options.outputdir:
+            os.makedirs(options.outputdir, exist_ok = True)
+        if not options.nograph and (options.outputdir or not online):
+            renderer = PlotRenderer(options.outputdir or '.')
+        reports = [{} for job in jobs]
+        cache = None if options.nocache else fitting.FitCache(options.cache)
+        if renderer is None and not options.nograph and len(jobs) == 1:
+            fits = [fit_calibration(calibrations[0], jobs[0]['fit_type'], jobs[0]['fit_name'], jobs[0]['params'],
+                                    graph = True, budget = options.fittimeout, workers = options.workers, report = reports[0], cache = cache)]
+        else:
+            loop = asyncio.get_running_loop()
+            with ThreadPoolExecutor(max_workers = len(jobs)) as pool:
+                fits = await asyncio.gather(*[loop.run_in_executor(pool, fit_calibration, calibration, job['fit_type'], job['fit_name'],
+                                                                   job['params'], renderer or False, options.fittimeout, options.workers, report, cache)
+                                              for calibration, job, report in zip(calibrations, jobs, reports)])
+
+        if cache is not None:
+            cache.save()
+        plots = renderer.close() if renderer is not None else {}
+        if options.outputdir or not online:
+            write_report(os.path.join(options.outputdir or '.', 'fit_report.json'), jobs, fits, reports, plots)
+
+        for job, fit in zip(jobs, fits):
+            if job.get('file'):
+                continue  # offline fits are only reported
+            update_cal = 'y'
+            if not options.alwaysyes:
+                update_cal = input('Update eVOLVER with calibration {0} ({1})? (y/n): '.format(job['fit_name'], job['name']))
+            if update_cal == 'y':
+                client.set_fit(job['name'], fit)
+
+    if client is not None:
+        client.disconnect()
 
 if __name__ == '__main__':
     parser = optparse.OptionParser()
@@ -247,72 +485,15 @@ if __name__ == '__main__':
     parser.add_option('-p', '--params', action = 'store', dest = 'params', help = "Desired parameter(s) to fit. Comma separated, no spaces")
     parser.add_option('-y', '--always-yes', action = 'store_true', dest = 'alwaysyes', help = "Skips asking to save calibration to eVOLVER")
     parser.add_option('-r', '--no-graph', action = 'store_true', dest = 'nograph', help = "Skips graphing if provided")
+    parser.add_option('-s', '--fit-timeout', action = 'store', dest = 'fittimeout', type = 'float', default = 10, help = "Seconds allowed per vial for sigmoid fits (default 10)")
+    parser.add_option('-w', '--workers', action = 'store', dest = 'workers', type = 'int', help = "Processes used for sigmoid fits (default: one per CPU)")
+    parser.add_option('-b', '--batch', action = 'store', dest = 'batch', help = "JSON file listing several calibrations to fit, each with name (or file), fit_type, fit_name and params. Fetched and fitted in parallel")
+    parser.add_option('-i', '--input', action = 'store', dest = 'input', help = "Calibration JSON file to fit offline, without an eVOLVER")
+    parser.add_option('-o', '--output-dir', action = 'store', dest = 'outputdir', help = "Directory for the fit plots (PNG) and fit_report.json. Default for offline fits: current directory")
 
+    parser.add_option('-c', '--cache', action = 'store', dest = 'cache', default = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fit_cache.json'), help = "File caching fits per vial, so only vials whose calibration data changed are refitted (default: fit_cache.json next to this script)")
+    parser.add_option('--no-cache', action = 'store_true', dest = 'nocache', help = "Refits every vial and leaves the fit cache untouched")
 
     (options, args) = parser.parse_args()
-    cal_name = options.calname
-    get_names = options.getnames
-    fit_type = options.fittype
-    fit_name = options.fitname
-    params = options.params
-    always_yes = options.alwaysyes
-    no_graph = options.nograph
-
-    if not options.ipaddress:
-        print('Please specify ip address')
-        parser.print_help()
-        sys.exit(2)
 
-    ip_address = 'http://' + options.ipaddress
-
-    new_loop = asyncio.new_event_loop()
-    t = Thread(target = start_background_loop, args = (new_loop,))
-    t.daemon = True
-    t.start()
-    new_loop.call_soon_threadsafe(run, ip_address, 8081)
-
-    if dpu_evolver_ns is None:
-        print("Waiting for evolver connection...")
-
-    while dpu_evolver_ns is None:
-        pass
-
-    if get_names:
-        print("Getting calibration names...")
-        dpu_evolver_ns.emit('getcalibrationnames', [], namespace = '/dpu-evolver')
-    if cal_name:
-        if fit_name is None:
-            print("Please input a name for the fit!")
-            parser.print_help()
-            sys.exit(2)
-        if fit_type not in VALID_FIT_TYPES:
-            print("Invalid fit type!")
-            parser.print_help()
-            sys.exit(2)
-        if params is None:
-            print("Must provide at least 1 parameter!")
-            parser.print_help()
-            sys.exit(2)
-        if no_graph is None:
-            no_graph = False
-        dpu_evolver_ns.emit('getcalibration', {'name':cal_name}, namespace='/dpu-evolver')
-        params = params.strip().split(',')
-
-    while not data_received:
-        pass
-
-    if cal_name is not None and not get_names:
-        if fit_type == "sigmoid":
-            fit = sigmoid_fit(calibration, fit_name, params, graph = not no_graph)
-        elif fit_type == "linear":
-            fit = linear_fit(calibration, fit_name, params, graph = not no_graph)
-        elif fit_type == "constant":
-            fit = constant_fit(calibration, fit_name, params, graph = not no_graph)
-        elif fit_type == "3d":
-            fit = three_dimension_fit(calibration, fit_name, params, graph = not no_graph)
-
-        update_cal = 'y'
-        if not always_yes:
-            update_cal = input('Update eVOLVER with calibration? (y/n): ')
-        if update_cal == 'y':
-            dpu_evolver_ns.emit('setfitcalibration', {'name': cal_name, 'fit': fit}, namespace = '/dpu-evolver')
+    asyncio.run(main(options, parser))
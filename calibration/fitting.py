@@ -0,0 +1,341 @@
+"""
+    Fitting backends for calibrate.py.
+
+    Data for all vials is handled as NaN-padded arrays shaped (vials, points),
+    so vials with fewer points than others are supported. Padding is ignored
+    by every fit.
+"""
+import os
+import json
+import time
+import hashlib
+import warnings
+import threading
+import multiprocessing
+import concurrent.futures
+import numpy as np
+from scipy.optimize import curve_fit
+from scipy.special import expit
+
+def pad(rows, fill = np.nan):
+    """
+        Converts a list of per-vial lists of possibly different lengths into a
+        (vials, points) float array, padding short vials with NaN.
+    """
+    rows = [np.atleast_1d(np.asarray(row, dtype = float)) for row in rows]
+    width = max([len(row) for row in rows] + [0])
+    padded = np.full((len(rows), width), fill)
+    for i, row in enumerate(rows):
+        padded[i, :len(row)] = row
+    return padded
+
+def as_array(rows):
+    """Rows as a float array, NaN-padded with pad() when they are ragged."""
+    try:
+        return np.asarray(rows, dtype = float)
+    except ValueError:
+        return pad(rows)
+
+def raw_array(raw_sets):
+    """
+        Converts raw calibration sets (one per param, each a list of vials of
+        points of replicate readings) into one float array shaped
+        (params, vials, points, replicates). Missing vials, points and
+        replicates are NaN.
+    """
+    try:
+        # Rectangular data converts directly
+        array = np.asarray(raw_sets, dtype = float)
+        if array.ndim == 4:
+            return array
+    except ValueError:
+        pass
+
+    shape = [len(raw_sets), 0, 0, 0]
+    for vials in raw_sets:
+        shape[1] = max(shape[1], len(vials))
+        for points in vials:
+            shape[2] = max(shape[2], len(points))
+            for point in points:
+                shape[3] = max(shape[3], len(np.atleast_1d(point)))
+    array = np.full(shape, np.nan)
+    for p, vials in enumerate(raw_sets):
+        for v, points in enumerate(vials):
+            for i, point in enumerate(points):
+                point = np.atleast_1d(np.asarray(point, dtype = float))
+                array[p, v, i, :len(point)] = point
+    return array
+
+def replicate_stats(raw):
+    """
+        Median and standard deviation over the replicates (last axis) of a
+        raw_array, ignoring padding. Points without any reading are NaN.
+    """
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)  # all-NaN padding points
+        return np.nanmedian(raw, axis = -1), np.nanstd(raw, axis = -1)
+
+def linear_design(x):
+    """Columns [x, 1] for linear(x, a, b) = a*x + b."""
+    return np.stack([x, np.ones_like(x)], axis = -1)
+
+def three_dim_design(x, y):
+    """Columns for three_dim: c0 + c1*x + c2*y + c3*x^2 + c4*x*y + c5*y^2."""
+    return np.stack([np.ones_like(x), x, y, x * x, x * y, y * y], axis = -1)
+
+def batched_lstsq(design, target):
+    """
+        Solves the least squares problem of every vial in one batched call.
+
+        design is (vials, points, coefficients) and target (vials, points).
+        Points where the target or any design column is NaN are left out of
+        their vial's fit. Columns are scaled to unit norm before solving, since
+        raw ADC values squared are ~1e9 and would make the system ill-conditioned.
+
+        Returns a dict of per-vial arrays: 'coefficients' (vials, coefficients),
+        'rmse', 'r_squared' and 'points' (number of points used).
+    """
+    design = np.asarray(design, dtype = float)
+    target = np.asarray(target, dtype = float)
+    valid = np.isfinite(target) & np.isfinite(design).all(axis = -1)
+
+    A = np.where(valid[..., None], design, 0.)
+    z = np.where(valid, target, 0.)
+    scale = np.sqrt(np.sum(A * A, axis = 1, keepdims = True))
+    scale[scale == 0] = 1.
+    coefficients = np.matmul(np.linalg.pinv(A / scale), z[..., None])[..., 0] / scale[:, 0, :]
+
+    n = valid.sum(axis = 1)
+    residuals = np.where(valid, np.matmul(A, coefficients[..., None])[..., 0] - z, 0.)
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        rmse = np.sqrt(np.sum(residuals ** 2, axis = 1) / n)
+        mean = np.sum(z, axis = 1) / n
+        total = np.sum(np.where(valid, (z - mean[:, None]) ** 2, 0.), axis = 1)
+        r_squared = 1. - np.sum(residuals ** 2, axis = 1) / total
+
+    # Vials without enough points for a unique solution have no fit
+    underdetermined = n < design.shape[-1]
+    coefficients[underdetermined] = np.nan
+    rmse[underdetermined] = np.nan
+    r_squared[underdetermined] = np.nan
+    return {'coefficients': coefficients, 'rmse': rmse, 'r_squared': r_squared, 'points': n}
+
+def fit_linear(x, y):
+    """Fits y = a*x + b for every vial; coefficients are [a, b] as in calibrate.linear."""
+    x = np.asarray(x, dtype = float)
+    return batched_lstsq(linear_design(x), np.broadcast_to(y, x.shape))
+
+def fit_three_dim(x, y, z):
+    """Fits z = three_dim([x, y], c0..c5) for every vial."""
+    x = np.asarray(x, dtype = float)
+    y = np.asarray(y, dtype = float)
+    return batched_lstsq(three_dim_design(x, y), np.broadcast_to(z, x.shape))
+
+def report(fit, vial_names = None):
+    """Prints the per-vial fit quality."""
+    for i, (rmse, r_squared, n) in enumerate(zip(fit['rmse'], fit['r_squared'], fit['points'])):
+        name = vial_names[i] if vial_names is not None else i
+        print('Vial {0}: RMSE {1:.4g}, R-squared {2:.4f} ({3} points)'.format(name, rmse, r_squared, n))
+
+#### SIGMOID ####
+SIGMOID_P0 = [62721, 62721, 0, -1]
+LN10 = np.log(10)
+
+def sigmoid(x, a, b, c, d):
+    # a + (b - a)/(1 + 10**((c-x)*d)), without overflow for large exponents
+    return a + (b - a) * expit(-(c - np.asarray(x, dtype = float)) * d * LN10)
+
+def sigmoid_jacobian(x, a, b, c, d):
+    """
+        Analytic derivatives of sigmoid with respect to a, b, c and d, using
+        s = 1 / (1 + 10**((c-x)*d)) computed without overflow.
+    """
+    x = np.asarray(x, dtype = float)
+    s = expit(-(c - x) * d * LN10)
+    slope = (b - a) * s * (1 - s) * LN10
+    return np.stack([1 - s, s, -slope * d, -slope * (c - x)], axis = -1)
+
+class FitTimeout(Exception):
+    pass
+
+def active_coefficients(calibration, fit_type, params):
+    """
+        Coefficients of the fit currently active on the eVOLVER for this
+        calibration, if it is of the same type and params, else None.
+    """
+    for fit in calibration.get('fits', None) or []:
+        if fit.get('active') and fit.get('type') == fit_type and list(fit.get('params', [])) == list(params):
+            return fit.get('coefficients')
+    return None
+
+def fit_sigmoid_vial(x, y, starts, budget, maxfev = 100000):
+    """
+        Fits one vial, trying each starting point in turn until one converges.
+        Gives up when budget seconds have passed, checked on every evaluation.
+
+        Returns (coefficients, status, message), status being 'ok', 'timeout'
+        or 'failed'.
+    """
+    x = np.asarray(x, dtype = float)
+    y = np.asarray(y, dtype = float)
+    valid = np.isfinite(x) & np.isfinite(y)
+    x, y = x[valid], y[valid]
+    if len(x) < 4:
+        return None, 'failed', 'only {0} points'.format(len(x))
+
+    deadline = time.time() + budget
+    def objective(x, *p):
+        if time.time() > deadline:
+            raise FitTimeout()
+        return sigmoid(x, *p)
+    def jacobian(x, *p):
+        if time.time() > deadline:
+            raise FitTimeout()
+        return sigmoid_jacobian(x, *p)
+
+    message = ''
+    for p0 in starts:
+        try:
+            coefficients, covariance = curve_fit(objective, x, y, p0 = p0, jac = jacobian, maxfev = maxfev)
+            if np.all(np.isfinite(coefficients)):
+                return coefficients.tolist(), 'ok', ''
+            message = 'non-finite coefficients'
+        except FitTimeout:
+            return None, 'timeout', 'no fit within {0} s'.format(budget)
+        except (RuntimeError, ValueError, np.linalg.LinAlgError) as e:
+            message = str(e)
+    return None, 'failed', message
+
+def fit_sigmoid(x, y, warm_start = None, budget = 10, workers = None):
+    """
+        Fits sigmoid(x) = y for every vial in parallel across a process pool.
+
+        x and y are (vials, points). warm_start is an optional per-vial list of
+        coefficients (the active fit) tried before the default SIGMOID_P0.
+        Each vial gets budget seconds; vials that do not converge in time are
+        reported instead of holding up the others. workers = 1, or a single
+        vial, fits in this process.
+
+        Returns a dict with per-vial 'coefficients' (None on failure), 'status',
+        'message' and 'rmse'.
+    """
+    x = np.asarray(x, dtype = float)
+    y = np.asarray(y, dtype = float)
+    vials = len(x)
+    starts = []
+    for i in range(vials):
+        vial_starts = [SIGMOID_P0]
+        if warm_start is not None and i < len(warm_start) and np.all(np.isfinite(warm_start[i])):
+            vial_starts.insert(0, list(warm_start[i]))
+        starts.append(vial_starts)
+
+    results = [(None, 'timeout', 'no fit within {0} s'.format(budget))] * vials
+    if workers == 1 or vials == 1:
+        results = [fit_sigmoid_vial(x[i], y[i], starts[i], budget) for i in range(vials)]
+    else:
+        workers = workers or os.cpu_count() or 1
+        # spawn, not fork: batch mode calls this from several threads at once
+        pool = concurrent.futures.ProcessPoolExecutor(max_workers = min(workers, vials) or 1,
+                                                      mp_context = multiprocessing.get_context('spawn'))
+        futures = [pool.submit(fit_sigmoid_vial, x[i], y[i], starts[i], budget) for i in range(vials)]
+        # Vials are fitted in rounds of `workers`; allow for process start up on top
+        deadline = time.time() + budget * -(-vials // workers) + 10
+        for i, future in enumerate(futures):
+            try:
+                results[i] = future.result(timeout = max(deadline - time.time(), 0))
+            except concurrent.futures.TimeoutError:
+                future.cancel()
+            except Exception as e:
+                results[i] = (None, 'failed', str(e))
+        pool.shutdown(wait = False)
+
+    coefficients = [result[0] for result in results]
+    rmse = np.full(vials, np.nan)
+    for i, c in enumerate(coefficients):
+        if c is not None:
+            valid = np.isfinite(x[i]) & np.isfinite(y[i])
+            rmse[i] = np.sqrt(np.mean((sigmoid(x[i][valid], *c) - y[i][valid]) ** 2))
+    return {'coefficients': coefficients,
+            'status': [result[1] for result in results],
+            'message': [result[2] for result in results],
+            'rmse': rmse}
+
+#### FIT CACHE ####
+# Bump whenever a change to the fitting code changes its results, to invalidate cached fits
+FIT_CODE_VERSION = 1
+
+class FitCache:
+    """
+        Per-vial fit results stored in a JSON file, keyed by a hash of the
+        vial's processed calibration points, the fit type, the params and
+        FIT_CODE_VERSION. Identical data is never fitted twice.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.fits = {}
+        self._lock = threading.Lock()
+        try:
+            with open(path) as f:
+                cached = json.load(f)
+            if cached.get('version') == FIT_CODE_VERSION:
+                self.fits = cached.get('fits', {})
+        except (OSError, ValueError, AttributeError):
+            pass
+
+    @staticmethod
+    def key(fit_type, params, arrays):
+        digest = hashlib.sha256(json.dumps([FIT_CODE_VERSION, fit_type, list(params)]).encode())
+        for array in arrays:
+            array = np.ascontiguousarray(array, dtype = float)
+            digest.update(str(array.shape).encode())
+            digest.update(array.tobytes())
+        return digest.hexdigest()
+
+    def get(self, key):
+        with self._lock:
+            return self.fits.get(key)
+
+    def set(self, key, result):
+        with self._lock:
+            self.fits[key] = result
+
+    def save(self):
+        with self._lock:
+            temporary = self.path + '.tmp'
+            with open(temporary, 'w') as f:
+                json.dump({'version': FIT_CODE_VERSION, 'fits': self.fits}, f, allow_nan = False)
+            os.replace(temporary, self.path)
+
+def fit_with_cache(cache, fit_type, params, arrays, fit):
+    """
+        Fits only the vials whose data is not in the cache.
+
+        arrays are the (vials, ...) inputs of the fit, fit(vials) fits the given
+        vial indices and returns one dict per vial with its 'coefficients' and
+        quality measures. Successful results are cached. Returns the dicts of
+        all vials, cached and new.
+    """
+    vials = len(arrays[0])
+    if cache is None:
+        return fit(list(range(vials)))
+    keys = [cache.key(fit_type, params, [array[v] for array in arrays]) for v in range(vials)]
+    results = [cache.get(key) for key in keys]
+    todo = [v for v in range(vials) if results[v] is None]
+    if todo:
+        for v, result in zip(todo, fit(todo)):
+            results[v] = result
+            if result.get('status', 'ok') == 'ok' and np.all(np.isfinite(result['coefficients'])):
+                cache.set(keys[v], result)
+    print('Fitted {0} vials, {1} unchanged vials from the cache'.format(len(todo), vials - len(todo)))
+    return results
+
+def per_vial(fit, vials):
+    """Splits a dict of per-vial arrays/lists into one plain dict per vial."""
+    results = []
+    for i in range(len(vials)):
+        result = {}
+        for name, values in fit.items():
+            value = values[i]
+            result[name] = value.tolist() if isinstance(value, (np.ndarray, np.generic)) else value
+        results.append(result)
+    return results
@@ -4,13 +4,13 @@ import numpy as np
 import logging
 import os.path
 import time
-import pandas as pd
 import traceback
 
 import utils.step_utils as su
 import utils.file_utils as fu
 import utils.config_utils as cu
 import step_control
+from utils.storage import get_storage
 
 # logger setup
 logger = logging.getLogger(__name__)
@@ -94,46 +94,42 @@ def turbidostat(eVOLVER, input_data, vials, elapsed_time):
 
     # fluidic message: initialized so that no change is sent
     MESSAGE = ['--'] * 48
+    storage = get_storage(eVOLVER.exp_dir)
     for x in turbidostat_vials: #main loop through each vial
         # Update turbidostat configuration files for each vial
         # initialize OD and find OD path
 
-        file_name =  "vial{0}_ODset.txt".format(x)
-        ODset_path = os.path.join(eVOLVER.exp_dir, 'ODset', file_name)
-        data = np.genfromtxt(ODset_path, delimiter=',')
+        data = storage.read_range('ODset', x)
         ODset = data[len(data)-1][1]
         ODsettime = data[len(data)-1][0]
         num_curves=len(data)/2;
 
-        file_name =  "vial{0}_OD.txt".format(x)
-        OD_path = os.path.join(eVOLVER.exp_dir, 'OD', file_name)
-        data = eVOLVER.tail_to_np(OD_path, OD_values_to_average)
+        data = fu.get_last_n_lines('OD', x, OD_values_to_average, eVOLVER.exp_dir)
         average_OD = 0
 
         # Determine whether turbidostat dilutions are needed
         #enough_ODdata = (len(data) > 7) #logical, checks to see if enough data points (couple minutes) for sliding window
         collecting_more_curves = (num_curves <= (stop_after_n_curves + 2)) #logical, checks to see if enough growth curves have happened
 
-        if data.size != 0:
+        if data.size != 0 and data.dtype.kind == 'f': # not numeric while the header is within the window
             # Take median to avoid outlier
             od_values_from_file = data[:,1]
             average_OD = float(np.median(od_values_from_file))
 
             #if recently exceeded upper threshold, note end of growth curve in ODset, allow dilutions to occur and growthrate to be measured
             if (average_OD > upper_thresh[x]) and (ODset != lower_thresh[x]):
-                text_file = open(ODset_path, "a+")
-                text_file.write("{0},{1}\n".format(elapsed_time,
-                                                   lower_thresh[x]))
-                text_file.close()
+                storage.append('ODset', x, elapsed_time, lower_thresh[x])
+                fu.update_dilution_summary(x, elapsed_time, eVOLVER.exp_dir, odset_change=True)
+                eVOLVER.publish('odset', elapsed_time, vial=x, value=lower_thresh[x])
                 ODset = lower_thresh[x]
                 # calculate growth rate
                 eVOLVER.calc_growth_rate(x, ODsettime, elapsed_time)
 
             #if have approx. reached lower threshold, note start of growth curve in ODset
             if (average_OD < (lower_thresh[x] + (upper_thresh[x] - lower_thresh[x]) / 3)) and (ODset != upper_thresh[x]):
-                text_file = open(ODset_path, "a+")
-                text_file.write("{0},{1}\n".format(elapsed_time, upper_thresh[x]))
-                text_file.close()
+                storage.append('ODset', x, elapsed_time, upper_thresh[x])
+                fu.update_dilution_summary(x, elapsed_time, eVOLVER.exp_dir, odset_change=True)
+                eVOLVER.publish('odset', elapsed_time, vial=x, value=upper_thresh[x])
                 ODset = upper_thresh[x]
 
             #if need to dilute to lower threshold, then calculate amount of time to pump
@@ -146,11 +142,7 @@ def turbidostat(eVOLVER, input_data, vials, elapsed_time):
 
                 time_in = round(time_in, 2)
 
-                file_name =  "vial{0}_pump_log.txt".format(x)
-                file_path = os.path.join(eVOLVER.exp_dir,
-                                         'pump_log', file_name)
-                data = np.genfromtxt(file_path, delimiter=',')
-                last_pump = data[len(data)-1][0]
+                last_pump = storage.read_tail('pump_log', x, 1)[0][0]
                 if (((elapsed_time - last_pump)*60) >= pump_wait): # if sufficient time since last pump, send command to Arduino
                     if not np.isnan(time_in):
                         logger.info('turbidostat dilution for vial %d' % x)
@@ -159,12 +151,10 @@ def turbidostat(eVOLVER, input_data, vials, elapsed_time):
                         # efflux pump
                         MESSAGE[x + 16] = str(round(time_in + time_out, 2))
 
-                        file_name =  "vial{0}_pump_log.txt".format(x)
-                        file_path = os.path.join(eVOLVER.exp_dir, 'pump_log', file_name)
-
-                        text_file = open(file_path, "a+")
-                        text_file.write("{0},{1}\n".format(elapsed_time, time_in))
-                        text_file.close()
+                        storage.append('pump_log', x, elapsed_time, time_in)
+                        fu.update_dilution_summary(x, elapsed_time, eVOLVER.exp_dir, flow_rate,
+                                                   influx_s=time_in, efflux_s=round(time_in + time_out, 2))
+                        eVOLVER.publish('pump', elapsed_time, vial=x, influx_s=time_in, efflux_s=round(time_in + time_out, 2))
                     else:
                         print(f'Vial {x}: time_in is NaN, cancelling turbidostat dilution')
                         logger.warning(f'Vial {x}: time_in is NaN, cancelling turbidostat dilution')
@@ -1,26 +1,37 @@
 #!/usr/bin/env python3
 
+import time
+from utils.startup import StartupReport
+STARTUP = StartupReport() # started before the imports below, to time them
+
 import os
 import sys
-import time
 import pickle
 import shutil
 import logging
 import argparse
 import numpy as np
-import pandas as pd
 import json
 import traceback
-from scipy import stats
+STARTUP.mark('import numpy')
 from socketIO_client import SocketIO, BaseNamespace
-from nbstreamreader import NonBlockingStreamReader as NBSR
+STARTUP.mark('import socketIO_client')
 
 import custom_script
 from custom_script import EXP_NAME
 from custom_script import EVOLVER_PORT, OPERATION_MODE
 from custom_script import STIR_INITIAL, TEMP_INITIAL, EXCEL_CONFIG_FILE
 import utils.config_utils as cu
+import utils.file_utils as fu
+import utils.data_bus as data_bus
+import utils.od_lookup as od_lookup
 import utils.step_init as step_init 
+import utils.analytics as an
+import utils.runtime as runtime
+import utils.broadcast_lag as broadcast_lag
+from utils.storage import get_storage
+from utils.clock import WallClock
+STARTUP.mark('import custom_script and utils')
 
 # Should not be changed
 # vials to be considered/excluded should be handled
@@ -40,8 +51,6 @@ THREE_DIMENSION = '3d'
 
 logger = logging.getLogger('eVOLVER')
 
-paused = False
-
 EVOLVER_NS = None
 
 class EvolverNamespace(BaseNamespace):
@@ -51,6 +60,11 @@ class EvolverNamespace(BaseNamespace):
     experiment_params = None
     ip_address = None
     exp_dir = EXP_DIR
+    data_bus = None
+    clock = WallClock() # a VirtualClock runs the experiment in accelerated time
+    config_watcher = None
+    broadcast_lag = None
+    last_elapsed_time = None
 
     def on_connect(self, *args):
         print("Connected to eVOLVER as client")
@@ -65,8 +79,23 @@ class EvolverNamespace(BaseNamespace):
         logger.info("reconnected to eVOLVER as client")
 
     def on_broadcast(self, data):
+        # timestamp the broadcast first, to tell how long it waited
+        queue_lag = self.broadcast_lag.arrived(data)
+        try:
+            self.process_broadcast(data, queue_lag)
+        finally:
+            self.broadcast_lag.processed()
+            self.export_lag_metrics()
+
+    def process_broadcast(self, data, queue_lag):
+        STARTUP.mark('wait for the first broadcast')
         logger.info('Broadcast received')
-        elapsed_time = round((time.time() - self.start_time) / 3600, 4)
+        # readings are stored at the time they were measured, not handled, but
+        # never before the last readings: the series must not go back in time
+        elapsed_time = self.clock.elapsed_hours(self.start_time, at=self.clock.time() - queue_lag)
+        if self.last_elapsed_time is not None:
+            elapsed_time = max(elapsed_time, self.last_elapsed_time)
+        self.last_elapsed_time = elapsed_time
         logger.info('Elapsed time: %.4f hours' % elapsed_time)
         print("{0}: {1} Hours".format(EXP_NAME, elapsed_time))
         # are the calibrations in yet?
@@ -113,10 +142,28 @@ class EvolverNamespace(BaseNamespace):
             logger.info("Broadcast received before experiment initialization - skipping custom function...")
             return
 
-        # run custom functions
-        self.custom_functions(data, VIALS, elapsed_time)
+        # push the new readings to live subscribers (dashboard etc.)
+        self.publish('od', elapsed_time, values=data['transformed']['od'])
+        self.publish('temp', elapsed_time, values=data['transformed']['temp'])
+
+        if self.broadcast_lag.skip_control:
+            # a newer broadcast is already waiting: leave the control to it
+            logger.warning('broadcast waited %.1f s, stored its data without '
+                           'running custom functions' % queue_lag)
+        else:
+            # apply config edits made since the last broadcast
+            if self.config_watcher is not None:
+                self.config_watcher.check(elapsed_time)
+
+            # run custom functions
+            self.custom_functions(data, VIALS, elapsed_time)
         # save variables
         self.save_variables(self.start_time, self.OD_initial)
+        if not STARTUP.finished:
+            STARTUP.finish('process the first broadcast')
+            logger.info(STARTUP.report())
+            if STARTUP.verbose:
+                print(STARTUP.report(), flush = True)
 
         # Restart logging for db/gdrive syncing
         logging.shutdown()
@@ -140,13 +187,12 @@ class EvolverNamespace(BaseNamespace):
                         json.dump(fit, f)
                     # Create raw data directories and files for params needed
                     for param in fit['params']:
-                        if not os.path.isdir(os.path.join(EXP_DIR, param + '_raw')) and param != 'pump':
-                            os.makedirs(os.path.join(EXP_DIR, param + '_raw'))
+                        if not get_storage(EXP_DIR).exists(param + '_raw') and param != 'pump':
                             for x in range(len(fit['coefficients'])):
                                 exp_str = "Experiment: {0} vial {1}, {2}".format(EXP_NAME,
                                         x,
                                         time.strftime("%c"))
-                                self._create_file(x, param + '_raw', defaults=[exp_str])
+                                self._create_file(x, param + '_raw', header=[exp_str])
                     break
 
     def request_calibrations(self):
@@ -178,43 +224,28 @@ class EvolverNamespace(BaseNamespace):
         temp_data = np.array([float(x) for x in temp_data])
         set_temp_data = np.array([float(x) for x in set_temp_data])
 
+        # convert raw photodiode data into OD data for all vials at once,
+        # using lookup tables compiled from the calibration curve
+        od_values = None
+        lookup = od_lookup.get_lookup(od_cal)
+        if lookup is not None:
+            od_values = lookup.transform(od_data, od_data_2)
+
         temps = []
         for x in vials:
-            file_name =  "vial{0}_temp_config.txt".format(x)
-            file_path = os.path.join(EXP_DIR, 'temp_config', file_name)
-            temp_set_data = np.genfromtxt(file_path, delimiter=',')
-            temp_set = temp_set_data[len(temp_set_data)-1][1]
+            temp_set = get_storage(EXP_DIR).read_tail('temp_config', x, 1)[0][1]
             temps.append(temp_set)
-            od_coefficients = od_cal['coefficients'][x]
             temp_coefficients = temp_cal['coefficients'][x]
-            try:
-                if od_cal['type'] == SIGMOID:
-                    #convert raw photodiode data into ODdata using calibration curve
-                    od_data[x] = np.real(od_coefficients[2] -
-                                        ((np.log10((od_coefficients[1] -
-                                                    od_coefficients[0]) /
-                                                    (float(od_data[x]) -
-                                                    od_coefficients[0])-1)) /
-                                                    od_coefficients[3]))
-                    if not np.isfinite(od_data[x]):
-                        od_data[x] = 'NaN'
-                        logger.debug('OD from vial %d: %s' % (x, od_data[x]))
-                    else:
-                        logger.debug('OD from vial %d: %.3f' % (x, od_data[x]))
-                elif od_cal['type'] == THREE_DIMENSION:
-                    od_data[x] = np.real(od_coefficients[0] +
-                                        (od_coefficients[1]*od_data[x]) +
-                                        (od_coefficients[2]*od_data_2[x]) +
-                                        (od_coefficients[3]*(od_data[x]**2)) +
-                                        (od_coefficients[4]*od_data[x]*od_data_2[x]) +
-                                        (od_coefficients[5]*(od_data_2[x]**2)))
-                else:
-                    logger.error('OD calibration not of supported type!')
-                    od_data[x] = 'NaN'
-            except ValueError:
-                print("OD Read Error")
-                logger.error('OD read error for vial %d, setting to NaN' % x)
+            if od_values is None:
+                logger.error('OD calibration not of supported type!')
                 od_data[x] = 'NaN'
+            else:
+                # out of range readings are NaN, as with the analytic calibration
+                od_data[x] = od_values[x]
+                if not np.isfinite(od_data[x]):
+                    logger.debug('OD from vial %d: %s' % (x, od_data[x]))
+                else:
+                    logger.debug('OD from vial %d: %.3f' % (x, od_data[x]))
             try:
                 temp_data[x] = (float(temp_data[x]) *
                                 temp_coefficients[0]) + temp_coefficients[1]
@@ -317,17 +348,9 @@ class EvolverNamespace(BaseNamespace):
         logger.info('stopping all pumps')
         self.emit('command', data, namespace = '/dpu-evolver')
 
-    def _create_file(self, vial, param, directory=None, defaults=None):
-        if defaults is None:
-            defaults = []
-        if directory is None:
-            directory = param
-        file_name =  "vial{0}_{1}.txt".format(vial, param)
-        file_path = os.path.join(EXP_DIR, directory, file_name)
-        text_file = open(file_path, "w")
-        for default in defaults:
-            text_file.write(default + '\n')
-        text_file.close()
+    def _create_file(self, vial, param, header=None, defaults=None):
+        # the directory is given by the series name (see utils.storage)
+        get_storage(EXP_DIR).create_series(param, vial, header=header or [], records=defaults or [])
                 
     def initialize_exp(self, vials, experiment_params, log_name, quiet, verbose, ip_address, always_yes = False):
         self.ip_address = ip_address
@@ -365,20 +388,13 @@ class EvolverNamespace(BaseNamespace):
                     logger.warning('not deleting existing data directory, exiting')
                     sys.exit(1)
 
-            start_time = time.time()
+            start_time = self.clock.time()
 
             self.request_calibrations()
+            STARTUP.mark('request calibrations')
 
             logger.debug('creating data directories')
-            os.makedirs(os.path.join(EXP_DIR, 'OD'))
-            os.makedirs(os.path.join(EXP_DIR, 'temp'))
-            os.makedirs(os.path.join(EXP_DIR, 'temp_config'))
-            os.makedirs(os.path.join(EXP_DIR, 'pump_log'))
-            os.makedirs(os.path.join(EXP_DIR, 'slow_pump_log'))
-            os.makedirs(os.path.join(EXP_DIR, 'ODset'))
-            os.makedirs(os.path.join(EXP_DIR, 'growthrate'))
-            os.makedirs(os.path.join(EXP_DIR, 'chemo_config'))
-            os.makedirs(os.path.join(EXP_DIR, 'step_log')) # for stepwise evolution logging
+            os.makedirs(EXP_DIR, exist_ok=True) # series directories are created with their files
   
             setup_logging(log_name, quiet, verbose)
             for x in vials:
@@ -386,40 +402,35 @@ class EvolverNamespace(BaseNamespace):
                                                                  x,
                                                            time.strftime("%c"))
                 # make OD file
-                self._create_file(x, 'OD', defaults=[exp_str])
+                self._create_file(x, 'OD', header=[exp_str])
                 # make temperature data file
                 self._create_file(x, 'temp')
                 # make temperature configuration file
-                self._create_file(x, 'temp_config',
-                                  defaults=[exp_str,
-                                            "0,{0}".format(TEMP_INITIAL[x])])
+                self._create_file(x, 'temp_config', header=[exp_str],
+                                  defaults=["0,{0}".format(TEMP_INITIAL[x])])
                 # make pump log file
-                self._create_file(x, 'pump_log',
-                                  defaults=[exp_str,
-                                            "0,0"])
-                self._create_file(x, 'slow_pump_log',
-                                  defaults=[exp_str,
-                                            "0,0"])
+                self._create_file(x, 'pump_log', header=[exp_str],
+                                  defaults=["0,0"])
+                self._create_file(x, 'slow_pump_log', header=[exp_str],
+                                  defaults=["0,0"])
                 # make ODset file
-                self._create_file(x, 'ODset',
-                                  defaults=[exp_str,
-                                            "0,0"])
+                self._create_file(x, 'ODset', header=[exp_str],
+                                  defaults=["0,0"])
                 # make growth rate file
-                self._create_file(x, 'gr',
-                                  defaults=[exp_str,
-                                            "0,0"],
-                                  directory='growthrate')
+                self._create_file(x, 'gr', header=[exp_str],
+                                  defaults=["0,0"])
                 # make chemostat file
                 self._create_file(x, 'chemo_config',
                                   defaults=["0,0,0",
-                                            "0,0,0"],
-                                  directory='chemo_config')
+                                            "0,0,0"])
                 # make stepwise evolution data logging file
                 self._create_file(x, 'step_log',
-                                  defaults=[exp_str,
-                                            "elapsed_time,step_change_time,current_step,chemical_concentration,event_message",
-                                            "0,0,0,0,0"],
-                                  directory='step_log')
+                                  header=[exp_str,
+                                          "elapsed_time,step_change_time,current_step,chemical_concentration,event_message"],
+                                  defaults=["0,0,0,0,0"])
+
+            fu.create_dilution_summary(vials, EXP_DIR)
+            STARTUP.mark('create experiment files')
 
             stir_rate = STIR_INITIAL
             temp_values = TEMP_INITIAL
@@ -450,13 +461,21 @@ class EvolverNamespace(BaseNamespace):
             x = loaded_var
             start_time = x[0]
             self.OD_initial = x[1]
+            STARTUP.mark('load previous experiment')
 
-        elapsed_time = round((time.time() - start_time) / 3600, 4)
+        elapsed_time = self.clock.elapsed_hours(start_time)
         
+        self.broadcast_lag = broadcast_lag.BroadcastLag(self.clock)
+
         # Selection initialization
+        self.config_watcher = step_init.ConfigWatcher(EXCEL_CONFIG_FILE, vials, logger, self)
         excel_configs = cu.load_excel_configs(EXCEL_CONFIG_FILE)
-        step_init.update_selection_configs(elapsed_time, vials, excel_configs, logger, self)
-        step_init.plot_steps(vials, 'selection-steps', 'Selection', self.exp_dir) # plot selection steps for each vial TODO only plot steps if there was an update?
+        STARTUP.mark('read Excel configs')
+        updated_vials = step_init.update_selection_configs(elapsed_time, vials, excel_configs, logger, self)
+        STARTUP.mark('update selection configs')
+        # plot selection steps of all vials if any changed, in the background
+        step_init.plot_steps(vials, 'selection-steps', 'Selection', self.exp_dir, updated_vials)
+        STARTUP.mark('start plotting selection steps')
 
         # copy current custom script to txt file
         backup_filename = '{0}_{1}.txt'.format(EXP_NAME,
@@ -480,12 +499,24 @@ class EvolverNamespace(BaseNamespace):
     def save_data(self, data, elapsed_time, vials, parameter):
         if len(data) == 0:
             return
+        storage = get_storage(EXP_DIR)
         for x in vials:
-            file_name =  "vial{0}_{1}.txt".format(x, parameter)
-            file_path = os.path.join(EXP_DIR, parameter, file_name)
-            text_file = open(file_path, "a+")
-            text_file.write("{0},{1}\n".format(elapsed_time, data[x]))
-            text_file.close()
+            storage.append(parameter, x, elapsed_time, data[x])
+
+    def publish(self, topic, elapsed_time, **payload):
+        # never blocks: messages are queued per subscriber
+        if self.data_bus is not None:
+            self.data_bus.publish(topic, elapsed_time, **payload)
+
+    def export_lag_metrics(self):
+        # for the dashboard and for after the experiment
+        metrics = self.broadcast_lag.metrics()
+        logger.debug('broadcast lag: %s' % metrics)
+        self.publish('lag', self.clock.elapsed_hours(self.start_time), **metrics)
+        try:
+            get_storage(EXP_DIR).write_json(broadcast_lag.LAG_FILE, metrics)
+        except OSError:
+            pass
 
     def save_variables(self, start_time, OD_initial):
         # save variables needed for restarting experiment later
@@ -503,10 +534,9 @@ class EvolverNamespace(BaseNamespace):
         return pump_cal['coefficients']
 
     def calc_growth_rate(self, vial, gr_start, elapsed_time):
-        ODfile_name =  "vial{0}_OD.txt".format(vial)
         # Grab Data and make setpoint
-        OD_path = os.path.join(EXP_DIR, 'OD', ODfile_name)
-        OD_data = np.genfromtxt(OD_path, delimiter=',')
+        storage = get_storage(EXP_DIR)
+        OD_data = storage.read_range('OD', vial)
         raw_time = OD_data[:, 0]
         raw_OD = OD_data[:, 1]
         raw_time = raw_time[np.isfinite(raw_OD)]
@@ -518,17 +548,13 @@ class EvolverNamespace(BaseNamespace):
 
         # Take natural log, calculate slope
         log_OD = np.log(trim_OD)
-        slope, intercept, r_value, p_value, std_err = stats.linregress(
-            trim_time[np.isfinite(log_OD)],
-            log_OD[np.isfinite(log_OD)])
+        slope = an.regression_slope(trim_time[np.isfinite(log_OD)],
+                                    log_OD[np.isfinite(log_OD)])
         logger.debug('growth rate for vial %s: %.2f' % (vial, slope))
 
         # Save slope to file
-        file_name =  "vial{0}_gr.txt".format(vial)
-        gr_path = os.path.join(EXP_DIR, 'growthrate', file_name)
-        text_file = open(gr_path, "a+")
-        text_file.write("{0},{1}\n".format(elapsed_time, slope))
-        text_file.close()
+        storage.append('gr', vial, elapsed_time, slope)
+        self.publish('gr', elapsed_time, vial=vial, value=slope)
 
     def custom_functions(self, data, vials, elapsed_time):
         # load user script from custom_script.py
@@ -586,6 +612,16 @@ def get_options():
     parser.add_argument('-i', '--ip-address', action='store', dest='ip_address',
                         help='IP address of eVOLVER to run experiment on.')
 
+    parser.add_argument('-m', '--max-lag', type=float,
+                        default=broadcast_lag.MAX_LAG,
+                        help='Seconds a broadcast may wait before the '
+                             'connection to the eVOLVER is reset to clear the '
+                             'backlog (default: %(default)s)')
+    parser.add_argument('-t', '--startup-report', action='store_true',
+                        default=False,
+                        help='Print how long each startup phase took, up to '
+                             'the first processed broadcast (always logged)')
+
     log_nolog = parser.add_mutually_exclusive_group()
     log_nolog.add_argument('-v', '--verbose', action='count',
                            default=0,
@@ -598,6 +634,7 @@ def get_options():
 
 if __name__ == '__main__':
     options, parser = get_options()
+    STARTUP.verbose = options.startup_report
 
 
     #changes terminal tab title in OSX
@@ -615,6 +652,7 @@ if __name__ == '__main__':
 
     socketIO = SocketIO(evolver_ip, EVOLVER_PORT)
     EVOLVER_NS = socketIO.define(EvolverNamespace, '/dpu-evolver')
+    STARTUP.mark('connect to eVOLVER')
 
     # start by stopping any existing chemostat
     EVOLVER_NS.stop_all_pumps()
@@ -628,81 +666,29 @@ if __name__ == '__main__':
                                                       options.always_yes
                                                       )
 
-    # Using a non-blocking stream reader to be able to listen
-    # for commands from the electron app. 
-    nbsr = NBSR(sys.stdin)
-    paused = False
-
-    # logging setup
-
-    reset_connection_timer = time.time()
-    while True:        
-        try:
-            # infinite loop
-
-            # check if a message has come in from the DPU
-            message = nbsr.readline()
-            if 'stop-script' in message:
-                logger.info('Stop message received - halting all pumps');
-                EVOLVER_NS.stop_exp()
-                socketIO.disconnect()
-            if 'pause-script' in message:
-                print('Pausing experiment', flush = True)
-                logger.info('Pausing experiment in dpu')
-                paused = True
-                EVOLVER_NS.stop_exp()
-                socketIO.disconnect()
-                
-            if 'continue-script' in message:
-                print('Restarting experiment', flush = True)
-                logger.info('Restarting experiment')
-                paused = False
-                socketIO.connect()
-
-            if not paused:
-                    socketIO.wait(seconds=0.1)
-                    if time.time() - reset_connection_timer > 3600 and not paused:
-                        # reset connection to avoid buildup of broadcast
-                        # messages (unlikely but could happen for very long
-                        # experiments with slow dpu code/computer)
-                        logger.info('resetting connection to eVOLVER to avoid '
-                                    'potential buildup of broadcast messages')
-                        socketIO.disconnect()
-                        socketIO.connect()
-                        reset_connection_timer = time.time()
-        except KeyboardInterrupt:
-            try:
-                print('Ctrl-C detected, pausing experiment')
-                logger.warning('interrupt received, pausing experiment')
-                EVOLVER_NS.stop_exp()
-                # stop receiving broadcasts
-                socketIO.disconnect()
-                while True:
-                    key = input('Experiment paused. Press enter key to restart '
-                                ' or hit Ctrl-C again to terminate experiment')
-                    logger.warning('resuming experiment')
-                    # no need to have something like "restart_chemo" here
-                    # with the new server logic
-                    socketIO.connect()
-                    break
-            except KeyboardInterrupt:
-                print('Second Ctrl-C detected, shutting down')
-                logger.warning('second interrupt received, terminating '
-                                'experiment')
-                EVOLVER_NS.stop_exp()
-                print('Experiment stopped, goodbye!')
-                logger.warning('experiment stopped, goodbye!')
-                break
-        except Exception as e:
-            logger.critical('exception %s stopped the experiment' % str(e))
-            print('error "%s" stopped the experiment' % str(e))
-            traceback.print_exc(file=sys.stdout)
-            EVOLVER_NS.stop_exp()
-            print('Experiment stopped, goodbye!')
-            logger.warning('experiment stopped, goodbye!')
-            break
+    # publish live data for the dashboard and other local consumers
+    try:
+        EVOLVER_NS.data_bus = data_bus.DataBus(EXP_DIR)
+        EVOLVER_NS.data_bus.start()
+    except OSError as e:
+        logger.warning('could not start the live data bus: %s' % e)
+        EVOLVER_NS.data_bus = None
+    STARTUP.mark('start live data bus')
+
+    # Socket events, commands from the electron app on stdin, reconnects when
+    # broadcasts back up and Ctrl-C are all handled by one event loop
+    EVOLVER_NS.broadcast_lag.max_lag = options.max_lag
+    error = runtime.ExperimentRuntime(socketIO, EVOLVER_NS).run()
+    if error is not None:
+        logger.critical('exception %s stopped the experiment' % str(error))
+        print('error "%s" stopped the experiment' % str(error))
+        traceback.print_exception(type(error), error, error.__traceback__, file=sys.stdout)
+    print('Experiment stopped, goodbye!')
+    logger.warning('experiment stopped, goodbye!')
 
     # stop experiment one last time
     # covers corner case where user presses Ctrl-C twice quickly
     socketIO.connect()
     EVOLVER_NS.stop_exp()
+    if EVOLVER_NS.data_bus is not None:
+        EVOLVER_NS.data_bus.close()
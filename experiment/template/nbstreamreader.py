@@ -1,38 +0,0 @@
-from threading import Thread
-from collections import deque
-
-class NonBlockingStreamReader:
-
-    def __init__(self, stream):
-        '''
-        stream: the stream to read from.
-                Usually a process' stdout or stderr.
-        '''
-
-        self._s = stream
-        self._q = deque()
-
-        def _populateQueue(stream, queue):
-            '''
-            Collect lines from 'stream' and put them in 'quque'.
-            '''
-
-            while True:
-                line = stream.readline()
-                if line:
-                    queue.append(line)
-                else:
-                    raise UnexpectedEndOfStream
-
-        self._t = Thread(target = _populateQueue,
-                args = (self._s, self._q))
-        self._t.daemon = True
-        self._t.start() #start collecting lines from the stream
-
-    def readline(self):
-        if len(self._q) > 0:
-            return self._q.popleft()
-        else:
-            return '' 
-
-class UnexpectedEndOfStream(Exception): pass
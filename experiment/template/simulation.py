@@ -0,0 +1,323 @@
+#!/usr/bin/env python3
+
+import os
+import time
+import json
+import shutil
+import logging
+import numpy as np
+
+import custom_script
+from custom_script import VOLUME, EXCEL_CONFIG_FILE
+import utils.config_utils as cu
+import utils.step_init as step_init
+import utils.file_utils as fu
+import utils.storage as storage
+import utils.analytics as an
+
+SAVE_PATH = os.getcwd()
+EXP_NAME = 'simulation'
+EXP_DIR = os.path.join(SAVE_PATH, EXP_NAME)
+PUMP_CAL_PATH = os.path.join(SAVE_PATH, 'pump_cal.json')
+
+SIGMOID = 'sigmoid'
+LINEAR = 'linear'
+EXPONENTIAL = 'exponential'
+
+class EvolverSimulation:
+    """
+    Simulated eVOLVER for testing selection strategies without hardware.
+
+    Growth, dilution, selection delay and adaptation are computed as arrays over all vials
+    at each time step. Control decisions go through the real custom_script functions and
+    SteppedController. With experiment_params['storage'] = 'memory' all experiment data is
+    kept in RAM (utils.storage.MemoryStorage); the default 'file' writes the usual experiment
+    directory.
+    """
+    def __init__(self, experiment_params):
+        self.exp_dir = experiment_params.get('exp_dir', EXP_DIR)
+        self.custom_function = experiment_params['custom_function']
+        self.vials = list(experiment_params['vials']) # vial numbers
+        self.log_name = experiment_params['log_name']
+        self.logger = logging.getLogger('eVOLVER')
+        self.rng = np.random.default_rng(experiment_params.get('seed'))
+
+        # Time variables
+        self.duration = experiment_params['duration'] # hours; duration of the experiment
+        self.start_time = 0 # hours
+        self.elapsed_time = 0 # hours
+        self.time_interval = experiment_params['time_interval'] # hours; time of each iteration
+
+        # Biological variables, indexed by vial number
+        self.ODs = np.array(experiment_params['initial_ODs'], dtype=float) # optical density
+        self.max_OD = experiment_params['max_OD']
+        self.growth_rates = np.array(experiment_params['initial_grs'], dtype=float) # growth rate without selection
+        self.active = np.zeros(len(self.ODs), dtype=bool) # vials being simulated
+        self.active[self.vials] = True
+
+        # Selection variables
+        self.selection_growth_rates = self.growth_rates.copy() # growth rate under selection
+        self.selection_growth_rates_log = {vial: [] for vial in self.vials} # [time, growth rate] at every change
+        self.selection_harshness = np.array(experiment_params['initial_selection_harshness'], dtype=float) # 1 for normal growth; multiplier for growth rate
+        self.selection_delay = np.array(experiment_params['selection_delay'], dtype=float) # hours; delay after an increase in selection that growth rate is updated
+        self.selection_function = experiment_params['selection_function'] # TODO implement | translates selection units into selection pressure
+        self.selection_params = experiment_params['selection_params'] # TODO implement
+        self.adaptation_function = experiment_params['adaptation_function'] # how the organism adapts to selection; linear or sigmoid
+        self.adaptation_params = experiment_params['adaptation_params'] # [linear_slope, linear_intercept] or [sigmoid a, b, c]
+        self.last_increase_time = np.full(len(self.ODs), np.nan) # step change time of the last logged selection increase
+        self.selection_increase_time = np.full(len(self.ODs), -np.inf) # last increase already applied to the growth rate
+
+        # Fluidics variables
+        self.min_fast = 0.5 # ml; minimum bolus to pump using fast pumps
+        self.min_slow = 0.1 # ml; minimum bolus to pump using slow pumps
+        self.volume = experiment_params['vial_volume'] # mL
+        self.flow_rate = experiment_params.get('flow_rate')
+        self.media_ml = np.zeros(len(self.ODs)) # mL of media pumped per vial
+        self.selection_ml = np.zeros(len(self.ODs)) # mL of selection chemical pumped per vial
+        self.excel_configs = experiment_params.get('excel_configs')
+        self.excel_config_file = experiment_params.get('excel_config_file', EXCEL_CONFIG_FILE)
+        self.plot_steps = experiment_params.get('plot_steps', True)
+        self.storage_type = experiment_params.get('storage', 'file')
+        self.storage = None
+
+        # eVOLVER adaptation variables - for making this script work with actual eVOLVER code
+        self.experiment_params = None
+        self.data_bus = None
+
+        # OD history, one row per save: [elapsed time, OD of every vial]
+        self._od_history = np.empty((1024, len(self.ODs) + 1))
+        self._od_count = 0
+
+        # Simulation variables
+        self.working_time = 0
+
+    def run_simulation(self, quiet=False, verbose=0):
+        """Run the simulation."""
+        start_time = time.time()
+        print('Running simulation...')
+
+        self.initialize_exp(self.vials, self.log_name, quiet, verbose)
+        print(f'Experiment initialized. Initialization time: {time.time()-start_time:.2f} seconds')
+
+        while self.elapsed_time < self.duration:
+            self.simulate_step()
+        logging.shutdown()
+        print(f'Simulation complete. Iteration time: {self.working_time:.2f} seconds')
+
+    def simulate_step(self):
+        """Simulate one time step for all vials."""
+        start_time = time.time()
+        self.grow() # Grow the cells one step in all vials.
+        self.custom_functions({'transformed': {'od': self.ODs}}, self.vials, self.elapsed_time)
+        self.simulate_selection()
+        self.elapsed_time += self.time_interval
+        self.working_time += time.time() - start_time
+
+    #### BIOLOGY ####
+    def grow(self):
+        """Grow the cells one step in all vials; vials at carrying capacity stop growing."""
+        full = self.active & (self.ODs >= self.max_OD)
+        self.selection_growth_rates[full] = 0
+        growing = self.active & ~full
+        self.ODs[growing] = self.exponential(self.time_interval, self.ODs[growing], self.selection_growth_rates[growing])
+        self.save_data(self.ODs, self.elapsed_time, self.vials, 'OD')
+
+    def exponential(self, x, a, b):
+        return a * np.exp(b * x)
+    def linear(self, x, m, b):
+        return m * x + b
+    def sigmoid(self, x, a, b, c):
+        return a / (1 + np.exp(-b * (x - c)))
+
+    def simulate_selection(self):
+        """
+        Applies logged selection increases to the growth rates once their delay has passed,
+        then lets every vial under selection adapt back towards its normal growth rate.
+        """
+        sel_gr = self.selection_growth_rates.copy()
+
+        # Each increase is applied once, selection_delay hours after the step changed
+        due = (self.active & np.isfinite(self.last_increase_time)
+               & (self.elapsed_time - self.last_increase_time >= self.selection_delay)
+               & (self.selection_harshness < 1)
+               & (self.selection_increase_time < self.last_increase_time))
+        if due.any():
+            self.selection_increase_time[due] = self.last_increase_time[due]
+            # coin flip between the full and half the selection harshness
+            harsh = np.where(self.rng.random(len(sel_gr)) < 0.5, self.selection_harshness, self.selection_harshness / 2)
+            sel_gr[due] *= harsh[due]
+
+        adapting = self.active & (sel_gr < self.growth_rates)
+        sel_gr[adapting] += self.adaptation(sel_gr[adapting])
+
+        for vial in np.flatnonzero(sel_gr != self.selection_growth_rates):
+            self.selection_growth_rates_log[vial].append([self.elapsed_time, sel_gr[vial]])
+        self.selection_growth_rates = sel_gr
+
+    def adaptation(self, sel_gr):
+        """Growth rate gained in one step by vials under selection, given their current growth rates."""
+        if self.adaptation_function == LINEAR:
+            return self.linear(sel_gr, self.adaptation_params[0], self.adaptation_params[1])
+        elif self.adaptation_function == SIGMOID:
+            return self.sigmoid(sel_gr, *self.adaptation_params)
+        else:
+            return sel_gr
+
+    #### FLUIDICS ####
+    def fluid_command(self, MESSAGE):
+        self.logger.debug('fluid command: %s' % MESSAGE)
+        self.simulate_fluidics(MESSAGE)
+
+    def simulate_fluidics(self, MESSAGE):
+        """Makes dilutions in vials based off of flow rates and time to pump."""
+        flow_rate = np.asarray(self.get_flow_rate(), dtype=float)
+        n = len(self.ODs)
+        influx = np.array([0 if value == '--' else float(value) for value in MESSAGE[:n]])
+        selection = np.array([0 if value == '--' else float(value) for value in MESSAGE[32:32 + n]])
+        bolus_in_mL = flow_rate[:n] * influx * self.active
+        OD_decrease = np.exp(-bolus_in_mL / VOLUME)
+        self.ODs *= OD_decrease
+        self.media_ml += bolus_in_mL
+        self.selection_ml += flow_rate[32:32 + n] * selection * self.active
+
+        self.logger.info(f'Elapsed Time: {self.elapsed_time}')
+        for vial in np.flatnonzero(bolus_in_mL):
+            self.logger.info(f'Vial {vial}: Pumped {bolus_in_mL[vial]:.3f} mL, OD decreased by {OD_decrease[vial]:.3f}X to {self.ODs[vial]:.3f} from {round(self.ODs[vial] / OD_decrease[vial], 3)}')
+        self.save_data(self.ODs, self.elapsed_time, self.vials, 'OD')
+
+    def update_chemo(self, data, vials, bolus_in_s, period_config, immediate = False):
+        self.logger.info('chemostat mode is not simulated')
+
+    def stop_all_pumps(self, ):
+        self.logger.info('stopping all pumps')
+
+    def get_flow_rate(self):
+        if self.flow_rate is None:
+            with open(PUMP_CAL_PATH) as f:
+                self.flow_rate = json.load(f)['coefficients']
+        return self.flow_rate
+
+    #### EVOLVER INTERFACE ####
+    def publish(self, topic, elapsed_time, **payload):
+        # no live data bus in simulations; selection increases are picked up here
+        # instead of re-reading the step logs
+        if topic == 'step' and 'INCREASE' in payload.get('message', ''):
+            self.last_increase_time[payload['vial']] = float(payload['step_change_time'])
+
+    def initialize_exp(self, vials, log_name, quiet, verbose):
+        """Initialize the experiment."""
+        # Remove and close all handlers
+        for handler in logging.root.handlers[:]:
+            logging.root.removeHandler(handler)
+            handler.close()
+
+        if os.name == 'nt':
+            time.sleep(1) # Give Windows a second to actually release the log file lock
+
+        if self.storage_type == 'memory':
+            self.storage = storage.use_storage(self.exp_dir, storage.MemoryStorage())
+        else:
+            if os.path.exists(self.exp_dir):
+                shutil.rmtree(self.exp_dir)
+            os.makedirs(self.exp_dir)
+            storage.release_storage(self.exp_dir)
+            self.storage = storage.get_storage(self.exp_dir)
+
+        setup_logging(log_name, quiet, verbose)
+        self.logger.debug('creating data series')
+        for x in vials:
+            exp_str = "Experiment: {0} vial {1}, {2}".format(EXP_NAME, x, time.strftime("%c"))
+            self.storage.create_series('OD', x, header=[exp_str])
+            self.storage.create_series('pump_log', x, header=[exp_str], records=["0,0"])
+            self.storage.create_series('slow_pump_log', x, header=[exp_str], records=["0,0"])
+            self.storage.create_series('ODset', x, header=[exp_str], records=["0,0"])
+            self.storage.create_series('gr', x, header=[exp_str], records=["0,0"])
+            self.storage.create_series('chemo_config', x, records=["0,0,0", "0,0,0"])
+            self.storage.create_series('step_log', x,
+                                       header=[exp_str, "elapsed_time,step_change_time,current_step,chemical_concentration,event_message"],
+                                       records=["0,0,0,0,0"])
+        fu.create_dilution_summary(vials, self.exp_dir)
+
+        # Selection initialization
+        excel_configs = self.excel_configs if self.excel_configs is not None else cu.load_excel_configs(self.excel_config_file)
+        updated_vials = step_init.update_selection_configs(self.elapsed_time, vials, excel_configs, self.logger, self)
+        if self.plot_steps and self.storage_type != 'memory':
+            step_init.plot_steps(vials, 'selection-steps', 'Selection', self.exp_dir, updated_vials)
+
+    def save_data(self, data, elapsed_time, vials, parameter):
+        if len(data) == 0:
+            return
+        if parameter == 'OD':
+            self._record_ods(elapsed_time, data)
+        for x in vials:
+            self.storage.append(parameter, x, elapsed_time, data[x])
+
+    def _record_ods(self, elapsed_time, ODs):
+        if self._od_count == len(self._od_history):
+            self._od_history = np.concatenate([self._od_history, np.empty_like(self._od_history)])
+        self._od_history[self._od_count, 0] = elapsed_time
+        self._od_history[self._od_count, 1:] = ODs
+        self._od_count += 1
+
+    def od_history(self, vial):
+        """
+        OD values saved for a vial.
+        Returns:
+            numpy.ndarray: (n, 2) array of [elapsed time, OD].
+        """
+        return self._od_history[:self._od_count, [0, vial + 1]]
+
+    def calc_growth_rate(self, vial, gr_start, elapsed_time):
+        OD_data = self.od_history(vial)
+        raw_time = OD_data[:, 0]
+        raw_OD = OD_data[:, 1]
+
+        # Trim points prior to gr_start, take natural log, calculate slope
+        trim = np.isfinite(raw_OD) & (raw_time > gr_start)
+        log_OD = np.log(raw_OD[trim])
+        trim_time = raw_time[trim]
+        slope = an.regression_slope(trim_time[np.isfinite(log_OD)], log_OD[np.isfinite(log_OD)])
+        self.logger.debug('growth rate for vial %s: %.2f' % (vial, slope))
+
+        # Save slope
+        self.storage.append('gr', vial, elapsed_time, slope)
+        self.publish('gr', elapsed_time, vial=vial, value=slope)
+
+    def custom_functions(self, data, vials, elapsed_time):
+        # load user script from custom_script.py
+        if self.custom_function == 'turbidostat':
+            custom_script.turbidostat(self, data, vials, elapsed_time)
+        else:
+            # try to load the user function
+            # if failing report to user
+            self.logger.info('user-defined operation mode %s' % self.custom_function)
+            try:
+                func = getattr(custom_script, self.custom_function)
+                func(self, data, vials, elapsed_time)
+            except AttributeError:
+                self.logger.error('could not find function %s in custom_script.py' %
+                            self.custom_function)
+                print('Could not find function %s in custom_script.py '
+                    '- Skipping user defined functions'%
+                    self.custom_function)
+
+    def stop_exp(self):
+        self.logger.info('stopping experiment')
+        print('stopping experiment')
+
+def setup_logging(filename, quiet, verbose):
+    if quiet:
+        logging.basicConfig(level=logging.CRITICAL + 10)
+    else:
+        if verbose == 0:
+            level = logging.INFO
+        elif verbose >= 1:
+            level = logging.DEBUG
+        logging.basicConfig(format='%(asctime)s - %(name)s - [%(levelname)s] '
+                            '- %(message)s',
+                            datefmt='%Y-%m-%d %H:%M:%S',
+                            filename=filename,
+                            level=level)
+
+if __name__ == '__main__':
+    print('Please run eVOLVER.py instead')
@@ -1,11 +1,12 @@
 import os
 import traceback
 import numpy as np
-import pandas as pd
 
 import utils.step_utils as su
 import utils.file_utils as fu
 import utils.config_utils as cu
+import utils.analytics as an
+from utils.storage import get_storage
 
 class SteppedController:
     def __init__(self, vial, exp_dir, dilution_window, logger, elapsed_time, eVOLVER):
@@ -23,16 +24,16 @@ class SteppedController:
         self.fold_decrease = 0.5 # Fold to decrease when going below lowest step
 
         # Selection Controls
-        self.stock_conc = float(self.selection_controls.stock_concentration)
-        self.curves_to_start = int(self.selection_controls.curves_to_start)
-        self.min_curves_per_step = int(self.selection_controls.min_curves_per_step)
-        self.min_step_time = float(self.selection_controls.min_step_time)
-        self.growth_stalled_time = float(self.selection_controls.growth_stalled_time)
-        self.min_growthrate = float(self.selection_controls.min_growthrate)
-        self.max_growthrate = float(self.selection_controls.max_growthrate)
-        self.rescue_dilutions = int(self.selection_controls.rescue_dilutions)
-        self.rescue_threshold = float(self.selection_controls.rescue_threshold)
-        self.selection_units = self.selection_controls.selection_units
+        self.stock_conc = float(self.selection_controls['stock_concentration'])
+        self.curves_to_start = int(self.selection_controls['curves_to_start'])
+        self.min_curves_per_step = int(self.selection_controls['min_curves_per_step'])
+        self.min_step_time = float(self.selection_controls['min_step_time'])
+        self.growth_stalled_time = float(self.selection_controls['growth_stalled_time'])
+        self.min_growthrate = float(self.selection_controls['min_growthrate'])
+        self.max_growthrate = float(self.selection_controls['max_growthrate'])
+        self.rescue_dilutions = int(self.selection_controls['rescue_dilutions'])
+        self.rescue_threshold = float(self.selection_controls['rescue_threshold'])
+        self.selection_units = self.selection_controls['selection_units']
 
         # Step Log
         self.last_time = float(self.last_step_log[0])
@@ -47,14 +48,15 @@ class SteppedController:
         self.current_step = self.last_step
         
     def load_info(self):
-        """Load growth rate, OD, and selection data for the given vial."""
-        file_name = f"vial{self.vial}_gr.txt"
-        gr_path = os.path.join(self.exp_dir, 'growthrate', file_name)
-        gr_data = pd.read_csv(gr_path, delimiter=',', header=1, names=['time', 'gr'], dtype={'time': float, 'gr': float})
+        """
+        Load growth rate, OD, and selection data for the given vial. A controller is created for
+        every vial at every broadcast, so this only builds numpy arrays and a dict (no DataFrames).
+        """
+        gr_data = get_storage(self.exp_dir).read_range('gr', self.vial)[1:, :2] # [time, gr]; skip the initial 0,0 record
 
         OD_data = fu.get_last_n_lines('OD', self.vial, self.dilution_window * 2, self.exp_dir)
         selection_steps =fu.get_last_n_lines('selection-steps', self.vial, 1, self.exp_dir)[0][1:]
-        selection_controls = fu.labeled_last_n_lines('selection-control', self.vial, 1, self.exp_dir).iloc[0]
+        selection_controls = fu.labeled_last_config('selection-control', self.vial, self.exp_dir)
         last_step_log = fu.get_last_n_lines('step_log', self.vial, 1, self.exp_dir)[0]
 
         return gr_data, OD_data, selection_steps, selection_controls, last_step_log
@@ -84,6 +86,8 @@ class SteppedController:
         if self.selection_status_message: # Log the selection status message if there is one
             log_message = f"{self.step_changed_time},{self.current_step},{round(self.current_conc, 5)},{self.selection_status_message}"
             fu.update_log(self.vial, 'step_log', self.elapsed_time, log_message, self.exp_dir)
+            self.eVOLVER.publish('step', self.elapsed_time, vial=self.vial, step_change_time=self.step_changed_time,
+                                 step=self.current_step, concentration=self.current_conc, message=self.selection_status_message)
 
         return MESSAGE
 
@@ -103,11 +107,11 @@ class SteppedController:
     def determine_step(self):
         """Determine and adjust the selection step for the vial."""
         try:
-            num_curves_this_step = len(self.gr_data[self.gr_data['time'] > self.last_step_change_time])
+            num_curves_this_step = int(np.count_nonzero(self.gr_data[:, 0] > self.last_step_change_time))
             
             if self.step_time >= self.min_step_time:
-                last_gr_time = self.gr_data['time'].values[-1]
-                last_gr = self.gr_data.tail(self.min_curves_per_step)['gr'].median()
+                last_gr_time = self.gr_data[-1, 0]
+                last_gr = an.recent_growth_rate(self.gr_data[:, 1], self.min_curves_per_step)
                 
                 if (self.elapsed_time-last_gr_time) > self.growth_stalled_time:
                     self.decrease_step("GROWTH STALLED", last_gr_time)
@@ -201,6 +205,8 @@ class SteppedController:
                             MESSAGE[self.vial + 32] = str(time_in) # set the pump message
                         
                             fu.update_log(self.vial, 'slow_pump_log', self.elapsed_time, time_in, self.exp_dir)
+                            fu.update_dilution_summary(self.vial, self.elapsed_time, self.exp_dir, flow_rate, selection_s=time_in)
+                            self.eVOLVER.publish('pump', self.elapsed_time, vial=self.vial, selection_s=time_in)
                             self.selection_status_message += f'SELECTION CHEMICAL ADDED {round(calculated_bolus, 3)}mL | '
 
                     elif (np.median(self.OD_data[:,1]) < lower_thresh) and (self.current_step != 0):
@@ -274,6 +280,9 @@ class SteppedController:
                 MESSAGE[self.vial] = str(time_in) # influx pump
                 MESSAGE[self.vial + 16] = str(round(time_in + time_out,2)) # efflux pump
                 fu.update_log(self.vial, 'pump_log', self.elapsed_time, time_in, self.exp_dir)
+                fu.update_dilution_summary(self.vial, self.elapsed_time, self.exp_dir, flow_rate,
+                                           influx_s=time_in, efflux_s=round(time_in + time_out, 2))
+                self.eVOLVER.publish('pump', self.elapsed_time, vial=self.vial, influx_s=time_in, efflux_s=round(time_in + time_out, 2))
                 self.selection_status_message += f'[RESCUE DILUTION] | '
                 return MESSAGE
 
@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+
+import io
+import os
+import json
+import time
+import argparse
+import itertools
+import contextlib
+import tempfile
+import concurrent.futures
+import numpy as np
+import pandas as pd
+
+from custom_script import VOLUME, EXCEL_CONFIG_FILE
+import utils.config_utils as cu
+import utils.file_utils as fu
+import utils.storage as storage
+import simulation
+
+# Baseline simulation; every sweep point overrides some of these
+DEFAULT_SIMULATION = {
+    'vials': list(range(16)),
+    'custom_function': 'turbidostat',
+    'duration': 336, # hours; two weeks
+    'initial_ODs': [0.1] * 16,
+    'initial_grs': [0.2] * 16,
+    'vial_volume': VOLUME, # mL
+    'time_interval': 0.1, # hours
+    'max_OD': 4,
+    'initial_selection_harshness': [0.5] * 16,
+    'selection_delay': [2] * 16, # hours
+    'selection_function': simulation.LINEAR,
+    'selection_params': [0.1, 0],
+    'adaptation_function': simulation.LINEAR,
+    'adaptation_params': [0.005, 0],
+    'flow_rate': [1] * 48, # mL/s
+    'plot_steps': False,
+    'storage': 'memory',
+}
+
+# Simulation parameters given per vial; a single value in a sweep applies to all vials
+VIAL_PARAMS = ['initial_ODs', 'initial_grs', 'initial_selection_harshness', 'selection_delay']
+
+# Excel config sheets whose columns can be swept
+CONFIG_SHEETS = ['selection-control', 'selection-step_generation']
+
+#### SWEEP POINTS ####
+def grid(**axes):
+    """
+    Every combination of the given values.
+    Args:
+        **axes: Parameter name to list of values, e.g. min_growthrate=[0.08, 0.1].
+    Returns:
+        list: One dict of parameter values per point.
+    """
+    names = list(axes)
+    return [dict(zip(names, values)) for values in itertools.product(*axes.values())]
+
+def random_samples(n, seed=None, **ranges):
+    """
+    Random points drawn independently for each parameter.
+    Args:
+        n (int): Number of points.
+        seed (int): Seed for reproducible samples.
+        **ranges: Parameter name to a (low, high) tuple, sampled uniformly (as integers when
+            both bounds are integers), or to a list of values to choose from.
+    Returns:
+        list: One dict of parameter values per point.
+    """
+    rng = np.random.default_rng(seed)
+    columns = {}
+    for name, values in ranges.items():
+        if isinstance(values, tuple):
+            low, high = values
+            if isinstance(low, int) and isinstance(high, int):
+                columns[name] = rng.integers(low, high, endpoint=True, size=n).tolist()
+            else:
+                columns[name] = rng.uniform(low, high, size=n).tolist()
+        else:
+            columns[name] = [values[i] for i in rng.integers(len(values), size=n)]
+    return [{name: columns[name][i] for name in columns} for i in range(n)]
+
+def apply_point(point, base_params, configs):
+    """
+    Splits a sweep point into simulation parameters and Excel configs.
+    Config columns (e.g. min_growthrate, step_number) are set for every vial; everything
+    else overrides the simulation parameters.
+    Returns:
+        tuple: (experiment_params, configs) for the point; the inputs are not modified.
+    """
+    params = dict(base_params)
+    configs = {name: config.copy() for name, config in configs.items()}
+    for name, value in point.items():
+        sheet = next((sheet for sheet in CONFIG_SHEETS if name != 'vial' and name in configs[sheet].columns), None)
+        if sheet is not None:
+            configs[sheet][name] = value
+        elif name in VIAL_PARAMS and np.isscalar(value):
+            params[name] = [value] * len(base_params[name])
+        elif name in base_params or name == 'seed':
+            params[name] = value
+        else:
+            raise KeyError(f'{name} is neither a simulation parameter nor a column of {", ".join(CONFIG_SHEETS)}')
+    return params, configs
+
+#### OUTCOMES ####
+def read_step_log(vial, exp_dir):
+    """
+    Reads a vial's step log.
+    Returns:
+        list: (elapsed_time, current_step, message) per logged event.
+    """
+    lines = storage.get_storage(exp_dir).read_lines('step_log', vial)[3:] # header lines and the initial "0,0,0,0,0"
+    events = []
+    for line in lines:
+        fields = line.rstrip('\n').split(',', 4)
+        if len(fields) == 5:
+            events.append((float(fields[0]), float(fields[2]), fields[4]))
+    return events
+
+def summarize(sim):
+    """
+    Outcome of a finished simulation, aggregated over its vials.
+    Returns:
+        dict: final_step (mean over vials), vials_at_max_step, time_to_max_step (median hours
+            for the vials that reached it), rescues, media_ml and selection_ml (totals).
+    """
+    final_steps = []
+    times_to_max = []
+    rescues = 0
+    for vial in sim.vials:
+        max_step = max(fu.get_last_n_lines('selection-steps', vial, 1, sim.exp_dir)[0][1:])
+        events = read_step_log(vial, sim.exp_dir)
+        final_steps.append(events[-1][1] if events else 0)
+        reached = [event_time for event_time, step, message in events if step >= max_step > 0]
+        if reached:
+            times_to_max.append(reached[0])
+        rescues += sum('RESCUE DILUTION' in message for event_time, step, message in events)
+    return {'final_step': float(np.mean(final_steps)),
+            'vials_at_max_step': len(times_to_max),
+            'time_to_max_step': float(np.median(times_to_max)) if times_to_max else np.nan,
+            'rescues': rescues,
+            'media_ml': float(np.sum(sim.media_ml[sim.vials])),
+            'selection_ml': float(np.sum(sim.selection_ml[sim.vials]))}
+
+def run_point(point, base_params, configs):
+    """
+    Runs one sweep point as an isolated simulation in its own temporary experiment directory
+    (kept in memory unless the base parameters set 'storage' to 'file').
+    Returns:
+        dict: The point's parameters and outcome, with an 'error' message if it failed.
+    """
+    start = time.time()
+    result = dict(point)
+    try:
+        params, point_configs = apply_point(point, base_params, configs)
+        with tempfile.TemporaryDirectory(prefix='evolver-sweep-') as tmp:
+            params['exp_dir'] = os.path.join(tmp, simulation.EXP_NAME)
+            params['log_name'] = os.devnull
+            params['excel_configs'] = point_configs
+            sim = simulation.EvolverSimulation(params)
+            with contextlib.redirect_stdout(io.StringIO()):
+                sim.run_simulation(quiet=True)
+            try:
+                result.update(summarize(sim))
+            finally:
+                storage.release_storage(sim.exp_dir)
+        result['error'] = None
+    except Exception as e:
+        result['error'] = f'{type(e).__name__}: {e}'
+    result['runtime_s'] = time.time() - start
+    return result
+
+def run_sweep(points, base_params=None, config_file=EXCEL_CONFIG_FILE, workers=None, seed=0):
+    """
+    Runs every point of a sweep in a process pool.
+    Args:
+        points (list): Parameter dicts, e.g. from grid() or random_samples().
+        base_params (dict): Simulation parameters the points override; DEFAULT_SIMULATION if None.
+        config_file (str): Excel configs the points override.
+        workers (int): Processes to use; one per CPU if None.
+        seed (int): Points without a 'seed' get seed + their index, so sweeps are reproducible.
+    Returns:
+        pandas.DataFrame: One row per point with its parameters and outcome.
+    """
+    base_params = dict(DEFAULT_SIMULATION if base_params is None else base_params)
+    configs = cu.load_excel_configs(config_file)
+    points = [dict(point, seed=point.get('seed', seed + i)) for i, point in enumerate(points)]
+    workers = workers or os.cpu_count() or 1
+    results = [None] * len(points)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=min(workers, len(points)) or 1) as pool:
+        futures = {pool.submit(run_point, point, base_params, configs): i for i, point in enumerate(points)}
+        for done, future in enumerate(concurrent.futures.as_completed(futures), 1):
+            results[futures[future]] = future.result()
+            print(f'\r{done}/{len(points)} simulations done', end='', flush=True)
+    print()
+    return pd.DataFrame(results)
+
+def parse_value(text):
+    try:
+        return json.loads(text)
+    except ValueError:
+        return text
+
+def get_options():
+    description = 'Simulate a selection experiment for many parameter sets in parallel'
+    parser = argparse.ArgumentParser(description=description,
+                                     epilog='Parameters are simulation parameters (e.g. initial_grs, '
+                                            'selection_delay, adaptation_params) or columns of the '
+                                            'selection-control and selection-step_generation configs '
+                                            '(e.g. min_growthrate, rescue_threshold, step_number).')
+    sampling = parser.add_mutually_exclusive_group(required=True)
+    sampling.add_argument('-g', '--grid', action='append', metavar='NAME=V1,V2,...',
+                          help='Values of a parameter; all combinations are simulated. Repeat for each parameter.')
+    sampling.add_argument('-r', '--random', action='append', metavar='NAME=LOW:HIGH',
+                          help='Range of a parameter to sample uniformly (integers if both bounds are), '
+                               'or NAME=V1,V2,... to choose from. Repeat for each parameter.')
+    parser.add_argument('-n', '--samples', type=int, default=100,
+                        help='Number of random points (default: %(default)s)')
+    parser.add_argument('-d', '--duration', type=float, default=DEFAULT_SIMULATION['duration'],
+                        help='Simulated hours per point (default: %(default)s)')
+    parser.add_argument('-c', '--config', default=EXCEL_CONFIG_FILE,
+                        help='Excel configs to start from (default: %(default)s)')
+    parser.add_argument('-w', '--workers', type=int,
+                        help='Processes to use (default: one per CPU)')
+    parser.add_argument('-s', '--seed', type=int, default=0,
+                        help='Seed for sampling and the simulations (default: %(default)s)')
+    parser.add_argument('-o', '--output', default='sweep_results.csv',
+                        help='CSV file for the results table (default: %(default)s)')
+    return parser.parse_args(), parser
+
+if __name__ == '__main__':
+    options, parser = get_options()
+
+    if options.grid:
+        axes = {}
+        for axis in options.grid:
+            name, values = axis.split('=', 1)
+            axes[name] = [parse_value(value) for value in values.split(',')]
+        points = grid(**axes)
+    else:
+        ranges = {}
+        for axis in options.random:
+            name, values = axis.split('=', 1)
+            if ':' in values:
+                ranges[name] = tuple(parse_value(value) for value in values.split(':', 1))
+            else:
+                ranges[name] = [parse_value(value) for value in values.split(',')]
+        points = random_samples(options.samples, options.seed, **ranges)
+
+    base_params = dict(DEFAULT_SIMULATION, duration=options.duration)
+    print(f'Running {len(points)} simulations of {options.duration} hours')
+    results = run_sweep(points, base_params, options.config, options.workers, options.seed)
+    results.to_csv(options.output, index=False)
+    print(results.describe().to_string())
+    failed = results['error'].notna().sum()
+    if failed:
+        print(f'{failed} simulations failed, see the error column of {options.output}')
+    print(f'Results written to {options.output}')
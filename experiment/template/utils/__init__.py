@@ -1,5 +1,20 @@
 # __init__.py
-from .step_utils import *
-from .config_utils import *
-from .file_utils import *
-from .step_init import *
+# The helpers of step_utils, config_utils, file_utils and step_init are available as
+# utils.<name>, but their modules are only imported on first use: importing a single
+# module (e.g. utils.storage) does not pull in the others. For the same reason pandas and
+# matplotlib are imported inside the functions that need them, so that eVOLVER.py starts
+# without loading them.
+import importlib
+import importlib.util
+
+_HELPER_MODULES = ['step_utils', 'config_utils', 'file_utils', 'step_init']
+
+def __getattr__(name):
+    if importlib.util.find_spec(f'{__name__}.{name}') is not None:
+        return importlib.import_module(f'.{name}', __name__)
+    if not name.startswith('_'):
+        for module_name in _HELPER_MODULES:
+            module = importlib.import_module(f'.{module_name}', __name__)
+            if hasattr(module, name):
+                return getattr(module, name)
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
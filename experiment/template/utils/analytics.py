@@ -0,0 +1,286 @@
+import os.path
+import threading
+import collections
+import numpy as np
+
+#### ROLLING STATISTICS ####
+def _window_sums(values, window):
+    """
+    Trailing window sums of the finite values, their squares and their count,
+    computed from cumulative sums. Windows at the start are incomplete.
+    """
+    values = np.asarray(values, dtype=float)
+    finite = np.isfinite(values)
+    filled = np.where(finite, values, 0.)
+    sums = np.concatenate([[0.], np.cumsum(filled)])
+    squares = np.concatenate([[0.], np.cumsum(filled * filled)])
+    counts = np.concatenate([[0], np.cumsum(finite)])
+    end = np.arange(1, len(values) + 1)
+    begin = np.maximum(end - window, 0)
+    return sums[end] - sums[begin], squares[end] - squares[begin], counts[end] - counts[begin]
+
+def rolling_mean(values, window, min_periods=1):
+    """
+    NaN-aware trailing mean over the last 'window' values, including the current one.
+    Args:
+        values (array-like): The values to average.
+        window (int): The number of values in each window.
+        min_periods (int): Minimum number of finite values for a result; NaN otherwise.
+    Returns:
+        numpy.ndarray: The rolling mean, same length as values.
+    """
+    sums, _, counts = _window_sums(values, window)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = sums / counts
+    mean[counts < max(min_periods, 1)] = np.nan
+    return mean
+
+def rolling_std(values, window, min_periods=2, ddof=1):
+    """
+    NaN-aware trailing standard deviation over the last 'window' values.
+    Args:
+        values (array-like): The values.
+        window (int): The number of values in each window.
+        min_periods (int): Minimum number of finite values for a result; NaN otherwise.
+        ddof (int): Delta degrees of freedom, 1 for the sample standard deviation (as pandas).
+    Returns:
+        numpy.ndarray: The rolling standard deviation, same length as values.
+    """
+    sums, squares, counts = _window_sums(values, window)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        variance = (squares - sums * sums / counts) / (counts - ddof)
+    variance = np.maximum(variance, 0.)  # cancellation can leave tiny negatives
+    std = np.sqrt(variance)
+    std[counts < max(min_periods, ddof + 1)] = np.nan
+    return std
+
+def rolling_median(values, window, min_periods=1):
+    """
+    NaN-aware trailing median over the last 'window' values.
+    Medians cannot be built from cumulative sums, so this takes one nanmedian
+    over a strided (n, window) view of the NaN-padded values.
+    Args:
+        values (array-like): The values.
+        window (int): The number of values in each window.
+        min_periods (int): Minimum number of finite values for a result; NaN otherwise.
+    Returns:
+        numpy.ndarray: The rolling median, same length as values.
+    """
+    values = np.asarray(values, dtype=float)
+    if len(values) == 0:
+        return np.empty(0)
+    padded = np.concatenate([np.full(window - 1, np.nan), values])
+    stride = padded.strides[0]
+    windows = np.lib.stride_tricks.as_strided(padded, shape=(len(values), window), strides=(stride, stride), writeable=False)
+    counts = np.isfinite(windows).sum(axis=1)
+    median = np.full(len(values), np.nan)
+    valid = counts >= max(min_periods, 1)
+    if valid.any():
+        median[valid] = np.nanmedian(windows[valid], axis=1)
+    return median
+
+def recent_growth_rate(growth_rates, n):
+    """
+    Median of the last n growth rates, ignoring NaN (same as pandas tail(n).median()).
+    Args:
+        growth_rates (array-like): Growth rates in time order.
+        n (int): Number of growth curves to take the median over.
+    Returns:
+        float: The median growth rate, NaN if there are no finite values.
+    """
+    tail = np.asarray(growth_rates, dtype=float)[-n:] if n > 0 else np.empty(0)
+    tail = tail[np.isfinite(tail)]
+    if tail.size == 0:
+        return np.nan
+    return float(np.median(tail))
+
+def doubling_time(growth_rates):
+    """
+    Doubling time in hours for growth rates in 1/h. Non-positive rates give NaN.
+    """
+    growth_rates = np.asarray(growth_rates, dtype=float)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(growth_rates > 0, np.log(2) / growth_rates, np.nan)
+
+def regression_slope(x, y):
+    """
+    Least squares slope of y against x, same as scipy.stats.linregress(x, y).slope.
+    scipy is only imported for the cases it handles specially (fewer than two points or
+    identical x values), so it does not have to be loaded at startup.
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    if x.size >= 2:
+        dx = x - x.mean()
+        ssxm = np.dot(dx, dx)
+        if ssxm > 0:
+            return float(np.dot(dx, y - y.mean()) / ssxm)
+    from scipy import stats
+    return stats.linregress(x, y).slope
+
+#### PER-STEP AND PER-CURVE SUMMARIES ####
+def step_growth_summary(gr_data, step_log):
+    """
+    Joins growth rates to the selection step in effect when they were measured.
+    'std_gr' is the sample standard deviation (ddof=1), as in rolling_std; NaN for a single curve.
+    Args:
+        gr_data (numpy.ndarray): (n, 2) array of [time, growth rate].
+        step_log (numpy.ndarray): (m, >=3) array of [elapsed_time, step_change_time, current_step, ...].
+    Returns:
+        dict: Per-step arrays 'step', 'start', 'curves', 'median_gr', 'mean_gr', 'std_gr' and 'doubling_time'.
+    """
+    gr_data = np.asarray(gr_data, dtype=float).reshape(-1, 2)
+    step_log = np.asarray(step_log, dtype=float)
+    empty = {key: np.empty(0) for key in ['step', 'start', 'curves', 'median_gr', 'mean_gr', 'std_gr', 'doubling_time']}
+    if step_log.size == 0 or gr_data.size == 0:
+        return empty
+    step_log = step_log.reshape(-1, step_log.shape[-1])
+
+    # One row per distinct step change, keeping the last logged step for each
+    change_times, last_index = np.unique(step_log[::-1, 1], return_index=True)
+    steps = step_log[::-1, 2][last_index]
+
+    group = np.searchsorted(change_times, gr_data[:, 0], side='right') - 1
+    keep = (group >= 0) & np.isfinite(gr_data[:, 1])
+    group, values = group[keep], gr_data[keep, 1]
+    if values.size == 0:
+        return empty
+
+    n_groups = len(change_times)
+    curves = np.bincount(group, minlength=n_groups)
+    sums = np.bincount(group, weights=values, minlength=n_groups)
+    squares = np.bincount(group, weights=values * values, minlength=n_groups)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = sums / curves
+        variance = (squares - sums * mean) / (curves - 1)
+    std = np.sqrt(np.maximum(variance, 0.))  # cancellation can leave tiny negatives
+    std[curves < 2] = np.nan
+
+    # Medians from one sort by (group, value)
+    order = np.lexsort((values, group))
+    sorted_values = values[order]
+    starts = np.concatenate([[0], np.cumsum(curves)[:-1]])
+    lower = sorted_values[np.clip(starts + (curves - 1) // 2, 0, len(sorted_values) - 1)]
+    upper = sorted_values[np.clip(starts + curves // 2, 0, len(sorted_values) - 1)]
+    median = np.where(curves > 0, (lower + upper) / 2, np.nan)
+
+    used = curves > 0
+    return {
+        'step': steps[used],
+        'start': change_times[used],
+        'curves': curves[used],
+        'median_gr': median[used],
+        'mean_gr': mean[used],
+        'std_gr': std[used],
+        'doubling_time': doubling_time(median[used]),
+    }
+
+def od_curve_stats(od_data, odset_data):
+    """
+    Statistics of the OD within each growth curve, delimited by the ODset log.
+    Args:
+        od_data (numpy.ndarray): (n, 2) array of [time, OD].
+        odset_data (numpy.ndarray): (m, 2) array of [time, OD setpoint]; a row with the upper threshold starts a curve.
+    Returns:
+        dict: Per-curve arrays 'start', 'end', 'points', 'od_start', 'od_end', 'od_min', 'od_max'.
+    """
+    od_data = np.asarray(od_data, dtype=float).reshape(-1, 2)
+    odset_data = np.asarray(odset_data, dtype=float).reshape(-1, 2)
+    od_data = od_data[np.isfinite(od_data[:, 1])]
+    keys = ['start', 'end', 'points', 'od_start', 'od_end', 'od_min', 'od_max']
+    if od_data.size == 0 or odset_data.size == 0:
+        return {key: np.empty(0) for key in keys}
+
+    # Curves start at rows where the setpoint rose (the upper threshold was set)
+    rises = np.concatenate([[True], np.diff(odset_data[:, 1]) > 0])
+    starts = odset_data[rises, 0]
+    segment = np.searchsorted(starts, od_data[:, 0], side='right') - 1
+    keep = segment >= 0
+    segment, times, ods = segment[keep], od_data[keep, 0], od_data[keep, 1]
+    if ods.size == 0:
+        return {key: np.empty(0) for key in keys}
+
+    # OD data is in time order, so each segment is contiguous
+    boundaries = np.flatnonzero(np.diff(segment)) + 1
+    first = np.concatenate([[0], boundaries])
+    last = np.concatenate([boundaries, [len(ods)]]) - 1
+    return {
+        'start': times[first],
+        'end': times[last],
+        'points': last - first + 1,
+        'od_start': ods[first],
+        'od_end': ods[last],
+        'od_min': np.minimum.reduceat(ods, first),
+        'od_max': np.maximum.reduceat(ods, first),
+    }
+
+#### CACHED PER-VIAL ANALYTICS ####
+VIAL_CACHE_SIZE = 64 # vials (of any experiment and window) kept; least recently used go first
+_vial_cache = collections.OrderedDict()
+_vial_cache_lock = threading.Lock() # the dashboard reads from several threads
+
+def _signature(paths):
+    signature = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            signature.append((stat.st_size, stat.st_mtime_ns))
+        except OSError:
+            signature.append(None)
+    return tuple(signature)
+
+def _load(path, skip_header, columns=2):
+    try:
+        data = np.genfromtxt(path, delimiter=',', skip_header=skip_header, usecols=range(columns))
+    except (OSError, ValueError):
+        return np.empty((0, columns))
+    return np.atleast_2d(data).reshape(-1, columns)
+
+def vial_analytics(vial, exp_dir, window=10):
+    """
+    Derived statistics for one vial, recomputed only when one of its data files changes.
+    Args:
+        vial (int): The vial number.
+        exp_dir (str): The experiment directory.
+        window (int): Number of growth curves in the rolling statistics.
+    Returns:
+        dict: 'gr' (time, growth rate), 'gr_mean', 'gr_median', 'gr_std', 'doubling_time',
+            'steps' (see step_growth_summary) and 'curves' (see od_curve_stats).
+    """
+    paths = [os.path.join(exp_dir, 'growthrate', f'vial{vial}_gr.txt'),
+             os.path.join(exp_dir, 'OD', f'vial{vial}_OD.txt'),
+             os.path.join(exp_dir, 'ODset', f'vial{vial}_ODset.txt'),
+             os.path.join(exp_dir, 'step_log', f'vial{vial}_step_log.txt')]
+    key = (os.path.abspath(exp_dir), vial, window)
+    signature = _signature(paths)
+    with _vial_cache_lock:
+        cached = _vial_cache.get(key)
+        if cached is not None and cached[0] == signature:
+            _vial_cache.move_to_end(key)
+            return cached[1]
+
+    # Skip headers, the initial "0,0" rows and the first (biased) growth rate
+    gr_data = _load(paths[0], 3)
+    od_data = _load(paths[1], 1)
+    odset_data = _load(paths[2], 2)
+    step_log = _load(paths[3], 3, columns=4)
+
+    growth_rates = gr_data[:, 1]
+    result = {
+        'gr': gr_data,
+        'gr_mean': rolling_mean(growth_rates, window),
+        'gr_median': rolling_median(growth_rates, window),
+        'gr_std': rolling_std(growth_rates, window),
+        'doubling_time': doubling_time(growth_rates),
+        'steps': step_growth_summary(gr_data, step_log),
+        'curves': od_curve_stats(od_data, odset_data),
+    }
+    with _vial_cache_lock:
+        _vial_cache[key] = (signature, result)
+        _vial_cache.move_to_end(key)
+        while len(_vial_cache) > VIAL_CACHE_SIZE:
+            _vial_cache.popitem(last=False)
+    return result
+
+if __name__ == '__main__':
+    print('Please run eVOLVER.py instead')
@@ -0,0 +1,156 @@
+import time
+import collections
+
+from .clock import WallClock
+
+MAX_LAG = 300 # seconds a broadcast may wait before the connection is reset
+STALE_LAG = 30 # seconds after which a broadcast is only stored, not acted on
+MAX_SKIPPED = 3 # stale broadcasts in a row stored without control; the next one is acted on
+OFFSET_WINDOW = 180 # broadcasts (an hour at the server's 20 s) to estimate the clock offset over
+STEP_TOLERANCE = 1 # seconds the DPU wall clock may drift from its monotonic clock between broadcasts
+LAG_FILE = 'broadcast_lag.json'
+
+class BroadcastLag:
+    """
+    Tracks how fresh the broadcasts are, so that a backlog is noticed instead of guessed at.
+    Each broadcast is timestamped on arrival, on a monotonic clock, and compared with the
+    server's own 'timestamp' (all DPU times are taken from the injected clock):
+      - queue lag: how long it waited (at the server, in the socket or behind the previous
+        broadcast) before it was handled.
+      - processing lag: how long handling it took.
+
+    The server and the DPU clocks need not agree: their offset is taken to be the smallest
+    arrival - timestamp difference over the last OFFSET_WINDOW broadcasts, i.e. the freshest
+    recent broadcast is taken to have waited no time. The offset is reset on a clock step:
+    when the server timestamps go back, which a queue cannot do, or when the DPU wall clock
+    jumps against its monotonic clock, i.e. NTP stepped the clocks. Lags are never reset for
+    being long or steady, so a backlog that holds or grows keeps counting towards max_lag.
+    Broadcasts without a timestamp count as fresh, so nothing is skipped and no reconnect is
+    asked for.
+
+    A stale broadcast (queued longer than stale_lag) is still stored but not acted on; the
+    next, fresher one is. At most max_skipped are skipped in a row, so control never stops
+    for long. Only when the lag exceeds max_lag, i.e. storing the readings is not enough to
+    catch up, is a reconnect due.
+    """
+    def __init__(self, clock=None, max_lag=MAX_LAG, stale_lag=STALE_LAG, max_skipped=MAX_SKIPPED, window=OFFSET_WINDOW):
+        self.clock = clock if clock is not None else WallClock()
+        self.max_lag = max_lag
+        self.stale_lag = stale_lag
+        self.max_skipped = max_skipped
+        self.window = window
+        self._offsets = collections.deque() # (index, offset), offsets increasing: the window minimum
+        self._last_server_time = None
+        self._wall_offset = None # DPU wall clock - monotonic clock at the last broadcast
+        self.broadcasts = 0
+        self.timestamped = 0
+        self.stale = 0
+        self.skipped_in_row = 0
+        self.skip_control = False
+        self.clock_shifts = 0
+        self.reconnects = 0
+        self.queue_lag = 0.
+        self.queue_lag_max = 0.
+        self.processing_lag = 0.
+        self.processing_lag_max = 0.
+        self.processing_total = 0.
+        self.last_reconnect = None
+        self._started = None
+
+    def arrived(self, data):
+        """
+        Records a broadcast as it arrives, and decides whether to act on it (skip_control).
+        Args:
+            data (dict): The broadcast, with the server's 'timestamp' (seconds since the epoch) if it sends one.
+        Returns:
+            float: Its queue lag in seconds; the broadcast was measured this long before arriving.
+        """
+        self._started = time.perf_counter()
+        arrival_time = self.clock.monotonic()
+        wall_offset = self.clock.time() - arrival_time
+        self.broadcasts += 1
+        try:
+            server_time = float(data['timestamp'])
+        except (KeyError, TypeError, ValueError):
+            server_time = None
+        if server_time is None:
+            self.queue_lag = 0.
+        else:
+            self.timestamped += 1
+            self.queue_lag = self._lag(arrival_time - server_time, server_time, wall_offset)
+            self.queue_lag_max = max(self.queue_lag_max, self.queue_lag)
+
+        self.skip_control = self.queue_lag > self.stale_lag and self.skipped_in_row < self.max_skipped
+        if self.skip_control:
+            self.stale += 1
+            self.skipped_in_row += 1
+        else:
+            self.skipped_in_row = 0
+        return self.queue_lag
+
+    def _lag(self, offset, server_time, wall_offset):
+        if self._last_server_time is not None and server_time < self._last_server_time:
+            # the server clock went back; a queue cannot do that
+            self._shift(offset)
+        elif self._wall_offset is not None and abs(wall_offset - self._wall_offset) > STEP_TOLERANCE:
+            # the DPU clock was stepped, most likely by NTP, which sets the server's too
+            self._shift(offset)
+        self._last_server_time = server_time
+        self._wall_offset = wall_offset
+
+        while self._offsets and self._offsets[-1][1] >= offset:
+            self._offsets.pop()
+        self._offsets.append((self.timestamped, offset))
+        if self._offsets[0][0] <= self.timestamped - self.window:
+            self._offsets.popleft()
+        return offset - self._offsets[0][1]
+
+    def _shift(self, offset):
+        self.clock_shifts += 1
+        self._offsets.clear()
+        self._offsets.append((self.timestamped, offset))
+
+    def processed(self):
+        """Records that the last broadcast has been handled."""
+        if self._started is None:
+            return
+        self.processing_lag = time.perf_counter() - self._started
+        self.processing_lag_max = max(self.processing_lag_max, self.processing_lag)
+        self.processing_total += self.processing_lag
+        self._started = None
+
+    def reconnect_due(self):
+        """
+        Whether the lag calls for a reconnect. When it does, the reconnect is taken as made:
+        the next one is due at the earliest max_lag seconds later, on the injected clock.
+        """
+        now = self.clock.monotonic()
+        if self.queue_lag <= self.max_lag:
+            return False
+        if self.last_reconnect is not None and now - self.last_reconnect <= self.max_lag:
+            return False
+        self.last_reconnect = now
+        self.reconnects += 1
+        return True
+
+    def metrics(self):
+        """
+        Returns:
+            dict: Lag metrics, in seconds, and broadcast counts.
+        """
+        handled = max(self.broadcasts, 1)
+        return {
+            'broadcasts': self.broadcasts,
+            'timestamped': self.timestamped,
+            'stale': self.stale,
+            'clock_shifts': self.clock_shifts,
+            'reconnects': self.reconnects,
+            'queue_lag': round(self.queue_lag, 3),
+            'queue_lag_max': round(self.queue_lag_max, 3),
+            'processing_lag': round(self.processing_lag, 3),
+            'processing_lag_max': round(self.processing_lag_max, 3),
+            'processing_lag_mean': round(self.processing_total / handled, 3),
+        }
+
+if __name__ == '__main__':
+    print('Please run eVOLVER.py instead')
@@ -0,0 +1,53 @@
+import time
+
+class WallClock:
+    """Real time; what a running experiment uses."""
+    def time(self):
+        """Seconds since the epoch."""
+        return time.time()
+
+    def monotonic(self):
+        """Seconds that only go forward, whatever happens to the system clock (e.g. NTP steps)."""
+        return time.monotonic()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+    def elapsed_hours(self, start_time, at=None):
+        """
+        Experiment time as logged everywhere (OD files, pump logs, step logs, ...).
+        Args:
+            start_time (float): Clock time the experiment started at.
+            at (float): Clock time to measure up to; now if None.
+        Returns:
+            float: Hours from start_time, rounded to 4 decimals.
+        """
+        if at is None:
+            at = self.time()
+        return round((at - start_time) / 3600, 4)
+
+class VirtualClock(WallClock):
+    """
+    Time that only moves when advanced, so days of experiment time can be run in seconds.
+    Every time-dependent decision (pump_wait, min_step_time, growth_stalled_time, ...) is
+    made from the elapsed time, so it follows the virtual clock too.
+    """
+    def __init__(self, start=None):
+        self.now = time.time() if start is None else start
+
+    def time(self):
+        return self.now
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.advance(seconds)
+
+    def advance(self, seconds):
+        """Moves the clock forward; it never goes back."""
+        self.now += max(seconds, 0)
+        return self.now
+
+if __name__ == '__main__':
+    print('Please run eVOLVER.py instead')
@@ -1,20 +1,55 @@
 import os
-import pandas as pd
+import json
+import hashlib
+import numpy as np
+
+from .storage import get_storage
 
 #### UTILITIES FOR WORKING WITH CONFIG FILES ####
-def load_excel_configs(config_filename):
+COMPILED_CONFIG_VERSION = 1
+
+# Columns every known sheet must have, and the kind of values each holds
+CONFIG_SCHEMAS = {
+    'selection-control': {'vial': 'integer', 'step_type': 'text', 'stock_concentration': 'number',
+                          'curves_to_start': 'number', 'min_curves_per_step': 'number',
+                          'min_step_time': 'number', 'growth_stalled_time': 'number',
+                          'min_growthrate': 'number', 'max_growthrate': 'number',
+                          'rescue_dilutions': 'number', 'rescue_threshold': 'number',
+                          'selection_units': 'text'},
+    'selection-step_generation': {'vial': 'integer', 'logarithmic_steps': 'boolean',
+                                  'min_selection': 'number', 'max_selection': 'number',
+                                  'step_number': 'number'},
+    'selection-steps': {'vial': 'integer', 'steps': 'any'},
+}
+
+def load_excel_configs(config_filename, use_compiled=True):
     """
     Load configurations from an Excel file.
     This function reads an Excel file containing multiple sheets, where each sheet
     represents a different configuration. It returns a dictionary where the keys
     are the sheet names and the values are pandas DataFrames containing the data
     from each sheet.
+
+    Parsing the workbook is slow, so the parsed sheets are also compiled to JSON next to it
+    (see compiled_config_path) and reused while the workbook's content hash is unchanged.
+    The workbook stays the source of truth.
     Args:
         config_filename (str): The path to the Excel file containing the configurations.
+        use_compiled (bool): Whether to use (and write) the compiled configs.
     Returns:
         dict: A dictionary with sheet names as keys and pandas DataFrames as values.
+    Raises:
+        ValueError: If a known sheet is missing columns or has values of the wrong kind.
     """
-    
+    if use_compiled:
+        with open(config_filename, 'rb') as f:
+            workbook_hash = hashlib.sha256(f.read()).hexdigest()
+        configs = read_compiled_configs(config_filename, workbook_hash)
+        if configs is not None:
+            return configs
+
+    import pandas as pd # imported on first use, see utils/__init__.py
+
     # Load the Excel file
     excel_file = pd.ExcelFile(config_filename)
 
@@ -26,13 +61,87 @@ def load_excel_configs(config_filename):
     for config_name in config_names:
         # Read the sheet into a DataFrame
         config = pd.read_excel(excel_file, sheet_name=config_name)
+        validate_config(config_name, config)
         configs[config_name] = config
         
     # Explicitly close the file handle
     excel_file.close()
 
+    if use_compiled:
+        write_compiled_configs(config_filename, workbook_hash, configs)
     return configs
 
+def validate_config(config_name, config):
+    """
+    Checks a sheet against CONFIG_SCHEMAS; sheets without a schema are not checked.
+    Raises:
+        ValueError: Naming the sheet and column at fault.
+    """
+    schema = CONFIG_SCHEMAS.get(config_name)
+    if schema is None:
+        return
+    missing = [column for column in schema if column not in config.columns]
+    if missing:
+        raise ValueError(f"Config sheet '{config_name}' is missing columns: {', '.join(missing)}")
+    for column, kind in schema.items():
+        dtype_kind = config[column].dtype.kind
+        if kind == 'integer' and dtype_kind not in 'iu':
+            raise ValueError(f"Config sheet '{config_name}': column '{column}' must hold whole numbers")
+        if kind == 'number' and dtype_kind not in 'iuf':
+            raise ValueError(f"Config sheet '{config_name}': column '{column}' must hold numbers")
+        if kind == 'boolean' and dtype_kind != 'b':
+            raise ValueError(f"Config sheet '{config_name}': column '{column}' must hold TRUE or FALSE")
+    if list(config['vial']) != list(range(len(config))):
+        raise ValueError(f"Config sheet '{config_name}': vials must be numbered 0 to {len(config) - 1}, one per row")
+
+def compiled_config_path(config_filename):
+    """The compiled configs of a workbook, e.g. experiment_configurations.compiled.json."""
+    return os.path.splitext(config_filename)[0] + '.compiled.json'
+
+def read_compiled_configs(config_filename, workbook_hash):
+    """
+    Returns:
+        dict: The compiled configs as DataFrames, or None if there are none for this
+            workbook content (or they cannot be read).
+    """
+    try:
+        with open(compiled_config_path(config_filename)) as f:
+            compiled = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if compiled.get('version') != COMPILED_CONFIG_VERSION or compiled.get('hash') != workbook_hash:
+        return None
+
+    import pandas as pd # imported on first use, see utils/__init__.py
+    configs = {}
+    for config_name, sheet in compiled['sheets'].items():
+        config = pd.DataFrame(sheet['records'], columns=sheet['columns'])
+        configs[config_name] = config.astype(sheet['dtypes'])
+    return configs
+
+def write_compiled_configs(config_filename, workbook_hash, configs):
+    # The dtypes are kept so the DataFrames read back are the same as those parsed from Excel
+    compiled = {'version': COMPILED_CONFIG_VERSION,
+                'hash': workbook_hash,
+                'sheets': {config_name: {'columns': [str(column) for column in config.columns],
+                                         'dtypes': {str(column): str(dtype) for column, dtype in config.dtypes.items()},
+                                         'records': config.astype(object).where(config.notna(), None).values.tolist()}
+                           for config_name, config in configs.items()}}
+    path = compiled_config_path(config_filename)
+    tmp_path = path + '.tmp'
+    try:
+        with open(tmp_path, 'w') as f:
+            json.dump(compiled, f, default=_json_value)
+        os.replace(tmp_path, path)
+    except OSError:
+        pass # e.g. a read-only directory; the workbook is parsed every time instead
+
+def _json_value(value):
+    # numpy scalars in object columns
+    if hasattr(value, 'item'):
+        return value.item()
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
 def update_config(vial, config_name, current_config, exp_dir):
     """
     Update a configuration file with a new configuration.
@@ -44,12 +153,7 @@ def update_config(vial, config_name, current_config, exp_dir):
     Returns:
         None
     """
-
-    config_path = os.path.join(exp_dir, f'{config_name}', f'vial{vial}_{config_name}.txt')
-    
-    with open(config_path, "a+") as text_file:
-        line = ','.join(str(config) for config in current_config) # Convert the list to a string with commas as separators
-        text_file.write(line+'\n') # Write the string to the file, including a newline character
+    get_storage(exp_dir).append(config_name, vial, *current_config) # one line, values separated by commas
 
 def compare_configs(vial, current_config, config_name, exp_dir, ignore_time=True):
     """
@@ -66,16 +170,8 @@ def compare_configs(vial, current_config, config_name, exp_dir, ignore_time=True
     # Turn the current_config into a list of strings
     current_config = [str(config) for config in current_config]
 
-    # Open the config file
-    file_name = f"vial{vial}_{config_name}.txt"
-    if config_name == "gr":
-        config_name = "growthrate"
-    config_path = os.path.join(exp_dir, f'{config_name}', file_name)
-    with open(config_path, 'r') as file:
-        # Read all lines from the file
-        lines = file.readlines()
-        # Get the last line
-        last_config = lines[-1].strip().split(',')
+    # Get the last line of the config
+    last_config = get_storage(exp_dir).read_last_config(config_name, vial)
     
     # Check if config has changed
     if len(current_config) != len(last_config):
@@ -85,6 +181,53 @@ def compare_configs(vial, current_config, config_name, exp_dir, ignore_time=True
             return True
     return False # If the arrays are the same, return False
 
+# Last config written per vial, without the elapsed time:
+# {(experiment directory, config name): {vial: [values as str]}}
+_last_configs = {}
+
+def _last_config_key(exp_dir, config_name):
+    return (os.path.abspath(exp_dir), config_name)
+
+def remember_configs(exp_dir, config_name, rows):
+    """
+    Records configs just written, so the next comparison does not read them back.
+    Args:
+        rows (dict): Vial to its config values without the elapsed time.
+    """
+    last = _last_configs.setdefault(_last_config_key(exp_dir, config_name), {})
+    for vial, row in rows.items():
+        last[vial] = [str(value) for value in row]
+
+def changed_configs(exp_dir, config_name, vials, rows):
+    """
+    Compares new configs of many vials to the last ones written, ignoring the elapsed time,
+    in one array comparison. The last configs come from memory, read from the storage only
+    the first time (e.g. when continuing an experiment).
+    Args:
+        exp_dir (str): The experiment directory.
+        config_name (str): The name of the configuration.
+        vials (list): The vials of the rows.
+        rows (list): Each vial's new config values without the elapsed time; rows may differ
+            in length (e.g. selection steps).
+    Returns:
+        numpy.ndarray: Boolean array, True for the vials whose config changed.
+    """
+    last = _last_configs.setdefault(_last_config_key(exp_dir, config_name), {})
+    storage = get_storage(exp_dir)
+    for vial in vials:
+        if vial not in last:
+            last[vial] = storage.read_last_config(config_name, vial)[1:]
+    new_rows = [[str(value) for value in row] for row in rows]
+    last_rows = [last[vial] for vial in vials]
+    width = max([len(row) for row in new_rows + last_rows] + [0])
+    def padded(rows):
+        # None pads shorter rows, so a different length is a difference
+        table = np.full((len(rows), width), None, dtype=object)
+        for i, row in enumerate(rows):
+            table[i, :len(row)] = row
+        return table
+    return (padded(new_rows) != padded(last_rows)).any(axis=1)
+
 def update_config_files(vials, config, config_name, elapsed_time, logger, exp_dir):
     """
     Update configuration files for one configuration type for the given vials. If the configuration files do not exist, they are created. 
@@ -105,35 +248,35 @@ def update_config_files(vials, config, config_name, elapsed_time, logger, exp_di
     None
     """
     
-    config_directory = os.path.join(exp_dir, f'{config_name}')
+    storage = get_storage(exp_dir)
     config_copy = config.copy()
     
     updated_vials = [] # List of vials that have had their configs updated
+    values = config_copy.loc[vials].values.astype(str)[:, 1:] # all vials' configs without the vial column
 
     # Create config files if they do not exist
-    if not os.path.exists(config_directory):
-        os.makedirs(config_directory)
+    if not storage.exists(config_name):
         for vial in vials:
             vial_config = config_copy[config_copy['vial'] == vial] # get as DataFrame
             vial_config = vial_config.rename(columns={'vial': 'elapsed_time'}) # remove the vial column
             vial_config['elapsed_time'] = elapsed_time # add the elapsed time
-            vial_config.to_csv(os.path.join(config_directory, f'vial{vial}_{config_name}.txt'), header=True, index=False)
+            header, *records = vial_config.to_csv(header=True, index=False).splitlines()
+            storage.create_series(config_name, vial, header=[header], records=records)
             updated_vials.append(vial)
             print(f'Vial {vial}: updating {config_name} config')
             logger.info(f'Vial {vial}: updating {config_name} config')
+        _last_configs.pop(_last_config_key(exp_dir, config_name), None) # written by to_csv; read back once
 
-    # Compare the current config to the last line of the old config
+    # Compare the current configs to the last ones written, and append only the changed vials
     else:
-        for vial in vials:
-            current_config = config_copy.loc[vial].values.astype(str).tolist()
-            current_config[0] = elapsed_time # replace first value in current config with elapsed time
-            config_changed = compare_configs(vial, current_config, config_name, exp_dir, ignore_time=True) # compare the current config to the last line of the old config
-
-            if config_changed: # Update and log config change
-                update_config(vial, config_name, current_config, exp_dir)
-                print(f'Vial {vial}: updating {config_name} config')
-                logger.info(f'Vial {vial}: updating {config_name} config')
-                updated_vials.append(vial)
+        changed = changed_configs(exp_dir, config_name, vials, values)
+        for vial, row in zip(np.asarray(vials)[changed], values[changed]):
+            vial = int(vial)
+            update_config(vial, config_name, [elapsed_time] + row.tolist(), exp_dir)
+            print(f'Vial {vial}: updating {config_name} config')
+            logger.info(f'Vial {vial}: updating {config_name} config')
+            updated_vials.append(vial)
+        remember_configs(exp_dir, config_name, {int(vial): row for vial, row in zip(np.asarray(vials)[changed], values[changed])})
     return updated_vials
 
 if __name__ == '__main__':
@@ -0,0 +1,212 @@
+import os
+import json
+import math
+import socket
+import logging
+import threading
+from collections import deque
+
+import numpy as np
+
+# Written to the experiment directory so subscribers can find the bus
+ADDRESS_FILE = 'data_bus.json'
+
+logger = logging.getLogger('eVOLVER')
+
+#### MESSAGE ENCODING ####
+def _clean(value):
+    """
+    Converts numpy values to plain python and non-finite floats to None, so every
+    message is valid JSON for browsers.
+    """
+    if isinstance(value, np.ndarray):
+        value = value.tolist()
+    elif isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float):
+        return value if math.isfinite(value) else None
+    if isinstance(value, dict):
+        return {key: _clean(v) for key, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_clean(v) for v in value]
+    return value
+
+def encode_message(topic, elapsed_time, payload):
+    """
+    Encodes one bus message as a line of JSON.
+    Args:
+        topic (str): The kind of data, e.g. 'od', 'temp', 'gr', 'pump', 'step'.
+        elapsed_time (float): Experiment time in hours.
+        payload (dict): The data of the message.
+    Returns:
+        bytes: The newline terminated JSON message.
+    """
+    message = {'topic': topic, 'time': elapsed_time}
+    message.update(payload)
+    return (json.dumps(_clean(message)) + '\n').encode('utf-8')
+
+#### PUBLISHER ####
+class _Subscriber:
+    """
+    One connected subscriber. Messages are queued and sent from its own thread;
+    when the subscriber falls behind the oldest queued messages are dropped.
+    """
+    def __init__(self, conn, address, queue_size):
+        self.conn = conn
+        self.address = address
+        self.queue = deque(maxlen=queue_size)
+        self.dropped = 0
+        self.closed = False
+        self.ready = threading.Condition()
+        self.thread = threading.Thread(target=self._send, name=f'data-bus-{address}', daemon=True)
+        self.thread.start()
+
+    def put(self, message):
+        with self.ready:
+            if len(self.queue) == self.queue.maxlen:
+                self.dropped += 1
+            self.queue.append(message)
+            self.ready.notify()
+
+    def close(self):
+        with self.ready:
+            self.closed = True
+            self.ready.notify()
+
+    def _send(self):
+        try:
+            while True:
+                with self.ready:
+                    while not self.queue and not self.closed:
+                        self.ready.wait()
+                    if self.closed:
+                        return
+                    batch = b''.join(self.queue)
+                    self.queue.clear()
+                self.conn.sendall(batch)
+        except OSError:
+            pass
+        finally:
+            self.closed = True
+            try:
+                self.conn.close()
+            except OSError:
+                pass
+            if self.dropped:
+                logger.warning(f'data bus subscriber {self.address} dropped {self.dropped} messages')
+
+class DataBus:
+    """
+    Publishes live experiment data to any number of local subscribers over a
+    localhost socket, one JSON message per line. publish() only queues the
+    message, so slow or stuck subscribers never block the control loop.
+    """
+    def __init__(self, exp_dir, host='127.0.0.1', port=0, queue_size=1000):
+        self.exp_dir = exp_dir
+        self.host = host
+        self.port = port
+        self.queue_size = queue_size
+        self.address_path = os.path.join(exp_dir, ADDRESS_FILE)
+        self._server = None
+        self._subscribers = []
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Starts listening and writes the bus address to the experiment directory."""
+        self._server = socket.create_server((self.host, self.port))
+        self.port = self._server.getsockname()[1]
+        with open(self.address_path, 'w') as f:
+            json.dump({'host': self.host, 'port': self.port, 'pid': os.getpid()}, f)
+        threading.Thread(target=self._accept, name='data-bus', daemon=True).start()
+        logger.info(f'data bus listening on {self.host}:{self.port}')
+
+    def _accept(self):
+        while True:
+            try:
+                conn, address = self._server.accept()
+            except OSError:
+                return  # closed
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            subscriber = _Subscriber(conn, '{0}:{1}'.format(*address[:2]), self.queue_size)
+            with self._lock:
+                self._subscribers.append(subscriber)
+            logger.info(f'data bus subscriber connected: {subscriber.address}')
+
+    @property
+    def subscriber_count(self):
+        with self._lock:
+            return len([s for s in self._subscribers if not s.closed])
+
+    def publish(self, topic, elapsed_time, **payload):
+        """
+        Queues a message for every subscriber.
+        Args:
+            topic (str): The kind of data, e.g. 'od', 'temp', 'gr', 'pump', 'step'.
+            elapsed_time (float): Experiment time in hours.
+            **payload: The data of the message, JSON serializable or numpy values.
+        Returns:
+            None
+        """
+        with self._lock:
+            if not self._subscribers:
+                return
+            self._subscribers = [s for s in self._subscribers if not s.closed]
+            subscribers = list(self._subscribers)
+        message = encode_message(topic, elapsed_time, payload)
+        for subscriber in subscribers:
+            subscriber.put(message)
+
+    def close(self):
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+        with self._lock:
+            for subscriber in self._subscribers:
+                subscriber.close()
+            self._subscribers = []
+        try:
+            os.remove(self.address_path)
+        except OSError:
+            pass
+
+#### SUBSCRIBER ####
+def read_address(exp_dir):
+    """
+    Reads the address of a running experiment's data bus.
+    Returns:
+        tuple: (host, port), or None if the experiment is not publishing.
+    """
+    try:
+        with open(os.path.join(exp_dir, ADDRESS_FILE)) as f:
+            address = json.load(f)
+        return address['host'], address['port']
+    except (OSError, ValueError, KeyError):
+        return None
+
+def subscribe(exp_dir, timeout=None):
+    """
+    Yields the messages published by a running experiment as dicts.
+    Args:
+        exp_dir (str): The experiment directory.
+        timeout (float): Socket timeout in seconds; socket.timeout is raised when no
+            message arrives in time. None waits forever.
+    Raises:
+        ConnectionError: If the experiment is not publishing or the bus closes.
+    """
+    address = read_address(exp_dir)
+    if address is None:
+        raise ConnectionRefusedError(f'no data bus found in {exp_dir}')
+    with socket.create_connection(address, timeout=timeout) as conn:
+        buffer = b''
+        while True:
+            chunk = conn.recv(65536)
+            if not chunk:
+                raise ConnectionResetError('data bus closed')
+            buffer += chunk
+            *lines, buffer = buffer.split(b'\n')
+            for line in lines:
+                if line:
+                    yield json.loads(line)
+
+if __name__ == '__main__':
+    print('Please run eVOLVER.py instead')
@@ -1,66 +1,9 @@
 import numpy as np
-import os.path
-import pandas as pd
+import time
 
-#### FUNCTIONS FOR READING FILES ####
-def tail_to_np(path, window=10, BUFFER_SIZE=512):
-    """
-    Reads file from the end and returns a numpy array with the data of the last 'window' lines.
-    Alternative to np.genfromtxt(path) by loading only the needed lines instead of the whole file.
-    """
-    try:
-        f = open(path, 'rb')
-    except OSError as e:
-        print(f"Unable to open file: {path}\n\tError: {e}")
-        return np.asarray([])
-
-    if window == 0:
-        return np.asarray([])
-
-    f.seek(0, os.SEEK_END)
-    remaining_bytes = f.tell()
-    size = window + 1  # Read one more line to avoid broken lines
-    block = -1
-    data = []
-
-    while size > 0 and remaining_bytes > 0:
-        if remaining_bytes - BUFFER_SIZE > 0:
-            # Seek back one whole BUFFER_SIZE
-            f.seek(block * BUFFER_SIZE, os.SEEK_END)
-            # read BUFFER
-            bunch = f.read(BUFFER_SIZE)
-        else:
-            # file too small, start from beginning
-            f.seek(0, 0)
-            # only read what was not read
-            bunch = f.read(remaining_bytes)
-
-        bunch = bunch.decode('utf-8')
-        data.append(bunch)
-        size -= bunch.count('\n')
-        remaining_bytes -= BUFFER_SIZE
-        block -= 1
-
-    f.close()
-    data = ''.join(reversed(data)).splitlines()[-window:]
-
-    if len(data) < window:
-        # Not enough data
-        return np.asarray([])
-
-    for c, v in enumerate(data):
-        data[c] = v.split(',')
-
-    try:
-        data = np.asarray(data, dtype=np.float64)
-        return data
-    except:
-        try:
-            return np.asarray(data)
-        except e:
-            print(f"tail_to_np: Unable to read file as numpy array: {path}\n\tError: {e}")
-            return np.asarray([])
+from .storage import get_storage
 
+#### FUNCTIONS FOR READING FILES ####
 def get_last_n_lines(var_name, vial, n_lines, exp_dir):
     """
     Retrieves the last lines of the file for a given variable name and vial number.
@@ -71,24 +14,18 @@ def get_last_n_lines(var_name, vial, n_lines, exp_dir):
     Returns:
         numpy.ndarray: Returns the last n lines of the file.
     """
-    # Construct file name and path
-    file_name = f"vial{vial}_{var_name}.txt"
-    if var_name == "gr":
-        var_name = "growthrate"
-    file_path = os.path.join(exp_dir, f'{var_name}', file_name)
-
+    storage = get_storage(exp_dir)
     try:
-        data = tail_to_np(file_path, n_lines)
+        data = storage.read_tail(var_name, vial, n_lines)
         if data.ndim == 0:
             return data[0]
         return data
     except Exception as e:
-        print(f"Unable to read file using tail_to_np: {file_path}.\n\tError: {e}")
+        print(f"Unable to read the last lines of {var_name} for vial {vial}.\n\tError: {e}")
         try:
-            data = np.genfromtxt(file_path, delimiter=',', skip_header=0)  # Adjust delimiter as necessary
-            return data[-n_lines:]
+            return storage.read_range(var_name, vial)[-n_lines:]
         except Exception as e:
-            print(f"Unable to read file using np.genfromtxt: {file_path}.\n\tError: {e}")
+            print(f"Unable to read {var_name} for vial {vial}.\n\tError: {e}")
             return np.asarray([])
         
 def labeled_last_n_lines(var_name, vial, n_lines, exp_dir):
@@ -101,17 +38,27 @@ def labeled_last_n_lines(var_name, vial, n_lines, exp_dir):
     Returns:
         pd.DataFrame: The last n lines of the variable, with headers.
     """
-    file_name = f"vial{vial}_{var_name}.txt"
-    path = os.path.join(exp_dir, var_name, file_name)
-
-    with open(path, 'r') as file:
-        heading = file.readline().strip().split(',')
-    
+    import pandas as pd # imported on first use, see utils/__init__.py
+    heading = get_storage(exp_dir).read_header(var_name, vial)
     data = get_last_n_lines(var_name, vial, n_lines, exp_dir)
     if data.ndim == 0:
         return pd.DataFrame(data, columns=[heading])
     return pd.DataFrame(data, columns=heading)
 
+def labeled_last_config(var_name, vial, exp_dir):
+    """
+    Gets the last line of a config, labeled with the header from the CSV file. Cheaper than
+    labeled_last_n_lines(var_name, vial, 1, exp_dir) when called every broadcast: no DataFrame is built.
+    Args:
+        var_name (str): The name of the config, e.g. 'selection-control'.
+        vial (int): The vial number.
+        exp_dir (str): The experiment directory.
+    Returns:
+        dict: Column name to its value, as a string.
+    """
+    storage = get_storage(exp_dir)
+    return dict(zip(storage.read_header(var_name, vial), storage.read_last_config(var_name, vial)))
+
 #### FUNCTIONS FOR WRITING FILES ####
 def update_log(vial, log_name, elapsed_time, message, exp_dir):
     """
@@ -125,11 +72,127 @@ def update_log(vial, log_name, elapsed_time, message, exp_dir):
     Returns:
         None
     """
-    file_name = f"vial{vial}_{log_name}.txt"
-    file_path = os.path.join(exp_dir, log_name, file_name)
-    
-    with open(file_path, "a+") as text_file:
-        text_file.write(f"{elapsed_time},{message}\n")
+    get_storage(exp_dir).append(log_name, vial, elapsed_time, message)
+
+#### DILUTION SUMMARY ####
+DILUTION_SUMMARY_FILE = 'dilution_summary.json'
+SUMMARY_FIELDS = ['influx_s', 'efflux_s', 'influx_ml', 'efflux_ml', 'dilutions',
+                  'selection_s', 'selection_ml', 'selection_additions', 'odset_changes']
+
+def read_dilution_summary(exp_dir):
+    """
+    Reads the per-vial dilution summary maintained by the DPU.
+    Args:
+        exp_dir (str): The experiment directory.
+    Returns:
+        dict: {'vials': {vial (str): {field: value}}, 'updated': wall clock time}, or None if there is no summary.
+    """
+    return get_storage(exp_dir).read_json(DILUTION_SUMMARY_FILE)
+
+def _write_dilution_summary(summary, exp_dir):
+    summary['updated'] = time.time()
+    get_storage(exp_dir).write_json(DILUTION_SUMMARY_FILE, summary) # readers never see a partially written summary
+
+def _empty_vial_summary():
+    summary = {field: 0 for field in SUMMARY_FIELDS}
+    summary['last_event'] = None
+    summary['last_event_time'] = None
+    summary['last_dilution_time'] = None
+    return summary
+
+def create_dilution_summary(vials, exp_dir):
+    """
+    Creates an empty dilution summary for a new experiment.
+    Args:
+        vials (list): The vial numbers.
+        exp_dir (str): The experiment directory.
+    Returns:
+        None
+    """
+    _write_dilution_summary({'vials': {str(vial): _empty_vial_summary() for vial in vials}}, exp_dir)
+
+def _read_log_values(storage, name, vial, skip_lines=2):
+    """Reads the 'elapsed_time,value' rows of a log after its header lines."""
+    lines = storage.read_lines(name, vial)[skip_lines:]
+    rows = [line.split(',')[:2] for line in lines if line.strip()]
+    return np.asarray(rows, dtype=float).reshape(-1, 2)
+
+def rebuild_dilution_summary(exp_dir, flow_rate):
+    """
+    Rebuilds the dilution summary from the pump logs and ODset files, for experiments started without one.
+    Efflux times are not logged, so they only count from the rebuild on.
+    Args:
+        exp_dir (str): The experiment directory.
+        flow_rate (list): Flow rates of all 48 pumps in mL/s.
+    Returns:
+        dict: The rebuilt summary, also written to the experiment directory.
+    """
+    summary = {'vials': {}}
+    storage = get_storage(exp_dir)
+    for vial in storage.vials('pump_log'):
+        vial_summary = _empty_vial_summary()
+        pump_log = _read_log_values(storage, 'pump_log', vial)
+        if len(pump_log):
+            vial_summary['influx_s'] = float(np.nansum(pump_log[:, 1]))
+            vial_summary['influx_ml'] = vial_summary['influx_s'] * flow_rate[vial]
+            vial_summary['dilutions'] = len(pump_log)
+            vial_summary['last_event'] = float(pump_log[-1, 0])
+            vial_summary['last_event_time'] = storage.last_modified('pump_log', vial)
+            vial_summary['last_dilution_time'] = vial_summary['last_event_time'] # only dilutions are in the pump log
+        if storage.exists('slow_pump_log', vial):
+            slow_log = _read_log_values(storage, 'slow_pump_log', vial)
+            vial_summary['selection_s'] = float(np.nansum(slow_log[:, 1]))
+            vial_summary['selection_ml'] = vial_summary['selection_s'] * flow_rate[vial + 32]
+            vial_summary['selection_additions'] = len(slow_log)
+        if storage.exists('ODset', vial):
+            vial_summary['odset_changes'] = max(len(storage.read_lines('ODset', vial)) - 2, 0)
+        summary['vials'][str(vial)] = vial_summary
+    _write_dilution_summary(summary, exp_dir)
+    return summary
+
+def update_dilution_summary(vial, elapsed_time, exp_dir, flow_rate=None, influx_s=0, efflux_s=0, selection_s=0, odset_change=False):
+    """
+    Adds one pump or ODset event to the dilution summary, so readers never need to parse the full logs.
+    Call alongside the corresponding pump_log, slow_pump_log or ODset append.
+    Args:
+        vial (int): The vial number.
+        elapsed_time (float): The elapsed time of the event.
+        exp_dir (str): The experiment directory.
+        flow_rate (list): Flow rates of all 48 pumps in mL/s; required for pump events.
+        influx_s (float): Seconds the influx pump ran (a dilution when > 0).
+        efflux_s (float): Seconds the efflux pump ran.
+        selection_s (float): Seconds the slow (selection chemical) pump ran.
+        odset_change (bool): Whether an ODset line was appended (two per growth curve).
+    Returns:
+        None
+    """
+    summary = read_dilution_summary(exp_dir)
+    if summary is None:
+        # Experiment started without a summary: rebuild it from the logs once a flow rate
+        # is known. The current event is already in the logs, so it is counted there.
+        if flow_rate is not None and get_storage(exp_dir).exists('pump_log'):
+            rebuild_dilution_summary(exp_dir, flow_rate)
+        return
+    vial_summary = summary['vials'].setdefault(str(vial), _empty_vial_summary())
+
+    now = time.time()
+    if influx_s:
+        vial_summary['last_dilution_time'] = now
+        vial_summary['influx_s'] += influx_s
+        vial_summary['influx_ml'] += influx_s * flow_rate[vial]
+        vial_summary['dilutions'] += 1
+    if efflux_s:
+        vial_summary['efflux_s'] += efflux_s
+        vial_summary['efflux_ml'] += efflux_s * flow_rate[vial + 16]
+    if selection_s:
+        vial_summary['selection_s'] += selection_s
+        vial_summary['selection_ml'] += selection_s * flow_rate[vial + 32]
+        vial_summary['selection_additions'] += 1
+    if odset_change:
+        vial_summary['odset_changes'] += 1
+    vial_summary['last_event'] = elapsed_time
+    vial_summary['last_event_time'] = now
+    _write_dilution_summary(summary, exp_dir)
 
 if __name__ == '__main__':
     print('Please run eVOLVER.py instead')
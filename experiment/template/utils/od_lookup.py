@@ -0,0 +1,154 @@
+import json
+import numpy as np
+
+from .storage import get_storage
+
+# OD photodiode readings are 16-bit ADC values
+ADC_MAX = 65535
+
+SIGMOID = 'sigmoid'
+THREE_DIMENSION = '3d'
+
+#### ANALYTIC CALIBRATION ####
+def sigmoid_od(raw, coefficients):
+    """
+    Inverse of the sigmoid calibration, vectorized.
+    Args:
+        raw (array-like): Photodiode readings.
+        coefficients (array-like): [a, b, c, d] of one vial, or an array of shape (..., 4)
+            broadcasting against raw.
+    Returns:
+        numpy.ndarray: OD values, NaN where the reading is outside the calibrated range.
+    """
+    raw = np.asarray(raw, dtype=float)
+    a, b, c, d = np.moveaxis(np.asarray(coefficients, dtype=float), -1, 0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        od = np.real(c - np.log10((b - a) / (raw - a) - 1) / d)
+    return np.where(np.isfinite(od), od, np.nan)
+
+def three_dim_od(raw, raw_2, coefficients):
+    """
+    The 3d (two photodiode) calibration polynomial, vectorized.
+    Args:
+        raw (array-like): Readings of the first param (e.g. od_90).
+        raw_2 (array-like): Readings of the second param (e.g. od_135).
+        coefficients (array-like): [c0, ..., c5] of one vial, or an array of shape (..., 6).
+    Returns:
+        numpy.ndarray: OD values.
+    """
+    x = np.asarray(raw, dtype=float)
+    y = np.asarray(raw_2, dtype=float)
+    c0, c1, c2, c3, c4, c5 = np.moveaxis(np.asarray(coefficients, dtype=float), -1, 0)
+    return c0 + c1 * x + c2 * y + c3 * x ** 2 + c4 * x * y + c5 * y ** 2
+
+#### LOOKUP TABLES ####
+class ODLookup:
+    """
+    OD calibration compiled into per-vial lookup tables.
+
+    Sigmoid fits get a dense table over every ADC value, so integer readings are a
+    gather and give exactly the analytic result. 3d fits get a coarse grid over both
+    readings with bilinear interpolation. Readings the tables do not cover (not
+    integers, or outside the ADC range) fall back to the analytic calibration.
+    """
+    def __init__(self, od_cal, grid_step=256):
+        self.type = od_cal['type']
+        self.coefficients = np.asarray(od_cal['coefficients'], dtype=float)
+        self.grid_step = grid_step
+        if self.type == SIGMOID:
+            adc = np.arange(ADC_MAX + 1, dtype=float)
+            self.table = sigmoid_od(adc[None, :], self.coefficients[:, None, :])
+        elif self.type == THREE_DIMENSION:
+            self.grid = np.arange(0, ADC_MAX + grid_step, grid_step, dtype=float)
+            x, y = np.meshgrid(self.grid, self.grid, indexing='ij')
+            self.table = three_dim_od(x[None], y[None], self.coefficients[:, None, None, :])
+        else:
+            raise ValueError('OD calibration of type {0} is not supported'.format(self.type))
+
+    def transform(self, raw, raw_2=None, vials=None):
+        """
+        Converts readings to OD.
+        Args:
+            raw (array-like): Readings, shape (vials,) for one broadcast or (vials, n) for a
+                series per vial.
+            raw_2 (array-like): Readings of the second param for 3d calibrations, same shape.
+            vials (array-like): Vial of each row of raw; defaults to 0..len(raw)-1.
+        Returns:
+            numpy.ndarray: OD values with the shape of raw.
+        """
+        raw = np.asarray(raw, dtype=float)
+        vials = np.arange(len(raw)) if vials is None else np.asarray(vials)
+        vials = vials.reshape(vials.shape + (1,) * (raw.ndim - vials.ndim))
+        if self.type == SIGMOID:
+            return self._sigmoid(raw, np.broadcast_to(vials, raw.shape))
+        return self._three_dim(raw, np.asarray(raw_2, dtype=float), np.broadcast_to(vials, raw.shape))
+
+    def _sigmoid(self, raw, vials):
+        covered = np.isfinite(raw) & (raw >= 0) & (raw <= ADC_MAX) & (raw == np.round(raw))
+        od = np.full(raw.shape, np.nan)
+        od[covered] = self.table[vials[covered], raw[covered].astype(int)]
+        outside = ~covered & np.isfinite(raw)
+        if outside.any():
+            od[outside] = sigmoid_od(raw[outside], self.coefficients[vials[outside]])
+        return od
+
+    def _three_dim(self, raw, raw_2, vials):
+        covered = np.isfinite(raw) & np.isfinite(raw_2) & (raw >= 0) & (raw <= ADC_MAX) & (raw_2 >= 0) & (raw_2 <= ADC_MAX)
+        od = three_dim_od(raw, raw_2, self.coefficients[vials]) if not covered.all() else np.empty(raw.shape)
+        if covered.any():
+            x = raw[covered] / self.grid_step
+            y = raw_2[covered] / self.grid_step
+            i = np.minimum(x.astype(int), len(self.grid) - 2)
+            j = np.minimum(y.astype(int), len(self.grid) - 2)
+            fx, fy = x - i, y - j
+            table = self.table[vials[covered]]
+            rows = np.arange(len(i))
+            od[covered] = ((1 - fx) * (1 - fy) * table[rows, i, j] + fx * (1 - fy) * table[rows, i + 1, j] +
+                           (1 - fx) * fy * table[rows, i, j + 1] + fx * fy * table[rows, i + 1, j + 1])
+        return od
+
+_lookups = {}
+
+def get_lookup(od_cal, grid_step=256):
+    """
+    Compiled lookup for a calibration, built once per distinct fit.
+    Returns:
+        ODLookup: The lookup, or None if the calibration type is not supported.
+    """
+    key = json.dumps([od_cal.get('type'), od_cal.get('coefficients'), grid_step])
+    if key not in _lookups:
+        try:
+            _lookups.clear()  # only the active calibration is kept
+            _lookups[key] = ODLookup(od_cal, grid_step)
+        except (ValueError, KeyError, TypeError):
+            return None
+    return _lookups[key]
+
+#### BULK RECALIBRATION ####
+def recalibrate_od(exp_dir, od_cal, vial, grid_step=256):
+    """
+    Recomputes a vial's OD history from its stored raw readings with a (new) calibration.
+    Args:
+        exp_dir (str): The experiment directory.
+        od_cal (dict): The OD calibration, as in od_cal.json.
+        vial (int): The vial number.
+    Returns:
+        numpy.ndarray: (n, 2) array of [elapsed time, OD]. Blanking (OD_initial) is not applied.
+    """
+    params = od_cal['params']
+    storage = get_storage(exp_dir)
+    series = []
+    for param in params[:2 if od_cal['type'] == THREE_DIMENSION else 1]:
+        series.append(storage.read_range(f'{param}_raw', vial)[:, :2].reshape(-1, 2))
+    times = series[0][:, 0]
+    raw_2 = None
+    if len(series) > 1:
+        n = min(len(series[0]), len(series[1]))
+        times = times[:n]
+        series = [s[:n] for s in series]
+        raw_2 = series[1][:, 1][None]
+    od = get_lookup(od_cal, grid_step).transform(series[0][:, 1][None], raw_2, vials=[vial])[0]
+    return np.column_stack([times, od])
+
+if __name__ == '__main__':
+    print('Please run eVOLVER.py instead')
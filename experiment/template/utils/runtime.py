@@ -0,0 +1,234 @@
+import sys
+import queue
+import signal
+import asyncio
+import logging
+import threading
+import concurrent.futures
+
+logger = logging.getLogger('eVOLVER')
+
+class SocketThread(threading.Thread):
+    """
+    Owns the SocketIO connection. socketIO_client is blocking, so this thread waits on the
+    socket (broadcasts are handled here, as they arrive) and performs the connects and
+    disconnects the event loop asks for. While disconnected it sleeps until asked to connect.
+    """
+    WAIT_SECONDS = 1 # longest wait on the socket before looking at requests
+
+    def __init__(self, socketIO, on_error):
+        super().__init__(name='socketIO', daemon=True)
+        self.socketIO = socketIO
+        self.on_error = on_error
+        self.requests = queue.Queue()
+        self.wakeup = threading.Event()
+        self.listening = True # connected when the experiment starts
+        self.stopped = False
+
+    def request(self, action):
+        """
+        Asks for 'connect', 'disconnect', 'reconnect' or 'stop'.
+        Returns:
+            concurrent.futures.Future: Done once the action has been performed.
+        """
+        future = concurrent.futures.Future()
+        self.requests.put((action, future))
+        self.wakeup.set()
+        if self.stopped:
+            self._drain()
+        return future
+
+    def run(self):
+        try:
+            while self._handle_requests():
+                if self.listening:
+                    self.socketIO.wait(seconds=self.WAIT_SECONDS)
+                else:
+                    self.wakeup.wait()
+                    self.wakeup.clear()
+        except Exception as e:
+            self.on_error(e)
+        finally:
+            self.stopped = True
+            self._drain()
+
+    def _drain(self):
+        # requests made after the thread stopped are not performed
+        while True:
+            try:
+                action, future = self.requests.get_nowait()
+            except queue.Empty:
+                return
+            if not future.done():
+                future.set_result(None)
+
+    def _handle_requests(self):
+        while True:
+            try:
+                action, future = self.requests.get_nowait()
+            except queue.Empty:
+                return True
+            try:
+                if action in ('disconnect', 'reconnect', 'stop') and self.listening:
+                    self.socketIO.disconnect()
+                    self.listening = False
+                if action in ('connect', 'reconnect'):
+                    self.socketIO.connect()
+                    self.listening = True
+                future.set_result(action)
+            except Exception as e:
+                future.set_exception(e)
+            if action == 'stop':
+                return False
+
+class ExperimentRuntime:
+    """
+    Event loop of a running experiment. Socket events, commands from the eVOLVER app on stdin
+    ('pause-script', 'continue-script', 'stop-script'), reconnects, and Ctrl-C and SIGTERM
+    are all handled as they happen on one asyncio loop; nothing polls.
+
+    Broadcasts are processed on the socket thread under self.lock, and commands take the
+    same lock, so a pause never interleaves with a broadcast. Commands to the eVOLVER (e.g.
+    stopping the pumps) are emitted right away.
+
+    The connection is only reset when the namespace's broadcast_lag (see
+    utils.broadcast_lag) reports a backlog it cannot work off; a reset drops the queued
+    broadcasts, so it is never done preventively.
+    """
+    def __init__(self, socketIO, namespace, stdin=None):
+        self.socketIO = socketIO
+        self.namespace = namespace
+        self.stdin = stdin if stdin is not None else sys.stdin
+        self.lock = threading.Lock()
+        self.paused = False
+        self.interrupted = False # paused by Ctrl-C, waiting for enter or a second Ctrl-C
+        self.loop = None
+        self.socket_thread = None
+        self.finished = None
+
+    def run(self):
+        """Runs the experiment until it is stopped; returns the error that stopped it, if any."""
+        return asyncio.run(self.main())
+
+    async def main(self):
+        self.loop = asyncio.get_running_loop()
+        self.finished = self.loop.create_future()
+
+        # socketIO_client looks up on_<event> handlers on the namespace instance
+        handle_broadcast = self.namespace.on_broadcast
+        def on_broadcast(data):
+            with self.lock:
+                if not self.paused: # drop broadcasts that were already queued when pausing
+                    handle_broadcast(data)
+            lag = getattr(self.namespace, 'broadcast_lag', None)
+            if lag is not None and lag.reconnect_due():
+                self.loop.call_soon_threadsafe(asyncio.ensure_future, self.reconnect(lag.queue_lag))
+        self.namespace.on_broadcast = on_broadcast
+
+        self.socket_thread = SocketThread(self.socketIO, self._socket_error)
+        self.socket_thread.start()
+        self._install_signal_handlers()
+        commands = asyncio.create_task(self._read_commands())
+        try:
+            return await self.finished
+        finally:
+            commands.cancel()
+            self._remove_signal_handlers()
+            await asyncio.wrap_future(self.socket_thread.request('stop'))
+            self.namespace.on_broadcast = handle_broadcast
+
+    def finish(self, error=None):
+        if not self.finished.done():
+            self.finished.set_result(error)
+
+    #### EVENTS ####
+    async def _read_commands(self):
+        # a daemon thread reads stdin, so a pending read never holds up the exit
+        lines = asyncio.Queue()
+        def read_lines():
+            for line in iter(self.stdin.readline, ''):
+                self.loop.call_soon_threadsafe(lines.put_nowait, line)
+        threading.Thread(target=read_lines, name='stdin', daemon=True).start()
+        while True:
+            await self.handle_command(await lines.get())
+
+    async def handle_command(self, message):
+        if 'stop-script' in message:
+            logger.info('Stop message received - halting all pumps')
+            await self.pause()
+        elif 'pause-script' in message:
+            print('Pausing experiment', flush = True)
+            logger.info('Pausing experiment in dpu')
+            await self.pause()
+        elif 'continue-script' in message:
+            print('Restarting experiment', flush = True)
+            logger.info('Restarting experiment')
+            await self.resume()
+        elif self.interrupted:
+            # enter pressed after Ctrl-C
+            logger.warning('resuming experiment')
+            await self.resume()
+
+    def _interrupt(self):
+        if self.interrupted:
+            print('Second Ctrl-C detected, shutting down')
+            logger.warning('second interrupt received, terminating '
+                           'experiment')
+            self.finish()
+            return
+        print('Ctrl-C detected, pausing experiment')
+        logger.warning('interrupt received, pausing experiment')
+        self.interrupted = True
+        asyncio.ensure_future(self.pause())
+        print('Experiment paused. Press enter key to restart '
+              ' or hit Ctrl-C again to terminate experiment', flush = True)
+
+    def _terminate(self):
+        logger.warning('termination signal received, stopping experiment')
+        self.finish()
+
+    def _socket_error(self, error):
+        self.loop.call_soon_threadsafe(self.finish, error)
+
+    #### ACTIONS ####
+    async def pause(self):
+        """Stops the pumps and the broadcasts."""
+        self.paused = True
+        await self.loop.run_in_executor(None, self._locked, self.namespace.stop_exp)
+        await asyncio.wrap_future(self.socket_thread.request('disconnect'))
+
+    async def reconnect(self, queue_lag):
+        """Resets the connection to drop a backlog of broadcasts."""
+        if self.paused:
+            return
+        logger.warning('broadcasts are %.0f s behind, resetting connection to '
+                       'eVOLVER to drop the backlog' % queue_lag)
+        await asyncio.wrap_future(self.socket_thread.request('reconnect'))
+
+    async def resume(self):
+        self.paused = False
+        self.interrupted = False
+        await asyncio.wrap_future(self.socket_thread.request('connect'))
+
+    def _locked(self, function):
+        with self.lock:
+            return function()
+
+    #### SIGNALS ####
+    def _install_signal_handlers(self):
+        for signum, handler in [(signal.SIGINT, self._interrupt), (signal.SIGTERM, self._terminate)]:
+            try:
+                self.loop.add_signal_handler(signum, handler)
+            except (NotImplementedError, RuntimeError):
+                # e.g. Windows: plain handlers, which wake the loop up
+                signal.signal(signum, lambda *args, handler=handler: self.loop.call_soon_threadsafe(handler))
+
+    def _remove_signal_handlers(self):
+        for signum in [signal.SIGINT, signal.SIGTERM]:
+            try:
+                self.loop.remove_signal_handler(signum)
+            except (NotImplementedError, RuntimeError):
+                signal.signal(signum, signal.default_int_handler if signum == signal.SIGINT else signal.SIG_DFL)
+
+if __name__ == '__main__':
+    print('Please run eVOLVER.py instead')
@@ -0,0 +1,131 @@
+import numpy as np
+
+from .clock import VirtualClock
+from .storage import get_storage
+
+DPU_NAMESPACE = '/dpu-evolver'
+BROADCAST_INTERVAL = 20 # seconds between two broadcasts of the eVOLVER server
+
+class ScriptedBroadcasts:
+    """
+    Stands in for the SocketIO connection to the eVOLVER server: delivers scripted broadcasts
+    to an EvolverNamespace on a virtual clock, and records the commands the namespace sends.
+    The experiment code runs unmodified, as fast as it can process the broadcasts.
+
+    Like the server, it keeps the recurring config (temp, stir, pump) last commanded and
+    sends it with every broadcast, and answers calibration requests if given calibrations.
+
+    Example (a soak test replaying the raw readings of a previous experiment):
+        clock = VirtualClock()
+        source = ScriptedBroadcasts(replay_broadcasts(old_exp_dir, ['od_135', 'temp']), clock,
+                                    calibrations=calibrations)
+        namespace = source.define(eVOLVER.EvolverNamespace)
+        namespace.start_time = namespace.initialize_exp(eVOLVER.VIALS, None, log_name, True, 0,
+                                                        'scripted', always_yes=True)
+        source.run(hours=72)
+    """
+    def __init__(self, broadcasts, clock=None, interval=BROADCAST_INTERVAL, calibrations=None, vials=16):
+        """
+        Args:
+            broadcasts: Iterable of broadcast dicts ({'data': {param: [16 values]}}, optionally
+                with a 'config' and a 'timestamp'), or a function called with this source before every broadcast
+                that returns the next one, or None to end the script.
+            clock (VirtualClock): Clock shared with the namespace; a new one if None.
+            interval (float): Seconds of clock time between broadcasts.
+            calibrations (list): Active calibrations to answer 'getactivecal' with, as sent
+                by the server.
+            vials (int): Number of vials.
+        """
+        self.broadcasts = broadcasts
+        self.clock = clock if clock is not None else VirtualClock()
+        self.interval = interval
+        self.calibrations = calibrations
+        self.namespace = None
+        self.commands = [] # (clock time, event, data) of everything emitted
+        self.config = {'temp': {'value': ['0'] * vials},
+                       'stir': {'value': ['0'] * vials},
+                       'pump': {'value': ['--'] * (3 * vials)}}
+        self.delivered = 0
+        self._iterator = None
+
+    def define(self, namespace_class, path=DPU_NAMESPACE):
+        """Creates the namespace on this source, as SocketIO.define does, using its clock."""
+        self.namespace = namespace_class(self, path)
+        self.namespace.clock = self.clock
+        return self.namespace
+
+    def emit(self, event, *args, **kw):
+        data = args[0] if args else None
+        self.commands.append((self.clock.time(), event, data))
+        if event == 'command' and data.get('recurring') and data.get('param') in self.config:
+            self.config[data['param']] = {'value': list(data['value'])}
+        elif event == 'getactivecal' and self.calibrations is not None:
+            self.namespace.on_activecalibrations(self.calibrations)
+
+    def next_broadcast(self):
+        if callable(self.broadcasts):
+            return self.broadcasts(self)
+        if self._iterator is None:
+            self._iterator = iter(self.broadcasts)
+        return next(self._iterator, None)
+
+    def deliver(self, broadcast):
+        """
+        Sends one broadcast to the namespace, with the current config unless it has its own,
+        stamped with the clock time unless it has a 'timestamp' (e.g. to script a backlog).
+        """
+        data = dict(broadcast)
+        data.setdefault('timestamp', self.clock.time())
+        config = {param: dict(value) for param, value in self.config.items()}
+        config.update(broadcast.get('config', {}))
+        data['config'] = config
+        self.namespace.on_broadcast(data)
+        self.delivered += 1
+
+    def run(self, hours=None, count=None):
+        """
+        Delivers broadcasts, advancing the clock by the interval before each one, until the
+        script ends, the given hours of clock time have passed or count broadcasts were sent.
+        Returns:
+            int: Number of broadcasts delivered.
+        """
+        end = None if hours is None else self.clock.time() + hours * 3600
+        delivered = 0
+        while count is None or delivered < count:
+            if end is not None and self.clock.time() + self.interval > end:
+                break
+            broadcast = self.next_broadcast()
+            if broadcast is None:
+                break
+            self.clock.advance(self.interval)
+            self.deliver(broadcast)
+            delivered += 1
+        return delivered
+
+    def sent_commands(self, param=None):
+        """Commands ('command' events) sent so far, optionally only those for a param."""
+        return [(sent_time, data) for sent_time, event, data in self.commands
+                if event == 'command' and (param is None or data.get('param') == param)]
+
+def replay_broadcasts(exp_dir, params, vials=range(16)):
+    """
+    Broadcasts rebuilt from the raw readings an experiment stored (e.g. od_135_raw, temp_raw).
+    Args:
+        exp_dir (str): The recorded experiment directory.
+        params (list): Raw params to replay, e.g. ['od_135', 'temp'].
+        vials (iterable): Vials to replay; the experiment must have recorded all of them.
+    Returns:
+        generator: One broadcast dict per recorded reading, oldest first.
+    """
+    storage = get_storage(exp_dir)
+    readings = {}
+    for param in params:
+        series = [storage.read_range(f'{param}_raw', vial)[:, 1] for vial in vials]
+        n = min(len(s) for s in series)
+        readings[param] = np.array([s[:n] for s in series])
+    n = min(values.shape[1] for values in readings.values())
+    for i in range(n):
+        yield {'data': {param: [str(value) for value in values[:, i]] for param, values in readings.items()}}
+
+if __name__ == '__main__':
+    print('Please run eVOLVER.py instead')
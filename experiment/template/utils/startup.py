@@ -0,0 +1,47 @@
+import time
+
+class StartupReport:
+    """
+    Times the startup of an experiment, phase by phase, from launch until the first
+    broadcast is processed. Marking a phase again adds to its time, e.g. while broadcasts
+    are skipped because the calibrations are not in yet.
+    """
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.last = self.start
+        self.phases = {} # phase name: seconds, in the order first marked
+        self.finished = False
+        self.verbose = False # print the report as well as logging it
+
+    def mark(self, phase):
+        """Ends a phase: the time since the previous mark is added to it."""
+        if self.finished:
+            return
+        now = time.perf_counter()
+        self.phases[phase] = self.phases.get(phase, 0) + now - self.last
+        self.last = now
+
+    def finish(self, phase):
+        """Marks the last phase; later marks are ignored."""
+        self.mark(phase)
+        self.finished = True
+
+    def total(self):
+        return self.last - self.start
+
+    def report(self):
+        """
+        Returns:
+            str: One line per phase with its duration and share of the total.
+        """
+        total = self.total()
+        width = max([len(phase) for phase in self.phases] + [len('total')])
+        lines = ['Startup times:']
+        for phase, seconds in self.phases.items():
+            share = 100 * seconds / total if total > 0 else 0
+            lines.append(f'  {phase:<{width}}  {seconds:7.2f} s  {share:5.1f}%')
+        lines.append(f'  {"total":<{width}}  {total:7.2f} s')
+        return '\n'.join(lines)
+
+if __name__ == '__main__':
+    print('Please run eVOLVER.py instead')
@@ -1,25 +1,97 @@
 import os
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
-import matplotlib.pyplot as plt
 from . import file_utils as fu
 from . import config_utils as cu
+from .storage import get_storage
 
-def update_selection_configs(elapsed_time, vials, configs, logger, eVOLVER):
+logger = logging.getLogger(__name__)
+
+def update_selection_configs(elapsed_time, vials, configs, logger, eVOLVER, stop_on_error=True):
     """
     Updates selection configs for the given vials and automatically generates new steps if necessary.
+    The steps are worked out first, so an invalid config is rejected before anything is written.
     
     Parameters:
         elapsed_time (float): The elapsed time since the start of the experiment.
         vials (list): A list of vials to update the configs for.
         configs (dict): A dictionary containing configuration data for 'selection-control' and 'selection-step_generation'.
+        stop_on_error (bool): Stop the experiment before raising for an invalid config. A hot
+            reload (see ConfigWatcher) keeps running on the previous configs instead.
     Returns:
-        None
+        list: Vials whose selection steps were updated.
+    Raises:
+        ValueError: If a vial's selection steps cannot be worked out from the configs.
     """
     exp_dir = eVOLVER.exp_dir
+    try:
+        selection_steps, selection_units = selection_steps_for(vials, configs, logger)
+    except ValueError:
+        if stop_on_error:
+            eVOLVER.stop_exp()
+            print('Experiment stopped, goodbye!')
+            logger.warning('experiment stopped, goodbye!')
+        raise
     cu.update_config_files(vials, configs['selection-control'], 'selection-control', elapsed_time, logger, exp_dir) # Update the selection control configs
     cu.update_config_files(vials, configs['selection-step_generation'], 'selection-step_generation', elapsed_time, logger, exp_dir) # Update the selection step generation configs
 
-    update_steps(vials, configs, elapsed_time, logger, eVOLVER)
+    # Update the selection step configuration
+    return update_step_configs(vials, selection_steps, 'selection-steps', selection_units, elapsed_time, logger, eVOLVER)
+
+class ConfigWatcher:
+    """
+    Applies edits of the Excel configs during an experiment, without a restart.
+
+    check() is called before each broadcast is processed and only stats the workbook; when
+    it changed, the configs are reloaded and passed through update_selection_configs, which
+    appends a config line only for the vials whose configs differ. Controllers read the
+    configs from the experiment data each broadcast, so they pick up the change right away.
+    """
+    def __init__(self, config_filename, vials, logger, eVOLVER):
+        self.config_filename = config_filename
+        self.vials = vials
+        self.logger = logger
+        self.eVOLVER = eVOLVER
+        self.signature = self._signature()
+
+    def _signature(self):
+        try:
+            stat = os.stat(self.config_filename)
+        except OSError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def check(self, elapsed_time):
+        """
+        Reloads the configs if the workbook changed since the last check.
+        Returns:
+            list: Vials whose selection steps changed; empty if nothing was reloaded.
+        """
+        signature = self._signature()
+        if signature is None or signature == self.signature:
+            return []
+        # recorded before loading: a workbook that fails to load is not parsed again until it
+        # changes again, e.g. when a save that was in progress completes
+        self.signature = signature
+        try:
+            configs = cu.load_excel_configs(self.config_filename)
+        except Exception as e:
+            self.logger.warning(f'could not reload {self.config_filename}, waiting for it to be saved again: {e}')
+            return []
+        self.logger.info(f'reloading configs from {self.config_filename}')
+        try:
+            updated_vials = update_selection_configs(elapsed_time, self.vials, configs, self.logger, self.eVOLVER,
+                                                     stop_on_error=False)
+        except Exception as e:
+            # a bad edit must not stop the experiment: keep the previous configs until the
+            # workbook is saved again
+            self.logger.error(f'rejected the configs in {self.config_filename}, keeping the previous ones: {e}')
+            print(f'Rejected the configs in {self.config_filename}, keeping the previous ones: {e}', flush = True)
+            return []
+        plot_steps(self.vials, 'selection-steps', 'Selection', self.eVOLVER.exp_dir, updated_vials)
+        return updated_vials
 
 def update_steps(vials, configs, elapsed_time, logger, eVOLVER):
     """
@@ -31,7 +103,23 @@ def update_steps(vials, configs, elapsed_time, logger, eVOLVER):
         elapsed_time (float): The elapsed time since the start of the experiment.
         logger (logging.Logger): Logger instance for logging information and debug messages.
     Returns:
-        None
+        list: Vials whose selection steps were updated.
+    """
+    selection_steps, selection_units = selection_steps_for(vials, configs, logger)
+    return update_step_configs(vials, selection_steps, 'selection-steps', selection_units, elapsed_time, logger, eVOLVER)
+
+def selection_steps_for(vials, configs, logger):
+    """
+    Works out the selection steps of each vial from the configurations, without writing anything.
+    Parameters:
+        vials (list): List of vial identifiers.
+        configs (dict): Dictionary containing configuration dataframes for 'selection-steps', 
+                    'selection-step_generation', and 'selection-control'.
+        logger (logging.Logger): Logger instance for warnings.
+    Returns:
+        tuple: Dictionary mapping each vial to its list of steps, and the selection units.
+    Raises:
+        ValueError: For an invalid step type, manual steps or step generation config.
     """
     selection_steps = {}
 
@@ -58,18 +146,14 @@ def update_steps(vials, configs, elapsed_time, logger, eVOLVER):
             # Generate steps for the given vial
             # print(f'GENERATING selection steps for vial {vial}')
             # print(step_gen_config)
-            selection_steps[vial] = generate_selection_steps(step_gen_config, logger, eVOLVER)
+            selection_steps[vial] = generate_selection_steps(step_gen_config, logger)
         
         # Invalid step type
         else:
             logger.warning(f"Vial {vial}: Invalid step type '{step_type}' in selection-control configuration.")
-            eVOLVER.stop_exp()
-            print('Experiment stopped, goodbye!')
-            logger.warning('experiment stopped, goodbye!')
             raise ValueError(f"Vial {vial}: Invalid step type '{step_type}' in selection-control configuration.\n\tValid step types are 'manual', 'generated', and 'off'.")
-        
-    # Update the selection step configuration
-    update_step_configs(vials, selection_steps, 'selection-steps', selection_units, elapsed_time, logger, eVOLVER)
+
+    return selection_steps, selection_units
 
 def update_step_configs(vials, selection_steps, config_name, selection_units, elapsed_time, logger, eVOLVER):
     """
@@ -84,42 +168,37 @@ def update_step_configs(vials, selection_steps, config_name, selection_units, el
     Returns:
         list: List of vials that have had their configurations updated.
     """
-    config_directory = os.path.join(eVOLVER.exp_dir, f'{config_name}')
+    storage = get_storage(eVOLVER.exp_dir)
     updated_vials = [] # List of vials that have had their configs updated
 
     # Create config files and directory if they do not exist
-    if not os.path.exists(config_directory):
-        os.makedirs(config_directory)
+    if not storage.exists(config_name):
         for vial in vials:
             current_config = [elapsed_time] + selection_steps[vial]
-            with open(os.path.join(config_directory, f'vial{vial}_{config_name}.txt'), 'w') as file:
-                file.write(','.join(map(str, current_config)) + '\n')
+            storage.create_series(config_name, vial, records=[current_config])
             updated_vials.append(vial)
             print(f'Vial {vial}: updating {config_name} config')
             logger.info(f'Vial {vial}: updating {config_name} config')
+        cu.remember_configs(eVOLVER.exp_dir, config_name, {vial: selection_steps[vial] for vial in vials})
 
-    # Compare the current config to the last line of the old config
+    # Compare the current configs to the last ones written, all vials at once
     else:
-        for vial in vials:
+        changed = cu.changed_configs(eVOLVER.exp_dir, config_name, vials, [selection_steps[vial] for vial in vials])
+        for vial in np.asarray(vials)[changed].tolist():
             current_config = [elapsed_time] + selection_steps[vial]
-            config_changed = cu.compare_configs(vial, current_config, config_name, eVOLVER.exp_dir, ignore_time=True) # compare the current config to the last line of the old config
-
-            if config_changed: # Update and log config change
-                cu.update_config(vial, config_name, current_config, eVOLVER.exp_dir) # Update the config file
-                print(f'Vial {vial}: updating {config_name} config')
-                logger.info(f'Vial {vial}: updating {config_name} config')
-                updated_vials.append(vial)
+            # Update and log config change
+            cu.update_config(vial, config_name, current_config, eVOLVER.exp_dir) # Update the config file
+            cu.remember_configs(eVOLVER.exp_dir, config_name, {vial: selection_steps[vial]})
+            print(f'Vial {vial}: updating {config_name} config')
+            logger.info(f'Vial {vial}: updating {config_name} config')
+            updated_vials.append(vial)
     
-                # Update step_log if the config is updated
-                current_conc = fu.get_last_n_lines('step_log', vial, 1, eVOLVER.exp_dir)[0][3] # Get just the concentration from the last step
-                if current_conc != 0: # TODO: what if the current conc = 0 and config change? Need a better way of skipping this if experiment just started
-                    # Update log file with new steps
-                    file_name = f"vial{vial}_step_log.txt"
-                    file_path = os.path.join(eVOLVER.exp_dir, 'step_log', file_name)
-                    text_file = open(file_path, "a+")
-                    text_file.write(f"{elapsed_time},{elapsed_time},{round(selection_steps[vial][0], 3)},{current_conc},CONFIG CHANGE\n") # Format: [elapsed_time, step_time, current_step, current_conc]
-                    text_file.close()
-                    logger.info(f"Vial {vial}: step log updated to first step: {round(selection_steps[vial][0], 3)} {selection_units}")  
+            # Update step_log if the config is updated
+            current_conc = fu.get_last_n_lines('step_log', vial, 1, eVOLVER.exp_dir)[0][3] # Get just the concentration from the last step
+            if current_conc != 0: # TODO: what if the current conc = 0 and config change? Need a better way of skipping this if experiment just started
+                # Update log file with new steps
+                storage.append('step_log', vial, elapsed_time, elapsed_time, round(selection_steps[vial][0], 3), current_conc, 'CONFIG CHANGE') # Format: [elapsed_time, step_time, current_step, current_conc]
+                logger.info(f"Vial {vial}: step log updated to first step: {round(selection_steps[vial][0], 3)} {selection_units}")  
     
     return updated_vials
 
@@ -142,7 +221,7 @@ def parse_manual_steps(vial, steps):
     except Exception as e:
         raise ValueError(f"Error parsing manual steps for vial {vial}:\n\t{e}")
     
-def generate_selection_steps(step_gen_config, logger, eVOLVER):
+def generate_selection_steps(step_gen_config, logger):
     """
     Generates or validates selection steps for a single vial and logs configuration changes.
 
@@ -156,7 +235,6 @@ def generate_selection_steps(step_gen_config, logger, eVOLVER):
             - selection_step_nums: Number of steps between min and max selection per vial.
         elapsed_time: Current elapsed time of the experiment.
         logger: Logger for warnings and updates.
-        eVOLVER: eVOLVER instance for stopping experiments.
     Returns:
         list: List of selection steps for the vial.
     """
@@ -173,9 +251,6 @@ def generate_selection_steps(step_gen_config, logger, eVOLVER):
     elif log_steps: # Logarithmic step generation
         if min_selection <= 0: # check if min_selection is greater than 0
             logger.warning(f"Vial {vial}: min_selection must be greater than 0 for logarithmic steps.")
-            eVOLVER.stop_exp()
-            print('Experiment stopped, goodbye!')
-            logger.warning('experiment stopped, goodbye!')
             raise ValueError(f"Vial {vial}: min_selection must be greater than 0 for logarithmic steps.") # raise an error if min_selection is less than 0
         selection_steps = np.round(np.logspace(np.log10(min_selection), np.log10(max_selection), num=step_number), 3)
     else: # Linear step generation
@@ -184,17 +259,51 @@ def generate_selection_steps(step_gen_config, logger, eVOLVER):
     return list(selection_steps)
 
 # Plot steps for all vials in a 4x4 grid as a step plot
-def plot_steps(vials, config_name, step_type, exp_dir):
+def plot_steps(vials, config_name, step_type, exp_dir, updated_vials=None):
     """
-    Plots the steps for all vials in a grid as a step plot.
+    Plots the steps for all vials in a grid as a step plot, saved to <exp_dir>/<step_type>_steps.png.
+    The plot is rendered in a background process with a headless backend, so this returns
+    immediately; the steps are read here, so any storage backend works.
     Args:
         vials (list): A list of vials.
         config_name (str): The name of the configuration.
         step_type (str): The type of step.
         exp_dir (str): The path to the experiment directory.
+        updated_vials (list): Vials whose steps changed (see update_step_configs); nothing is
+            plotted if empty. If None, the steps are always plotted.
     Returns:
-        None
+        concurrent.futures.Future: Completes with the path of the plot, or None if there was
+            nothing to plot.
     """
+    if updated_vials is not None and len(updated_vials) == 0:
+        return None
+    steps = {}
+    for vial in vials:
+        try:
+            steps[vial] = [float(step) for step in fu.get_last_n_lines(config_name, vial, 1, exp_dir)[0][1:]]
+        except Exception as e:
+            steps[vial] = f"Error: {e}"
+    save_path = os.path.join(exp_dir, f'{step_type}_steps.png')
+    future = _get_plotter().submit(render_steps, steps, step_type, save_path, updated_vials or [])
+    future.add_done_callback(_log_plot_error)
+    return future
+
+def render_steps(steps, step_type, save_path, updated_vials=()):
+    """
+    Draws the step plot grid and saves it. Runs in the plotting process, without a display.
+    Args:
+        steps (dict): Vial to its list of steps, or to an error message if they could not be read.
+        step_type (str): The type of step.
+        save_path (str): Where to save the plot.
+        updated_vials (list): Vials marked as updated in their titles.
+    Returns:
+        str: save_path
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    vials = list(steps)
     num_vials = len(vials)
     num_cols = int(np.ceil(np.sqrt(num_vials)))
     num_rows = int(np.ceil(num_vials / num_cols))
@@ -204,25 +313,39 @@ def plot_steps(vials, config_name, step_type, exp_dir):
     fig.suptitle(f'{step_type} steps for all vials', fontsize=16)
 
     for i, vial in enumerate(vials):
-        try:
-            # Replace this with your actual function to fetch data
-            data = fu.get_last_n_lines(config_name, vial, 1, exp_dir)[0]
-            axs[i].step(range(1, len(data)), data[1:], where='post')
-            axs[i].set_title(f'Vial {vial}')
-            axs[i].set_xlabel('Step Number')
-            axs[i].set_ylabel(f'{step_type}')
-        except Exception as e:
-            axs[i].text(0.5, 0.5, f"Error: {e}", ha='center', va='center', fontsize=10)
+        data = steps[vial]
+        if isinstance(data, str):
+            axs[i].text(0.5, 0.5, data, ha='center', va='center', fontsize=10)
             axs[i].set_title(f'Vial {vial} - Error')
             axs[i].set_axis_off()
+            continue
+        axs[i].step(range(1, len(data) + 1), data, where='post')
+        axs[i].set_title(f'Vial {vial} (updated)' if vial in updated_vials else f'Vial {vial}')
+        axs[i].set_xlabel('Step Number')
+        axs[i].set_ylabel(f'{step_type}')
 
-    for j in range(i + 1, len(axs)):  # Turn off unused subplots
+    for j in range(num_vials, len(axs)):  # Turn off unused subplots
         axs[j].set_axis_off()
 
     plt.tight_layout(rect=[0, 0, 1, 0.95])
-    save_path = os.path.join(exp_dir, f'{step_type}_steps.png')
     plt.savefig(save_path)
-    plt.show()
+    plt.close(fig)
+    return save_path
+
+_plotter = None
+
+def _get_plotter():
+    # One plotting process, started on first use; spawned so it does not inherit
+    # the experiment's sockets and threads
+    global _plotter
+    if _plotter is None:
+        _plotter = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn'))
+    return _plotter
+
+def _log_plot_error(future):
+    if future.exception() is not None:
+        logger.warning(f'could not plot steps: {future.exception()}')
+
 # # Example call
 # plot_steps(vials, 'selection-steps', 'Selection', EXP_DIR)
 
@@ -1,6 +1,8 @@
 import numpy as np
 import os.path
 
+from .storage import get_storage
+
 #### MATH FUNCTIONS ####
 def exponential_growth(x, a, b):
     """
@@ -28,17 +30,13 @@ def count_rescues(vial, exp_dir):
     Returns:
     int: The number of 'RESCUE' occurrences since the last 'INCREASE' message.
     """
-    file_name = f"vial{vial}_step_log.txt"
-    file_path = os.path.join(exp_dir, 'step_log', file_name)
-
     try:
-        with open(file_path, "r") as text_file:
-            lines = text_file.readlines()
+        lines = get_storage(exp_dir).read_lines('step_log', vial)
     except FileNotFoundError:
-        print(f"Error: The log file {file_path} was not found.")
+        print(f"Error: The step log of vial {vial} was not found.")
         return 0
     except Exception as e:
-        print(f"Error reading file {file_path}: {e}")
+        print(f"Error reading the step log of vial {vial}: {e}")
         return 0
 
     # Reverse the messages to start counting from the latest one
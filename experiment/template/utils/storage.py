@@ -0,0 +1,386 @@
+import io
+import os
+import abc
+import json
+import time
+import numpy as np
+
+# Series stored in a directory named differently from the series
+SERIES_DIRECTORIES = {'gr': 'growthrate'}
+
+#### STORAGE INTERFACE ####
+class Storage(abc.ABC):
+    """
+    Where an experiment keeps its per-vial data series (OD, pump logs, step logs, configs, ...)
+    and its JSON documents (e.g. the dilution summary).
+
+    A series has optional header lines followed by records, one comma separated line each,
+    the first field usually being the elapsed time. Use get_storage(exp_dir) to get the
+    storage of an experiment.
+    """
+    @abc.abstractmethod
+    def create_series(self, name, vial, header=(), records=()):
+        """
+        Creates (or replaces) a series.
+        Args:
+            name (str): The series name, e.g. 'OD', 'pump_log', 'selection-control'.
+            vial (int): The vial number.
+            header (list of str): Header lines.
+            records (list): Initial records, each a line (str) or a list of fields.
+        Returns:
+            None
+        """
+
+    @abc.abstractmethod
+    def exists(self, name, vial=None):
+        """Whether the series exists; with vial None, whether any vial has the series."""
+
+    @abc.abstractmethod
+    def append(self, name, vial, *fields):
+        """
+        Appends a record of fields; each is written with str().
+        Raises:
+            FileNotFoundError: If no vial has the series yet.
+        """
+
+    @abc.abstractmethod
+    def read_tail(self, name, vial, n):
+        """
+        Reads the last n lines. As with tail_to_np on the files, header lines count: when the
+        tail reaches into the header, the result is an array of strings.
+        Returns:
+            numpy.ndarray: (n, fields) float array, or an array of strings for series with
+                text fields. Empty if there are fewer than n lines, header included.
+        """
+
+    @abc.abstractmethod
+    def read_range(self, name, vial, start=None, end=None):
+        """
+        Reads the numeric records with elapsed time in (start, end].
+        Returns:
+            numpy.ndarray: (records, fields) float array; text fields are NaN.
+        """
+
+    @abc.abstractmethod
+    def read_lines(self, name, vial):
+        """Reads every line of the series, header included, as text."""
+
+    def read_header(self, name, vial):
+        """Fields of the first line of the series."""
+        return self.read_lines(name, vial)[0].strip().split(',')
+
+    def read_last_config(self, name, vial):
+        """Fields of the last line of the series, as strings."""
+        return self.read_lines(name, vial)[-1].strip().split(',')
+
+    @abc.abstractmethod
+    def vials(self, name):
+        """Vials that have the series."""
+
+    @abc.abstractmethod
+    def last_modified(self, name, vial):
+        """Wall clock time of the last change to the series."""
+
+    @abc.abstractmethod
+    def read_json(self, name):
+        """Reads a JSON document, or None if there is none."""
+
+    @abc.abstractmethod
+    def write_json(self, name, data):
+        """Replaces a JSON document; readers never see it partially written."""
+
+#### FILE STORAGE ####
+def tail_to_np(path, window=10, BUFFER_SIZE=512):
+    """
+    Reads file from the end and returns a numpy array with the data of the last 'window' lines.
+    Alternative to np.genfromtxt(path) by loading only the needed lines instead of the whole file.
+    """
+    try:
+        f = open(path, 'rb')
+    except OSError as e:
+        print(f"Unable to open file: {path}\n\tError: {e}")
+        return np.asarray([])
+
+    if window == 0:
+        return np.asarray([])
+
+    f.seek(0, os.SEEK_END)
+    remaining_bytes = f.tell()
+    size = window + 1  # Read one more line to avoid broken lines
+    block = -1
+    data = []
+
+    while size > 0 and remaining_bytes > 0:
+        if remaining_bytes - BUFFER_SIZE > 0:
+            # Seek back one whole BUFFER_SIZE
+            f.seek(block * BUFFER_SIZE, os.SEEK_END)
+            # read BUFFER
+            bunch = f.read(BUFFER_SIZE)
+        else:
+            # file too small, start from beginning
+            f.seek(0, 0)
+            # only read what was not read
+            bunch = f.read(remaining_bytes)
+
+        bunch = bunch.decode('utf-8')
+        data.append(bunch)
+        size -= bunch.count('\n')
+        remaining_bytes -= BUFFER_SIZE
+        block -= 1
+
+    f.close()
+    data = ''.join(reversed(data)).splitlines()[-window:]
+
+    if len(data) < window:
+        # Not enough data
+        return np.asarray([])
+
+    return _rows_to_np([v.split(',') for v in data], path)
+
+def _rows_to_np(rows, name):
+    try:
+        return np.asarray(rows, dtype=np.float64)
+    except ValueError:
+        try:
+            return np.asarray(rows)
+        except ValueError as e:
+            print(f"tail_to_np: Unable to read file as numpy array: {name}\n\tError: {e}")
+            return np.asarray([])
+
+class FileStorage(Storage):
+    """
+    The experiment directory layout: one directory per series name holding one text file per
+    vial, e.g. <exp_dir>/OD/vial0_OD.txt and <exp_dir>/growthrate/vial0_gr.txt.
+    """
+    def __init__(self, exp_dir):
+        self.exp_dir = exp_dir
+
+    def path(self, name, vial):
+        directory = SERIES_DIRECTORIES.get(name, name)
+        return os.path.join(self.exp_dir, directory, f'vial{vial}_{name}.txt')
+
+    def create_series(self, name, vial, header=(), records=()):
+        path = self.path(name, vial)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            for line in header:
+                f.write(line + '\n')
+            for record in records:
+                f.write(_format_record(record) + '\n')
+
+    def exists(self, name, vial=None):
+        if vial is None:
+            return os.path.isdir(os.path.join(self.exp_dir, SERIES_DIRECTORIES.get(name, name)))
+        return os.path.exists(self.path(name, vial))
+
+    def append(self, name, vial, *fields):
+        with open(self.path(name, vial), 'a+') as f:
+            f.write(_format_record(fields) + '\n')
+
+    def read_tail(self, name, vial, n):
+        return tail_to_np(self.path(name, vial), n)
+
+    def read_range(self, name, vial, start=None, end=None):
+        data = np.atleast_2d(np.genfromtxt(self.path(name, vial), delimiter=','))
+        return _select_range(data, start, end)
+
+    def read_lines(self, name, vial):
+        with open(self.path(name, vial)) as f:
+            return f.readlines()
+
+    def read_header(self, name, vial):
+        with open(self.path(name, vial)) as f:
+            return f.readline().strip().split(',')
+
+    def read_last_config(self, name, vial):
+        # only the end of the file is read
+        with open(self.path(name, vial), 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            end = f.tell()
+            block = 512
+            while True:
+                f.seek(max(end - block, 0))
+                lines = f.read().decode('utf-8').splitlines()
+                if len(lines) > 1 or block >= end:
+                    return lines[-1].strip().split(',')
+                block *= 2
+
+    def vials(self, name):
+        directory = os.path.join(self.exp_dir, SERIES_DIRECTORIES.get(name, name))
+        suffix = f'_{name}.txt'
+        return sorted(int(f[4:-len(suffix)]) for f in os.listdir(directory)
+                      if f.startswith('vial') and f.endswith(suffix))
+
+    def last_modified(self, name, vial):
+        return os.path.getmtime(self.path(name, vial))
+
+    def read_json(self, name):
+        try:
+            with open(os.path.join(self.exp_dir, name)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def write_json(self, name, data):
+        path = os.path.join(self.exp_dir, name)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+
+#### MEMORY STORAGE ####
+class _MemorySeries:
+    """
+    One series in memory. The lines are kept as written; numeric records are also parsed
+    into a growing float array, so tails and ranges are array slices.
+    """
+    def __init__(self, header):
+        self.header = list(header)
+        self.lines = []
+        self.data = None # None once a record is not numeric
+        self.count = 0
+        self.numeric = True
+        self.modified = time.time()
+
+    def append(self, line):
+        self.lines.append(line)
+        self.modified = time.time()
+        if not self.numeric:
+            return
+        try:
+            values = [float(field) for field in line.split(',')]
+        except ValueError:
+            values = None
+        if values is None or (self.data is not None and len(values) != self.data.shape[1]):
+            self.numeric = False
+            self.data = None
+            return
+        if self.data is None:
+            self.data = np.empty((64, len(values)))
+        elif self.count == len(self.data):
+            self.data = np.concatenate([self.data, np.empty_like(self.data)])
+        self.data[self.count] = values
+        self.count += 1
+
+    def rows(self):
+        if self.numeric and self.data is not None:
+            return self.data[:self.count]
+        if not self.lines:
+            return np.empty((0, 0))
+        return np.atleast_2d(np.genfromtxt(io.StringIO('\n'.join(self.lines)), delimiter=','))
+
+class MemoryStorage(Storage):
+    """
+    Keeps every series and document in memory, for simulations and tests. Nothing is written
+    to disk; register it for an experiment with use_storage(exp_dir, MemoryStorage()).
+    """
+    def __init__(self):
+        self.series = {}
+        self.documents = {}
+
+    def _series(self, name, vial):
+        try:
+            return self.series[name, vial]
+        except KeyError:
+            raise FileNotFoundError(f'no series {name} for vial {vial}') from None
+
+    def create_series(self, name, vial, header=(), records=()):
+        series = self.series[name, vial] = _MemorySeries(header)
+        for record in records:
+            series.append(_format_record(record))
+
+    def exists(self, name, vial=None):
+        if vial is None:
+            return any(key[0] == name for key in self.series)
+        return (name, vial) in self.series
+
+    def append(self, name, vial, *fields):
+        series = self.series.get((name, vial))
+        if series is None:
+            if not self.exists(name):
+                raise FileNotFoundError(f'no series {name}')
+            series = self.series[name, vial] = _MemorySeries(())
+        series.append(_format_record(fields))
+
+    def read_tail(self, name, vial, n):
+        # header lines count, as in the files (see Storage.read_tail)
+        series = self._series(name, vial)
+        if n == 0 or len(series.header) + len(series.lines) < n:
+            return np.asarray([])
+        if series.numeric and n <= series.count:
+            return series.data[series.count - n:series.count].copy()
+        lines = (series.header + series.lines)[-n:]
+        return _rows_to_np([line.split(',') for line in lines], name)
+
+    def read_range(self, name, vial, start=None, end=None):
+        return _select_range(self._series(name, vial).rows(), start, end)
+
+    def read_lines(self, name, vial):
+        series = self._series(name, vial)
+        return [line + '\n' for line in series.header + series.lines]
+
+    def read_header(self, name, vial):
+        series = self._series(name, vial)
+        return (series.header + series.lines[:1])[0].strip().split(',')
+
+    def read_last_config(self, name, vial):
+        series = self._series(name, vial)
+        return (series.header + series.lines)[-1].strip().split(',')
+
+    def vials(self, name):
+        return sorted(vial for series_name, vial in self.series if series_name == name)
+
+    def last_modified(self, name, vial):
+        return self._series(name, vial).modified
+
+    def read_json(self, name):
+        document = self.documents.get(name)
+        return None if document is None else json.loads(document)
+
+    def write_json(self, name, data):
+        self.documents[name] = json.dumps(data)
+
+def _format_record(record):
+    if isinstance(record, str):
+        return record
+    return ','.join(str(field) for field in record)
+
+def _select_range(data, start, end):
+    if data.ndim != 2 or data.size == 0:
+        return np.empty((0, data.shape[1] if data.ndim == 2 else 0))
+    keep = np.isfinite(data[:, 0])
+    if start is not None:
+        keep &= data[:, 0] > start
+    if end is not None:
+        keep &= data[:, 0] <= end
+    return data[keep]
+
+#### STORAGE REGISTRY ####
+_storages = {}
+
+def get_storage(exp_dir):
+    """
+    The storage of an experiment: the one registered with use_storage(), otherwise the
+    experiment directory itself.
+    """
+    key = os.path.abspath(exp_dir)
+    storage = _storages.get(key)
+    if storage is None:
+        storage = _storages[key] = FileStorage(exp_dir)
+    return storage
+
+def use_storage(exp_dir, storage):
+    """
+    Makes every module read and write an experiment's data through the given storage.
+    Returns:
+        Storage: The storage.
+    """
+    _storages[os.path.abspath(exp_dir)] = storage
+    return storage
+
+def release_storage(exp_dir):
+    """Forgets the storage of an experiment, e.g. once a simulation is summarized."""
+    _storages.pop(os.path.abspath(exp_dir), None)
+
+if __name__ == '__main__':
+    print('Please run eVOLVER.py instead')
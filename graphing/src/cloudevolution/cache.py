@@ -0,0 +1,124 @@
+"""
+In-process LRU cache backend and single-flight rendering helpers.
+
+LRUCache is a Django cache backend (see CACHES in settings.py) that evicts the
+least recently used entry once MAX_ENTRIES is reached. render_once makes
+concurrent requests for the same key wait for one render instead of each
+rendering the same plots.
+"""
+
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from django.core.cache import caches
+from django.core.cache.backends.base import BaseCache, DEFAULT_TIMEOUT
+
+
+# Django creates a backend instance per thread, so the entries live here,
+# shared by name like in LocMemCache
+_stores = {}
+_locks = {}
+
+
+class LRUCache(BaseCache):
+
+	def __init__(self, name, params):
+		BaseCache.__init__(self, params)
+		self._cache = _stores.setdefault(name, OrderedDict())  # key -> (value, expiry time or None)
+		self._lock = _locks.setdefault(name, threading.Lock())
+
+	def _expired(self, key, now):
+		expiry = self._cache[key][1]
+		return expiry is not None and expiry <= now
+
+	def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+		key = self.make_key(key, version=version)
+		self.validate_key(key)
+		with self._lock:
+			if key in self._cache and not self._expired(key, time.time()):
+				return False
+			self._set(key, value, timeout)
+			return True
+
+	def get(self, key, default=None, version=None):
+		key = self.make_key(key, version=version)
+		self.validate_key(key)
+		with self._lock:
+			if key not in self._cache:
+				return default
+			if self._expired(key, time.time()):
+				del self._cache[key]
+				return default
+			self._cache.move_to_end(key)
+			return self._cache[key][0]
+
+	def _set(self, key, value, timeout):
+		timeout = self.get_backend_timeout(timeout)
+		self._cache[key] = (value, timeout)
+		self._cache.move_to_end(key)
+		while len(self._cache) > self._max_entries:
+			self._cache.popitem(last=False)
+
+	def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+		key = self.make_key(key, version=version)
+		self.validate_key(key)
+		with self._lock:
+			self._set(key, value, timeout)
+
+	def delete(self, key, version=None):
+		key = self.make_key(key, version=version)
+		self.validate_key(key)
+		with self._lock:
+			self._cache.pop(key, None)
+
+	def has_key(self, key, version=None):
+		return self.get(key, version=version) is not None
+
+	def clear(self):
+		with self._lock:
+			self._cache.clear()
+
+
+_render_locks = {}
+_render_locks_lock = threading.Lock()
+
+
+def render_once(cache_name, key, render):
+	"""
+	Return the cached value for key, calling render() to fill it on a miss.
+	Concurrent misses for the same key wait for the first render.
+	"""
+	cache = caches[cache_name]
+	value = cache.get(key)
+	if value is not None:
+		return value
+
+	with _render_locks_lock:
+		lock = _render_locks.setdefault(key, threading.Lock())
+	with lock:
+		value = cache.get(key)
+		if value is None:
+			value = render()
+			cache.set(key, value)
+		with _render_locks_lock:
+			_render_locks.pop(key, None)
+	return value
+
+
+def file_signature(*paths):
+	"""
+	Cache key fragment that changes whenever any of the files is appended to.
+	Hashed, so keys stay short (memcached rejects keys over 250 characters)
+	however many files they cover.
+	"""
+	parts = []
+	for path in paths:
+		try:
+			stat = os.stat(path)
+			parts.append('{0}-{1}'.format(stat.st_size, stat.st_mtime_ns))
+		except OSError:
+			parts.append('missing')
+	return hashlib.sha1(':'.join(parts).encode()).hexdigest()
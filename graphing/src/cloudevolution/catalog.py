@@ -0,0 +1,200 @@
+"""
+Cached catalog of the experiments found under the DPU experiment directory.
+
+The layout is experiment/<script dir>/<experiment dir>, e.g.
+experiment/template/my_expt. Directory listings are only redone when the
+mtime of the directory they came from changes, and mtimes are only checked
+once per poll interval (or by a background watcher), so page requests do not
+walk the filesystem tree.
+"""
+
+import os
+import threading
+import time
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+EVOLVER_DIR = os.path.join(ROOT_DIR, 'experiment')
+
+
+def _mtime(path):
+	try:
+		return os.stat(path).st_mtime
+	except OSError:
+		return None
+
+
+def _subdirs(path):
+	try:
+		return sorted(entry.name for entry in os.scandir(path) if entry.is_dir())
+	except OSError:
+		return []
+
+
+class ExperimentCatalog(object):
+
+	def __init__(self, evolver_dir=EVOLVER_DIR, poll_interval=5):
+		self.evolver_dir = evolver_dir
+		self.poll_interval = poll_interval
+		self._lock = threading.RLock()
+		self._root_mtime = None
+		self._subdir_mtimes = {}  # script dir -> mtime when last listed
+		self._subdir_contents = {}  # script dir -> [experiment dir names]
+		self._experiments = {}  # experiment name -> script dir
+		self._metadata = {}  # experiment name -> (signature, metadata)
+		self._last_check = 0
+		self._watcher = None
+
+	def refresh(self, force=False):
+		"""Re-list only the directories whose mtime changed since the last check."""
+		if self._watcher is not None and not force:
+			return
+		if not force and time.time() - self._last_check < self.poll_interval:
+			return
+
+		with self._lock:
+			changed = False
+			root_mtime = _mtime(self.evolver_dir)
+			if root_mtime != self._root_mtime:
+				subdirs = _subdirs(self.evolver_dir)
+				for subdir in list(self._subdir_mtimes):
+					if subdir not in subdirs:
+						del self._subdir_mtimes[subdir]
+						self._subdir_contents.pop(subdir, None)
+						changed = True
+				for subdir in subdirs:
+					self._subdir_mtimes.setdefault(subdir, None)
+				self._root_mtime = root_mtime
+
+			for subdir, last_mtime in list(self._subdir_mtimes.items()):
+				subdir_mtime = _mtime(os.path.join(self.evolver_dir, subdir))
+				if subdir_mtime != last_mtime:
+					self._subdir_contents[subdir] = _subdirs(os.path.join(self.evolver_dir, subdir))
+					self._subdir_mtimes[subdir] = subdir_mtime
+					changed = True
+
+			if changed:
+				experiments = {}
+				for subdir in sorted(self._subdir_contents):
+					for name in self._subdir_contents[subdir]:
+						experiments.setdefault(name, subdir)
+				self._experiments = experiments
+				for name in list(self._metadata):
+					if name not in experiments:
+						del self._metadata[name]
+			self._last_check = time.time()
+
+	def start_watcher(self):
+		"""Poll directory mtimes from a daemon thread instead of on requests."""
+		with self._lock:
+			if self._watcher is not None:
+				return
+			self.refresh(force=True)
+
+			def _watch():
+				while True:
+					time.sleep(self.poll_interval)
+					try:
+						self.refresh(force=True)
+					except Exception:
+						pass
+
+			self._watcher = threading.Thread(target=_watch, name='experiment-catalog')
+			self._watcher.daemon = True
+			self._watcher.start()
+
+	def experiments(self, tag='expt'):
+		"""Names of all experiments containing tag, in catalog order."""
+		self.refresh()
+		return [name for name in self._experiments if tag in name]
+
+	def experiment_dir(self, experiment):
+		"""Absolute path of an experiment directory, or None if it is unknown."""
+		self.refresh()
+		subdir = self._experiments.get(experiment)
+		if subdir is None:
+			return None
+		return os.path.join(self.evolver_dir, subdir, experiment)
+
+	def script_dir(self, experiment):
+		"""Path of the script directory holding an experiment (pump_cal.txt etc.)."""
+		self.refresh()
+		subdir = self._experiments.get(experiment)
+		if subdir is None:
+			return None
+		return os.path.join(self.evolver_dir, subdir)
+
+	def file_scan(self, tag):
+		"""Drop-in replacement for views.file_scan served from the catalog."""
+		self.refresh()
+		sidebar_links = []
+		subdir_log = []
+		for name, subdir in self._experiments.items():
+			if tag in name:
+				sidebar_links.append(name)
+				subdir_log.append(subdir)
+				subdir_log.append(subdir)
+		return sidebar_links, subdir_log
+
+	def metadata(self, experiment):
+		"""
+		Vial count, recorded parameters, start time and last update of an experiment.
+		Recomputed only when the experiment or OD directory mtime changes; the
+		last update time is refreshed at most once per poll interval.
+		"""
+		expt_dir = self.experiment_dir(experiment)
+		if expt_dir is None:
+			return None
+
+		od_dir = os.path.join(expt_dir, 'OD')
+		signature = (_mtime(expt_dir), _mtime(od_dir))
+		with self._lock:
+			cached = self._metadata.get(experiment)
+			if cached is not None and cached[0] == signature:
+				metadata = cached[1]
+				if time.time() - metadata['checked'] >= self.poll_interval:
+					metadata['last_update'] = _mtime(os.path.join(od_dir, 'vial0_OD.txt'))
+					metadata['checked'] = time.time()
+				return metadata
+
+		series = _subdirs(expt_dir)
+		try:
+			vial_count = len([f for f in os.listdir(od_dir) if f.endswith('_OD.txt')])
+		except OSError:
+			vial_count = 0
+
+		start_time = None
+		try:
+			with open(os.path.join(od_dir, 'vial0_OD.txt')) as f:
+				header = f.readline().strip()
+			if header.startswith('Experiment:'):
+				start_time = header.rsplit(',', 1)[-1].strip()
+		except OSError:
+			pass
+
+		metadata = {
+			"name": experiment,
+			"path": expt_dir,
+			"vial_count": vial_count,
+			"series": series,
+			"params": [s[:-len('_raw')] for s in series if s.endswith('_raw')],
+			"start_time": start_time,
+			"last_update": _mtime(os.path.join(od_dir, 'vial0_OD.txt')),
+			"checked": time.time(),
+		}
+		with self._lock:
+			self._metadata[experiment] = (signature, metadata)
+		return metadata
+
+
+_catalog = None
+
+
+def get_catalog():
+	"""Process-wide catalog, configured from the Django settings."""
+	global _catalog
+	if _catalog is None:
+		from django.conf import settings
+		_catalog = ExperimentCatalog(EVOLVER_DIR, getattr(settings, 'EXPERIMENT_CATALOG_POLL_INTERVAL', 5))
+		if getattr(settings, 'EXPERIMENT_CATALOG_WATCHER', False):
+			_catalog.start_watcher()
+	return _catalog
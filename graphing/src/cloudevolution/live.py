@@ -0,0 +1,119 @@
+"""
+Relays the live data bus of running experiments to browsers.
+
+The DPU publishes every transformed broadcast and pump/step event on a local
+socket (utils/data_bus.py in the experiment template). One relay per
+experiment holds a single subscription to that bus and fans each message out
+to the open event streams, so live views update without reading data files
+and without one DPU connection per browser tab.
+"""
+
+import json
+import queue
+import threading
+import time
+
+# importable from the experiment template, see EVOLVER_TEMPLATE_DIR in settings.py
+from utils import data_bus
+
+RETRY_INTERVAL = 5
+
+
+class BusRelay(object):
+
+	def __init__(self, expt_path, queue_size=1000):
+		self.expt_path = expt_path
+		self.queue_size = queue_size
+		self._listeners = set()
+		self._lock = threading.Lock()
+		self._thread = None
+		self.connected = False
+
+	def listen(self):
+		"""Register a new listener queue, starting the relay thread if needed."""
+		listener = queue.Queue(maxsize=self.queue_size)
+		with self._lock:
+			self._listeners.add(listener)
+			if self._thread is None:
+				self._thread = threading.Thread(target=self._run, name='bus-relay')
+				self._thread.daemon = True
+				self._thread.start()
+		return listener
+
+	def unlisten(self, listener):
+		with self._lock:
+			self._listeners.discard(listener)
+
+	def _run(self):
+		while True:
+			with self._lock:
+				if not self._listeners:
+					self._thread = None
+					return
+			try:
+				for message in data_bus.subscribe(self.expt_path):
+					self.connected = True
+					self._broadcast(message)
+					with self._lock:
+						if not self._listeners:
+							break
+			except (OSError, ValueError):
+				pass
+			self.connected = False
+			time.sleep(RETRY_INTERVAL)
+
+	def _broadcast(self, message):
+		with self._lock:
+			listeners = list(self._listeners)
+		for listener in listeners:
+			try:
+				listener.put_nowait(message)
+			except queue.Full:
+				# a stalled browser only loses its own messages
+				pass
+
+
+_relays = {}
+_relays_lock = threading.Lock()
+
+
+def get_relay(expt_path):
+	with _relays_lock:
+		relay = _relays.get(expt_path)
+		if relay is None:
+			relay = _relays[expt_path] = BusRelay(expt_path)
+		return relay
+
+
+def event_stream(expt_path, topics=None, vial=None, keepalive=15):
+	"""
+	Server-sent events for the messages of one experiment, optionally limited
+	to some topics and to one vial (per-vial values are reduced to a single
+	"value" for that vial). Sends a comment line every keepalive seconds so
+	closed connections are noticed.
+	"""
+	relay = get_relay(expt_path)
+	listener = relay.listen()
+	try:
+		yield "retry: {0}\n\n".format(RETRY_INTERVAL * 1000)
+		while True:
+			try:
+				message = listener.get(timeout=keepalive)
+			except queue.Empty:
+				yield ": keepalive\n\n"
+				continue
+			topic = message.get('topic')
+			if topics and topic not in topics:
+				continue
+			if vial is not None:
+				if 'values' in message:
+					# the relay hands the same message to every stream
+					message = dict(message)
+					values = message.pop('values')
+					message['vial'] = vial
+					message['value'] = values[vial] if vial < len(values) else None
+				elif message.get('vial') != vial:
+					continue
+			yield "event: {0}\ndata: {1}\n\n".format(topic, json.dumps(message))
+	finally:
+		relay.unlisten(listener)
@@ -0,0 +1,87 @@
+"""
+Parallel, downsampled loading of many data series at once.
+
+Used by the overview and comparison pages, which need dozens of series per
+request. Each series is parsed and downsampled in a worker process so that
+only a bounded number of points per series comes back to the view.
+"""
+
+import math
+import os
+import threading
+import multiprocessing
+import concurrent.futures
+import numpy as np
+
+from cloudevolution import series
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def downsample(data, max_points):
+	"""
+	Keep the minimum and maximum point of each of max_points / 2 equal buckets,
+	so spikes and dilution drops survive the downsampling.
+	"""
+	n = len(data)
+	if n <= max_points:
+		return data
+	buckets = max(max_points // 2, 1)
+	size = int(math.ceil(n / float(buckets)))
+	values = np.full(buckets * size, np.nan)
+	values[:n] = data[:, 1]
+	values = values.reshape(buckets, size)
+	finite = np.isfinite(values)
+	offsets = np.arange(buckets) * size
+	low = np.where(finite, values, np.inf).argmin(axis=1) + offsets
+	high = np.where(finite, values, -np.inf).argmax(axis=1) + offsets
+	keep = np.unique(np.clip(np.concatenate([low, high, [n - 1]]), 0, n - 1))
+	return data[keep]
+
+
+def load_downsampled(path, skip, max_points):
+	"""Worker: read a whole series file and downsample it."""
+	if not os.path.exists(path):
+		return None
+	context_data, data = series.read_since(path, skip=skip)
+	return downsample(data, max_points)
+
+
+def get_pool(workers=None):
+	"""
+	The worker pool, started on first use. Workers are spawned, not forked:
+	forking the threaded server while another request holds a lock (cache,
+	logging, catalog) would leave that lock held in the workers.
+	"""
+	global _pool
+	with _pool_lock:
+		if _pool is None:
+			_pool = concurrent.futures.ProcessPoolExecutor(max_workers=workers,
+				mp_context=multiprocessing.get_context('spawn'))
+		return _pool
+
+
+def load_many(requests, max_points=2000, timeout=10, workers=None):
+	"""
+	Load several series in parallel.
+
+	requests is a list of (key, path, skip). Returns {key: array or None}, where
+	None means the file is missing or was not loaded within the timeout.
+	"""
+	pool = get_pool(workers)
+	futures = {}
+	for key, path, skip in requests:
+		futures[pool.submit(load_downsampled, path, skip, max_points)] = key
+
+	results = dict((key, None) for key, path, skip in requests)
+	try:
+		for future in concurrent.futures.as_completed(futures, timeout=timeout):
+			try:
+				results[futures[future]] = future.result()
+			except Exception:
+				results[futures[future]] = None
+	except concurrent.futures.TimeoutError:
+		for future in futures:
+			future.cancel()
+	return results
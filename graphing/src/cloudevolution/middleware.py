@@ -0,0 +1,17 @@
+"""
+GZip compression for everything but the live event streams.
+"""
+
+from django.middleware.gzip import GZipMiddleware
+
+
+class EventStreamAwareGZipMiddleware(GZipMiddleware):
+	"""
+	GZipMiddleware buffers a compressed streaming response until the compressor
+	flushes, which holds server-sent events back; those are passed through as is.
+	"""
+
+	def process_response(self, request, response):
+		if response.get('Content-Type', '').startswith('text/event-stream'):
+			return response
+		return GZipMiddleware.process_response(self, request, response)
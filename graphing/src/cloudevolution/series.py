@@ -0,0 +1,167 @@
+"""
+Incremental readers for the per-vial data files written by the DPU.
+
+Every data file is an append-only "time,value" log with a few header lines,
+and time only increases. That lets us binary search the file by byte offset
+for the first point after a given time and read only the new points.
+"""
+
+import base64
+import io
+import os
+import numpy as np
+
+# param -> (directory, file suffix, leading lines to skip)
+# Growth rate files start with a header, a "0,0" row and a first value that
+# is biased by the difference between the initial OD and the lower threshold.
+SERIES = {
+	'od': ('OD', 'OD', 1),
+	'gr': ('growthrate', 'gr', 3),
+	'temp': ('temp', 'temp', 0),
+}
+
+BLOCK_SIZE = 4096
+
+
+def series_path(expt_path, param, vial):
+	if param in SERIES:
+		directory, suffix, skip = SERIES[param]
+	else:
+		directory, suffix, skip = param, param, 1
+	return os.path.join(expt_path, directory, "vial{0}_{1}.txt".format(vial, suffix)), skip
+
+
+def _data_start(f, skip):
+	f.seek(0)
+	for _ in range(skip):
+		if not f.readline():
+			break
+	return f.tell()
+
+
+def _line_time(line):
+	try:
+		return float(line.split(b',', 1)[0])
+	except ValueError:
+		return None
+
+
+def _first_offset_after(f, since, start, size):
+	"""Byte offset of the first line at or after start whose time is > since."""
+	lo, hi = start, size
+	while hi - lo > BLOCK_SIZE:
+		mid = (lo + hi) // 2
+		f.seek(mid)
+		f.readline()  # skip the partial line we landed in
+		line_start = f.tell()
+		line = f.readline()
+		if not line or line_start >= hi:
+			hi = mid
+			continue
+		t = _line_time(line)
+		if t is not None and t > since:
+			hi = mid
+		else:
+			lo = line_start
+	# Finish with a linear scan over at most one block
+	f.seek(lo)
+	while True:
+		offset = f.tell()
+		line = f.readline()
+		if not line:
+			return offset
+		t = _line_time(line)
+		if t is not None and t > since:
+			return offset
+
+
+def _back_lines(f, offset, n, start):
+	"""Byte offset n complete lines before offset, not going past start."""
+	if n <= 0:
+		return offset
+	pos = offset
+	newlines = 0
+	while pos > start:
+		read_from = max(start, pos - BLOCK_SIZE)
+		f.seek(read_from)
+		chunk = f.read(pos - read_from)
+		# The byte right before offset is the newline ending the previous line
+		end = len(chunk) - 1 if pos == offset else len(chunk)
+		idx = end
+		while True:
+			idx = chunk.rfind(b'\n', 0, idx)
+			if idx < 0:
+				break
+			newlines += 1
+			if newlines == n:
+				return read_from + idx + 1
+		pos = read_from
+	return start
+
+
+def parse_points(text, columns=2):
+	"""Parse "time,value" lines into an (n, columns) float array, skipping bad lines."""
+	if not text.strip():
+		return np.empty((0, columns))
+	try:
+		data = np.loadtxt(io.StringIO(text), delimiter=',', usecols=range(columns), ndmin=2)
+	except ValueError:
+		rows = []
+		for line in text.splitlines():
+			fields = line.split(',')
+			try:
+				rows.append([float(v) for v in fields[:columns]])
+			except ValueError:
+				continue
+		data = np.asarray(rows, dtype=float).reshape(-1, columns)
+	return data
+
+
+def read_since(path, since=None, skip=0, context=0):
+	"""
+	Read the points of a data file with time > since.
+
+	Returns (context_points, new_points): context_points are up to `context`
+	points immediately before the new ones, for trailing window statistics.
+	"""
+	with open(path, 'rb') as f:
+		f.seek(0, os.SEEK_END)
+		size = f.tell()
+		start = _data_start(f, skip)
+		if since is None:
+			offset = start
+		else:
+			offset = _first_offset_after(f, since, start, size)
+		context_offset = _back_lines(f, offset, context, start)
+		f.seek(context_offset)
+		context_text = f.read(offset - context_offset).decode('utf-8', 'replace')
+		new_text = f.read(size - offset).decode('utf-8', 'replace')
+
+	# Only hand complete lines to the parser; a partial last line is picked up next poll
+	if new_text and not new_text.endswith('\n'):
+		new_text = new_text[:new_text.rfind('\n') + 1]
+	return parse_points(context_text), parse_points(new_text)
+
+
+def compact(values, digits=7):
+	"""
+	Round values to float32 precision (7 significant digits), so their JSON
+	text is short. The DPU writes full float64 reprs of calibrated values.
+	"""
+	values = np.asarray(values, dtype=float)
+	if not len(values):
+		return values
+	return np.char.mod('%.{0}g'.format(digits), values).astype(float)
+
+
+def encode_b64(values):
+	"""
+	A column as base64 little-endian float32, in the {"__ndarray__": ...}
+	form newer BokehJS versions decode natively.
+	"""
+	values = np.asarray(values, dtype='<f4')
+	return {
+		'__ndarray__': base64.b64encode(values.tobytes()).decode('ascii'),
+		'dtype': 'float32',
+		'shape': [len(values)],
+	}
@@ -12,9 +12,16 @@ https://docs.djangoproject.com/en/1.8/ref/settings/
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 import os
+import sys
 
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
+# The experiment template whose utils package (analytics, file_utils, data_bus) the
+# views share with the DPU code; importable as 'utils' from every module
+EVOLVER_TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.dirname(BASE_DIR)), 'experiment', 'template')
+if EVOLVER_TEMPLATE_DIR not in sys.path:
+    sys.path.append(EVOLVER_TEMPLATE_DIR)
+
 
 # Quick-start development settings - unsuitable for production
 # See https://docs.djangoproject.com/en/1.8/howto/deployment/checklist/
@@ -44,6 +51,9 @@ INSTALLED_APPS = (
 )
 
 MIDDLEWARE_CLASSES = (
+    # First, so it compresses the final response (pages and chart data); event streams
+    # are left uncompressed, since gzip would hold the events back
+    'cloudevolution.middleware.EventStreamAwareGZipMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -117,3 +127,43 @@ MEDIA_ROOT = os.path.join(os.path.dirname(BASE_DIR), "static_in_env","media_root
 
 
 CRISPY_TEMPLATE_PACK = 'bootstrap3'
+
+
+# Experiment catalog (see cloudevolution/catalog.py)
+# Seconds between checks of the experiment directory mtimes. With the watcher
+# enabled the checks run on a background thread instead of during requests.
+EXPERIMENT_CATALOG_POLL_INTERVAL = 5
+EXPERIMENT_CATALOG_WATCHER = True
+
+# Milliseconds between polls of the live vial charts for new data points
+LIVE_CHART_POLL_INTERVAL = 10000
+
+# Caches
+# https://docs.djangoproject.com/en/1.8/topics/cache/
+# "plots" holds the rendered Bokeh components of the vial pages, keyed by the
+# size and mtime of their source files; the least recently used are evicted.
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'plots': {
+        'BACKEND': 'cloudevolution.cache.LRUCache',
+        'TIMEOUT': None,
+        'OPTIONS': {
+            'MAX_ENTRIES': 128,
+        },
+    },
+}
+
+# Overview and comparison pages (see cloudevolution/loader.py)
+# Series are loaded in a process pool and downsampled to at most
+# COMPARE_MAX_POINTS points; series not loaded within COMPARE_TIMEOUT seconds
+# are reported as missing. COMPARE_WORKERS = None uses one worker per CPU.
+COMPARE_MAX_POINTS = 2000
+COMPARE_TIMEOUT = 10
+COMPARE_WORKERS = None
+
+# Points of the OD and temperature plots inlined in the vial page; longer
+# series are downsampled keeping the min and max of each bucket
+VIAL_PLOT_MAX_POINTS = 2000
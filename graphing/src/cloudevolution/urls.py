@@ -23,12 +23,20 @@ urlpatterns = [
 	url(r'^$', 'cloudevolution.views.home',name = 'home'),
     url(r'^simple_chart/$', 'cloudevolution.views.simple_chart', name="simple_chart"),
 
+    url(r'^compare/$', 'cloudevolution.views.compare', name='compare'),
+
     url(r'^(?P<experiment>\w+)/$', 'cloudevolution.views.expt_name', name='expt_name'),
 
+    url(r'^(?P<experiment>\w+)/overview/$', 'cloudevolution.views.overview', name='overview'),
+
+    url(r'^(?P<experiment>\w+)/stream/$', 'cloudevolution.views.stream', name='stream'),
+
     url(r'^(?P<experiment>\w+)/(?P<vial>[0-9]+)/$', 'cloudevolution.views.vial_num', name='vial_num'),
 
     url(r'^(?P<experiment>\w+)/(dilutions)/$', 'cloudevolution.views.dilutions', name='dilutions'),
 
+    url(r'^(?P<experiment>\w+)/(?P<vial>[0-9]+)/(?P<param>\w+)/data/$', 'cloudevolution.views.series_data', name='series_data'),
+
     url(r'^admin/', include(admin.site.urls)),
 ]
 
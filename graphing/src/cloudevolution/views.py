@@ -1,14 +1,26 @@
 from django.shortcuts import render
-from django.http import HttpResponse
-from bokeh.plotting import figure
+from django.conf import settings
+from django.core.urlresolvers import reverse
+from django.http import HttpResponse, HttpResponseBadRequest, Http404, JsonResponse, StreamingHttpResponse
+from django.utils.http import urlencode
+from bokeh.plotting import figure, gridplot, vplot
 from bokeh.embed import components
-from bokeh.models import Range1d
+from bokeh.models import Range1d, AjaxDataSource
+from collections import OrderedDict
 import numpy as np
-import itertools
 import os
+import re
 import time
 import math
 
+from cloudevolution import live, loader, series
+from cloudevolution.cache import file_signature, render_once
+from cloudevolution.catalog import get_catalog
+
+# Derived statistics are shared with the DPU code in the experiment template (see
+# EVOLVER_TEMPLATE_DIR in settings.py)
+from utils import analytics, file_utils as fu
+
 # Create your views here.
 def home(request):
 	sidebar_links, subdir_log = file_scan('expt')
@@ -33,22 +45,37 @@ def simple_chart(request):
 
 def vial_num(request, experiment, vial):
 	sidebar_links, subdir_log = file_scan('expt')
-	vial_count = range(0, 16)
-	expt_dir, expt_subdir = file_scan(experiment)
-	rootdir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
-	evolver_dir = os.path.join(rootdir, 'experiment')
-	OD_dir = os.path.join(evolver_dir, expt_subdir[0], experiment, "OD", "vial{0}_OD.txt".format(vial))
-	gr_dir = os.path.join(evolver_dir, expt_subdir[0], experiment, "growthrate", "vial{0}_gr.txt".format(vial))
-	temp_dir = os.path.join(evolver_dir, expt_subdir[0], experiment, "temp", "vial{0}_temp.txt".format(vial))
+	vial_count = experiment_vials(experiment)
+	expt_path = experiment_dir(experiment)
+
+	# Plots are only re-rendered when one of the source files changed
+	sources = [series.series_path(expt_path, param, vial)[0] for param in ('od', 'gr', 'temp', 'step_log')]
+	key = 'vial:{0}:{1}:{2}'.format(experiment, vial, file_signature(*sources))
+	plots = render_once('plots', key, lambda: render_vial_plots(experiment, vial, expt_path))
+
+	context = {
+		"sidebar_links": sidebar_links,
+		"experiment": experiment,
+		"vial_count": vial_count,
+		"vial": vial,
+	}
+	context.update(plots)
+
+	return render(request, "vial.html", context)
+
+
+def render_vial_plots(experiment, vial, expt_path):
+	OD_dir, OD_skip = series.series_path(expt_path, 'od', vial)
+	gr_dir, gr_skip = series.series_path(expt_path, 'gr', vial)
+	temp_dir, temp_skip = series.series_path(expt_path, 'temp', vial)
 
 	"""
 	OD PLOT
 	"""
 
-	with open(OD_dir) as f_in:
-		data = np.genfromtxt(itertools.islice(f_in, 0, None, 5), delimiter=',')
-	if len(data) < 1000:
-		data = np.genfromtxt(OD_dir, delimiter=',')
+	context_data, data = series.read_since(OD_dir, skip=OD_skip)
+	OD_since = data[-1, 0] if len(data) else None
+	data = loader.downsample(data, getattr(settings, 'VIAL_PLOT_MAX_POINTS', 2000))
 
 	last_OD_update = time.ctime(os.path.getmtime(OD_dir))
 
@@ -56,7 +83,8 @@ def vial_num(request, experiment, vial):
 	p.y_range = Range1d(-.05, 2)
 	p.xaxis.axis_label = 'Hours'
 	p.yaxis.axis_label = 'Optical Density'
-	p.line(data[:,0], data[:,1], line_width=1)
+	source = live_source(experiment, vial, 'od', OD_since, x=data[:, 0], y=data[:, 1])
+	p.line('x', 'y', source=source, line_width=1)
 	OD_script, OD_div = components(p)
 	od_x_range = p.x_range  # Save plot size for later
 
@@ -64,39 +92,32 @@ def vial_num(request, experiment, vial):
 	GROWTH RATE PLOT
 	"""
 
-	gr_data = np.genfromtxt(gr_dir, delimiter=',', skip_header=2)
+	# Growth rates and their rolling statistics come from the per-vial analytics,
+	# which skip the "0,0" row and the first gr value, biased by the diff between
+	# the initial OD and the lower_thresh
+	wsize = 10  # Customize window size to calculate the mean
+	vial_stats = analytics.vial_analytics(vial, expt_path, window=wsize + 1)
+	gr_data = vial_stats['gr']
+	slide_mean = vial_stats['gr_mean']  # Growth rate
+	# slide_mean = analytics.rolling_mean(math.log(2) / gr_data[:, 1], wsize + 1)  # Generation time
+	gr_since = gr_data[-1, 0] if len(gr_data) else None
 
 	last_grate_update = time.ctime(os.path.getmtime(gr_dir))
 
 	# Quick patch when there's not enough growth rate values
-	if gr_data.ndim < 2 or len(gr_data) <= 2:
+	if len(gr_data) <= 1:
 		gr_data = np.asarray([[0, 0]])  # Avoids exception in p.line(gr.data ...)
+		slide_mean = np.asarray([0])
 		last_grate_update = "Not enough OD data yet!"  # Change time for a warning
-	else:
-		# Chop out first gr value, biased by the diff between the initial OD and the lower_thresh
-		gr_data = gr_data[1:]
 
 	p = figure(plot_width=700, plot_height=400)
 	p.y_range = Range1d(0, 1)  # Customize here y-axis range
 	p.x_range = od_x_range  # Set same size as the OD plot
 	p.xaxis.axis_label = 'Hours'
 	p.yaxis.axis_label = 'Growth rate (1/h)'
-	p.line(gr_data[:, 0], gr_data[:, 1], legend="growth rate")  # Growth rate
-	# p.line(gr_data[:, 0], math.log(2) / gr_data[:, 1], legend="growth rate")  # Generation time
-
-	# Sliding window for average growth rate calculation
-	slide_mean = []
-	wsize = 10  # Customize window size to calculate the mean
-	for i in range(0, len(gr_data[:, 1])):
-		if i - wsize < 0:
-			j = 0  # Allows plotting first incomplete windows
-		else:
-			j = i - wsize
-
-		slide_mean.append(np.nanmean(gr_data[j:i+1, 1]))  # Growth rate
-		# slide_mean.append(np.nanmean(math.log(2) / gr_data[j:i+1, 1]))  # Generation time
-
-	p.line(gr_data[:, 0], slide_mean, legend="{0} values mean".format(wsize), line_width=1, line_color="red")
+	source = live_source(experiment, vial, 'gr', gr_since, window=wsize, x=gr_data[:, 0], y=gr_data[:, 1], mean=slide_mean)
+	p.line('x', 'y', source=source, legend="growth rate")  # Growth rate
+	p.line('x', 'mean', source=source, legend="{0} values mean".format(wsize), line_width=1, line_color="red")
 
 	p.legend.orientation = "top_right"
 
@@ -106,10 +127,9 @@ def vial_num(request, experiment, vial):
 	TEMPERATURE PLOT
 	"""
 
-	with open(temp_dir) as f_in:
-		data = np.genfromtxt(itertools.islice(f_in, 0, None, 10), delimiter=',')
-	if len(data) < 1000:
-		data = np.genfromtxt(temp_dir, delimiter=',')
+	context_data, data = series.read_since(temp_dir, skip=temp_skip)
+	temp_since = data[-1, 0] if len(data) else None
+	data = loader.downsample(data, getattr(settings, 'VIAL_PLOT_MAX_POINTS', 2000))
 
 	last_temp_update = time.ctime(os.path.getmtime(temp_dir))
 
@@ -118,14 +138,19 @@ def vial_num(request, experiment, vial):
 	p.x_range = od_x_range  # Set same size as the OD plot
 	p.xaxis.axis_label = 'Hours'
 	p.yaxis.axis_label = 'Temp (C)'
-	p.line(data[:,0], data[:,1], line_width=1)
+	source = live_source(experiment, vial, 'temp', temp_since, x=data[:, 0], y=data[:, 1])
+	p.line('x', 'y', source=source, line_width=1)
 	temp_script, temp_div = components(p)
 
-	context = {
-		"sidebar_links": sidebar_links,
-		"experiment": experiment,
-		"vial_count": vial_count,
-		"vial": vial,
+	steps = vial_stats['steps']
+	if len(steps['step']):
+		step_summary = "step {0:g}: median growth rate {1:.3f} 1/h over {2} curves (doubling time {3:.2f} h)".format(
+			steps['step'][-1], steps['median_gr'][-1], steps['curves'][-1], steps['doubling_time'][-1])
+	else:
+		step_summary = None
+
+	return {
+		"step_summary": step_summary,
 		"OD_script": OD_script,
 		"OD_div": OD_div,
 		"grate_script": grate_script,
@@ -137,12 +162,10 @@ def vial_num(request, experiment, vial):
 		"last_temp_update": last_temp_update,
 	}
 
-	return render(request, "vial.html", context)
-
 
 def expt_name(request, experiment):
 	sidebar_links, subdir_log = file_scan('expt')
-	vial_count = range(0, 16)
+	vial_count = experiment_vials(experiment)
 
 	context = {
 		"sidebar_links": sidebar_links,
@@ -155,11 +178,60 @@ def expt_name(request, experiment):
 
 def dilutions(request, experiment):
 	sidebar_links, subdir_log = file_scan('expt')
-	vial_count = range(0, 16)
-	expt_dir, expt_subdir = file_scan(experiment)
-	rootdir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
-	evolver_dir = os.path.join(rootdir, 'experiment')
-	pump_cal = os.path.join(evolver_dir, expt_subdir[0], "pump_cal.txt")
+	vial_count = experiment_vials(experiment)
+	expt_path = experiment_dir(experiment)
+
+	# The DPU keeps a running dilution summary; only older experiments need their logs parsed
+	summary = fu.read_dilution_summary(expt_path)
+	if summary is None:
+		diluted, efficiency, last_dilution = dilutions_from_logs(experiment, expt_path, vial_count)
+	else:
+		diluted = []
+		efficiency = []
+		last = []
+
+		for vial in vial_count:
+			vial_summary = summary['vials'].get(str(vial))
+			if vial_summary is not None and vial_summary['dilutions'] != 0:
+				volume = str(round(vial_summary['influx_ml'] / 1000, 2))
+				dil_triggered = vial_summary['dilutions']
+				dil_intervals = vial_summary['odset_changes'] / 2
+				if dil_intervals != 0:
+					extra_dils = dil_triggered - dil_intervals
+					vial_eff = (dil_intervals - extra_dils) / dil_intervals * 100
+				else:
+					# Experiment is chemostat or vial is not used
+					vial_eff = 0
+			else:
+				volume = 0
+				vial_eff = 0
+
+			diluted.append(volume)
+			efficiency.append(str(round(vial_eff, 1)))
+			# ODset changes and selection additions are events too, but not dilutions
+			if vial_summary is not None and vial_summary.get('last_dilution_time') is not None:
+				last.append(vial_summary['last_dilution_time'])
+
+		last_dilution = time.ctime(max(last)) if last else None
+
+	if efficiency == ['0']*len(vial_count):
+		# All vials were chemostats or not used
+		efficiency = None
+
+	context = {
+	"sidebar_links": sidebar_links,
+	"experiment": experiment,
+	"vial_count": vial_count,
+	"diluted": diluted,
+	"efficiency": efficiency,
+	"last_dilution": last_dilution
+	}
+
+	return render(request, "dilutions.html", context)
+
+
+def dilutions_from_logs(experiment, expt_path, vial_count):
+	pump_cal = os.path.join(get_catalog().script_dir(experiment), "pump_cal.txt")
 
 	cal = np.genfromtxt(pump_cal, delimiter="\t")
 	diluted = []
@@ -167,8 +239,8 @@ def dilutions(request, experiment):
 	last = []
 
 	for vial in vial_count:
-		pump_dir = os.path.join(evolver_dir, expt_subdir[0], experiment, "pump_log", "vial{0}_pump_log.txt".format(vial))
-		ODset_dir = os.path.join(evolver_dir, expt_subdir[0], experiment, "ODset", "vial{0}_ODset.txt".format(vial))
+		pump_dir = os.path.join(expt_path, "pump_log", "vial{0}_pump_log.txt".format(vial))
+		ODset_dir = os.path.join(expt_path, "ODset", "vial{0}_ODset.txt".format(vial))
 		data = np.genfromtxt(pump_dir, delimiter=',', skip_header=2)
 
 		dil_triggered = len(data)
@@ -190,42 +262,232 @@ def dilutions(request, experiment):
 
 		diluted.append(volume)
 		efficiency.append(str(round(vial_eff, 1)))
-		last.append(time.ctime(os.path.getmtime(pump_dir)))
+		last.append(os.path.getmtime(pump_dir))
 
-	last_dilution = max(last)
+	return diluted, efficiency, time.ctime(max(last))
 
-	if efficiency == ['0']*16:
-		# All vials were chemostats or not used
-		efficiency = None
+
+# Line colors for series plotted on shared axes
+COLORS = ["#1f77b4", "#ff7f0e", "#2ca02c", "#d62728", "#9467bd", "#8c564b", "#e377c2", "#7f7f7f", "#bcbd22", "#17becf"]
+Y_RANGES = {'od': (-.05, 2), 'gr': (0, 1), 'temp': (25, 45)}
+Y_LABELS = {'od': 'Optical Density', 'gr': 'Growth rate (1/h)', 'temp': 'Temp (C)'}
+SERIES_PARAM = re.compile(r'\w+')
+
+
+def overview(request, experiment):
+	sidebar_links, subdir_log = file_scan('expt')
+	vial_count = experiment_vials(experiment)
+	expt_path = experiment_dir(experiment)
+
+	requests = []
+	for param in ('od', 'gr'):
+		for vial in vial_count:
+			path, skip = series.series_path(expt_path, param, vial)
+			requests.append(((param, vial), path, skip))
+	key = 'overview:{0}:{1}'.format(experiment, file_signature(*[path for key, path, skip in requests]))
+	plots = render_once('plots', key, lambda: render_overview(vial_count, requests))
 
 	context = {
-	"sidebar_links": sidebar_links,
-	"experiment": experiment,
-	"vial_count": vial_count,
-	"diluted": diluted,
-	"efficiency": efficiency,
-	"last_dilution": last_dilution
+		"sidebar_links": sidebar_links,
+		"experiment": experiment,
+		"vial_count": vial_count,
 	}
+	context.update(plots)
+
+	return render(request, "overview.html", context)
+
+
+def render_overview(vial_count, requests):
+	"""Small multiples of OD and growth rate for every vial, on shared axes."""
+	data = load_series(requests)
+	plots = {}
+	for param in ('od', 'gr'):
+		x_range = None
+		y_range = Range1d(*Y_RANGES[param])
+		rows = []
+		for vial in vial_count:
+			points = data[(param, vial)]
+			p = figure(plot_width=250, plot_height=200, title="Vial {0}".format(vial) if points is not None else "Vial {0} (no data)".format(vial))
+			p.y_range = y_range
+			if x_range is None:
+				x_range = p.x_range
+			else:
+				p.x_range = x_range
+			if points is not None and len(points):
+				p.line(series.compact(points[:, 0]), series.compact(points[:, 1]), line_width=1)
+			if len(rows) == 0 or len(rows[-1]) == 4:
+				rows.append([])
+			rows[-1].append(p)
+		script, div = components(gridplot(rows))
+		plots[param + "_script"] = script
+		plots[param + "_div"] = div
+	return plots
+
+
+def compare(request):
+	"""
+	Any selection of series on shared axes, one plot per parameter, e.g.
+	?series=expt_a:0:od,expt_b:0:od,expt_a:0:gr
+	"""
+	sidebar_links, subdir_log = file_scan('expt')
+	selection = []
+	for value in request.GET.getlist('series'):
+		for item in value.split(','):
+			if not item.strip():
+				continue
+			try:
+				experiment, vial, param = item.strip().split(':')
+				selection.append((experiment, int(vial), param))
+			except ValueError:
+				return HttpResponseBadRequest("series must be given as experiment:vial:param")
+			# param becomes part of a file path, as in the series_data URL pattern
+			if not SERIES_PARAM.fullmatch(param):
+				return HttpResponseBadRequest("invalid series parameter: {0}".format(param))
+
+	requests = []
+	unknown = []
+	for experiment, vial, param in selection:
+		expt_path = get_catalog().experiment_dir(experiment)
+		if expt_path is None:
+			unknown.append((experiment, vial, param))
+			continue
+		path, skip = series.series_path(expt_path, param, vial)
+		requests.append(((experiment, vial, param), path, skip))
+	data = load_series(requests)
+
+	plots = []
+	x_range = None
+	for param in sorted(set(param for experiment, vial, param in selection)):
+		p = figure(plot_width=900, plot_height=400)
+		if param in Y_RANGES:
+			p.y_range = Range1d(*Y_RANGES[param])
+		if x_range is None:
+			x_range = p.x_range
+		else:
+			p.x_range = x_range
+		p.xaxis.axis_label = 'Hours'
+		p.yaxis.axis_label = Y_LABELS.get(param, param)
+		for i, key in enumerate(k for k in data if k[2] == param):
+			points = data[key]
+			if points is not None and len(points):
+				p.line(series.compact(points[:, 0]), series.compact(points[:, 1]), line_width=1, line_color=COLORS[i % len(COLORS)], legend="{0} vial {1}".format(*key))
+		plots.append(p)
 
-	return render(request, "dilutions.html", context)
+	context = {
+		"sidebar_links": sidebar_links,
+		"selection": ["{0}:{1}:{2}".format(*item) for item in selection],
+		"missing": ["{0}:{1}:{2}".format(*key) for key in unknown + [key for key in data if data[key] is None]],
+	}
+	if plots:
+		context["compare_script"], context["compare_div"] = components(vplot(*plots))
+
+	return render(request, "compare.html", context)
+
+
+def load_series(requests):
+	return loader.load_many(requests,
+		max_points=getattr(settings, 'COMPARE_MAX_POINTS', 2000),
+		timeout=getattr(settings, 'COMPARE_TIMEOUT', 10),
+		workers=getattr(settings, 'COMPARE_WORKERS', None))
+
+
+def live_source(experiment, vial, param, since, window=None, **columns):
+	"""
+	Data source holding the points already rendered, which polls series_data
+	and appends only the points recorded after them. The endpoint sends the
+	time of its last point as ETag and jQuery sends it back as If-None-Match.
+	"""
+	data_url = reverse('series_data', kwargs={'experiment': experiment, 'vial': vial, 'param': param})
+	query = {}
+	if since is not None:
+		query['since'] = repr(float(since))
+	if window:
+		query['window'] = window
+	if query:
+		data_url += '?' + urlencode(query)
+	return AjaxDataSource(data={k: series.compact(v).tolist() for k, v in columns.items()},
+		data_url=data_url,
+		polling_interval=getattr(settings, 'LIVE_CHART_POLL_INTERVAL', 10000),
+		mode='append',
+		if_modified=True)
+
+
+def series_data(request, experiment, vial, param):
+	"""
+	Points of one vial's data series recorded after a given time.
+
+	The time comes from the If-None-Match header (polling clients) or the
+	"since" parameter; without either the whole series is returned. With
+	"window" a trailing mean column is added. format=f32 returns the columns
+	as little-endian float32 rows instead of JSON; encoding=b64 returns JSON
+	with each column as base64 float32 (see series.encode_b64).
+	"""
+	path, skip = series.series_path(experiment_dir(experiment), param, vial)
+	if not os.path.exists(path):
+		raise Http404("No {0} data for vial {1}".format(param, vial))
+
+	since = request.META.get('HTTP_IF_NONE_MATCH', '').replace('W/', '').strip('"') or request.GET.get('since')
+	try:
+		since = float(since) if since is not None else None
+		window = int(request.GET.get('window', 0))
+	except ValueError:
+		return HttpResponseBadRequest("since and window must be numbers")
+
+	context_data, data = series.read_since(path, since, skip, context=window)
+	columns = OrderedDict([('x', data[:, 0]), ('y', data[:, 1])])
+	if window:
+		values = np.concatenate([context_data[:, 1], data[:, 1]])
+		columns['mean'] = analytics.rolling_mean(values, window + 1)[len(context_data):]
+
+	if request.GET.get('format') == 'f32':
+		packed = np.column_stack(list(columns.values())).astype('<f4')
+		response = HttpResponse(packed.tobytes(), content_type='application/octet-stream')
+		response['X-Columns'] = ','.join(columns)
+	elif request.GET.get('encoding') == 'b64':
+		response = JsonResponse({k: series.encode_b64(v) for k, v in columns.items()})
+	else:
+		# Same NaN convention as Bokeh's own serializer
+		response = JsonResponse({k: [x if np.isfinite(x) else 'NaN' for x in series.compact(v).tolist()] for k, v in columns.items()})
+
+	last_time = data[-1, 0] if len(data) else since
+	if last_time is not None:
+		response['ETag'] = '"{0!r}"'.format(float(last_time))
+	response['Cache-Control'] = 'no-cache'
+	return response
+
+
+def stream(request, experiment):
+	"""
+	Server-sent events relayed from the experiment's live data bus, e.g.
+	?topics=od,gr&vial=3 for the OD and growth rate of vial 3 only.
+	"""
+	expt_path = experiment_dir(experiment)
+	topics = request.GET.get('topics')
+	vial = request.GET.get('vial')
+	try:
+		vial = int(vial) if vial is not None else None
+	except ValueError:
+		return HttpResponseBadRequest("vial must be a number")
+
+	response = StreamingHttpResponse(live.event_stream(expt_path, topics.split(',') if topics else None, vial), content_type='text/event-stream')
+	response['Cache-Control'] = 'no-cache'
+	return response
 
 
 def file_scan(tag):
-	rootdir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
-	evolver_dir = os.path.join(rootdir, "experiment")
-	url_string = '{%s url "home" %s}' % ('%','%')
+	# Served from the cached experiment catalog; see catalog.py
+	return get_catalog().file_scan(tag)
 
-	sidebar_links =[]
-	subdir_log = []
 
-	for subdir in next(os.walk(evolver_dir))[1]:
-		subdirname = os.path.join(next(os.walk(evolver_dir))[0], subdir)
+def experiment_dir(experiment):
+	expt_path = get_catalog().experiment_dir(experiment)
+	if expt_path is None:
+		raise Http404("Experiment {0} not found".format(experiment))
+	return expt_path
 
-		for subsubdir in next(os.walk(subdirname))[1]:
-			if tag in subsubdir:
-				#add_string = "<li><a href='%s'>%s</a></li>" % (url_string,subsubdir)
-				sidebar_links.append(subsubdir)
-				subdir_log.append(subdir)
-				subdir_log.append(subdir)
 
-	return sidebar_links,subdir_log
+def experiment_vials(experiment):
+	metadata = get_catalog().metadata(experiment)
+	if metadata is None or metadata['vial_count'] == 0:
+		return range(0, 16)
+	return range(0, metadata['vial_count'])